@@ -0,0 +1,285 @@
+# assets.py — Solo System static asset pipeline
+#
+#   python assets.py            # build static/dist (Dockerfile and render.yaml run this)
+#
+# build() copies the page's assets (ASSETS) into static/dist under
+# content-hashed names (app.3f2a9c1d04.js), rewriting the /static/... links
+# between them, and writes index.html and sw.js with their links pointing at
+# those names and the service worker's precache list and cache name derived
+# from them. Compressible files get .gz and, when the `brotli` package is
+# installed, .br siblings. dist/assets.json records the result together
+# with the source hashes, so a server started against edited sources
+# rebuilds instead of serving a stale copy.
+#
+# AssetFiles serves /static from that build: hashed names are immutable for a
+# year, index.html and sw.js are revalidated every time, every file has an
+# ETag answered with 304 on If-None-Match, and bodies come precompressed per
+# Accept-Encoding. Files outside the build are served as before. Everything
+# is read into memory once; the whole build is a few hundred KB.
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+import mimetypes
+from typing import Any, Dict, List, Mapping, Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli (gzip variants are always built)
+    brotli = None
+
+log = logging.getLogger("solo.assets")
+
+# Fingerprinted, in dependency order: a file may link to those before it
+# (manifest.json names the icons).
+ASSETS = [
+    "styles.css",
+    "app.js",
+    "sw-register.js",
+    "icon-192.svg",
+    "icon-512.svg",
+    "favicon.ico",
+    "sounds/ping.wav",
+    "manifest.json",
+]
+# Kept at their URLs (/ and /sw.js) and revalidated on every load.
+PAGES = ["index.html", "sw.js"]
+
+DIST = "dist"
+MANIFEST = "assets.json"
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "application/manifest+json",
+                "image/svg+xml", "image/vnd.microsoft.icon", "image/x-icon")
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))  # preference order
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("image/svg+xml", ".svg")
+
+def digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def media_type(name: str) -> str:
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+def hashed_name(name: str, data: bytes) -> str:
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest(data)[:10]}{ext}"
+
+def _write(path: str, data: bytes) -> None:
+    # whole files only: another worker may be reading (or building) too
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# === Build ===
+def _link_re(names: List[str]) -> "re.Pattern[str]":
+    # /static/app.js, /static/app.js?v11.9 -> one match per known asset
+    alts = "|".join(re.escape(n) for n in sorted(names, key=len, reverse=True))
+    return re.compile(r"/static/(%s)(?:\?[\w.=&-]*)?(?=[\"'\s)])" % alts)
+
+def _rewrite(data: bytes, urls: Dict[str, str]) -> bytes:
+    if not urls:
+        return data
+    text = data.decode("utf-8")
+    return _link_re(list(urls)).sub(lambda m: urls[m.group(1)], text).encode("utf-8")
+
+def _variants(data: bytes, mime: str) -> Dict[str, bytes]:
+    out = {}
+    if not mime.startswith(COMPRESSIBLE):
+        return out
+    if brotli is not None:
+        out["br"] = brotli.compress(data, quality=11)
+    out["gzip"] = gzip.compress(data, 9, mtime=0)
+    # not worth a Content-Encoding unless it saves a tenth
+    return {enc: body for enc, body in out.items() if len(body) < len(data) * 0.9}
+
+def source_hashes(static_dir: str) -> Dict[str, str]:
+    out = {}
+    for name in ASSETS + PAGES:
+        path = os.path.join(static_dir, name)
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                out[name] = digest(f.read())
+    return out
+
+def build(static_dir: str) -> Dict[str, Any]:
+    """Write static/dist and return its manifest."""
+    dist = os.path.join(static_dir, DIST)
+    previous = read_manifest(static_dir) or {}
+    files: Dict[str, Dict[str, Any]] = {}
+    urls: Dict[str, str] = {}  # source name -> hashed URL
+
+    def emit(served: str, data: bytes, immutable: bool) -> None:
+        mime = media_type(served)
+        variants = _variants(data, mime)
+        _write(os.path.join(dist, served), data)
+        for enc, suffix in ENCODINGS:
+            if enc in variants:
+                _write(os.path.join(dist, served + suffix), variants[enc])
+        files[served] = {"type": mime, "etag": digest(data), "immutable": immutable,
+                         "size": len(data), "encodings": {enc: len(v) for enc, v in variants.items()}}
+
+    for name in ASSETS:
+        path = os.path.join(static_dir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = f.read()
+        if media_type(name).startswith(COMPRESSIBLE):
+            data = _rewrite(data, urls)
+        served = hashed_name(name, data)
+        emit(served, data, True)
+        urls[name] = f"/static/{served}"
+
+    version = digest("".join(sorted(urls.values())).encode())[:10]
+    for name in PAGES:
+        path = os.path.join(static_dir, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, "rb") as f:
+            data = _rewrite(f.read(), urls)
+        if name == "sw.js":
+            # a new build is a new cache; activate drops the old one
+            data = re.sub(rb'const CACHE_NAME = "[^"]*"', b'const CACHE_NAME = "solo-cache-%s"' % version.encode(), data)
+        emit(name, data, False)
+
+    manifest = {"version": version, "sources": source_hashes(static_dir), "urls": urls, "files": files}
+    _write(os.path.join(dist, MANIFEST), json.dumps(manifest, indent=2).encode())
+    # keep the previous build's files one more round for pages still open on it
+    keep = {MANIFEST} | set(files) | set(previous.get("files", {}))
+    for root, _, names in os.walk(dist):
+        for n in names:
+            if n.endswith(".tmp"):
+                continue
+            rel = os.path.relpath(os.path.join(root, n), dist).replace(os.sep, "/")
+            for _, suffix in ENCODINGS:
+                if rel.endswith(suffix):
+                    rel = rel[:-len(suffix)]
+            if rel not in keep:
+                os.remove(os.path.join(root, n))
+    log.info("Built static assets %s (%s files, brotli=%s)", version, len(files), brotli is not None)
+    return manifest
+
+def read_manifest(static_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(static_dir, DIST, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def ensure_built(static_dir: str) -> Optional[Dict[str, Any]]:
+    """The current build, rebuilt first if the sources changed since; None if it can't be written."""
+    manifest = read_manifest(static_dir)
+    if manifest and manifest.get("sources") == source_hashes(static_dir):
+        return manifest
+    try:
+        return build(static_dir)
+    except OSError as e:
+        log.warning("Serving unbuilt static files: %s", e)
+        return None
+
+# === Serving ===
+def etag_matches(headers: Mapping[str, str], etag: str) -> bool:
+    """Whether If-None-Match names `etag` (quoted, as sent) or one of its encoded forms."""
+    header = headers.get("if-none-match")
+    if not header:
+        return False
+    tag = etag.strip('"')
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        candidate = candidate[2:] if candidate.startswith("W/") else candidate
+        candidate = candidate.strip('"')
+        if candidate == tag or candidate in (f"{tag}-{enc}" for enc, _ in ENCODINGS):
+            return True
+    return False
+
+def accepted(headers: Mapping[str, str]) -> List[str]:
+    """Content codings the client takes (Accept-Encoding, q=0 excluded)."""
+    out = []
+    for part in headers.get("accept-encoding", "").split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name.strip() and q > 0:
+            out.append(name.strip().lower())
+    return out
+
+class Asset:
+    __slots__ = ("type", "etag", "cache", "bodies")
+
+    def __init__(self, mime: str, etag: str, immutable: bool, bodies: Dict[str, bytes]):
+        self.type = mime
+        self.etag = etag
+        self.cache = IMMUTABLE if immutable else REVALIDATE
+        self.bodies = bodies  # "identity", "br", "gzip"
+
+    def response(self, headers: Mapping[str, str]) -> Response:
+        takes = accepted(headers)
+        enc = next((e for e, _ in ENCODINGS if e in self.bodies and (e in takes or "*" in takes)), "identity")
+        out = {
+            "Cache-Control": self.cache,
+            "ETag": f'"{self.etag}"' if enc == "identity" else f'"{self.etag}-{enc}"',
+        }
+        if len(self.bodies) > 1:
+            out["Vary"] = "Accept-Encoding"
+        if etag_matches(headers, self.etag):
+            return Response(status_code=304, headers=out)
+        if enc != "identity":
+            out["Content-Encoding"] = enc
+        return Response(self.bodies[enc], media_type=self.type, headers=out)
+
+class AssetFiles(StaticFiles):
+    """/static mount: the build in static/dist first, the plain files after."""
+
+    def __init__(self, directory: str, build: bool = True):
+        super().__init__(directory=directory)
+        self.files: Dict[str, Asset] = {}
+        self.version: Optional[str] = None
+        manifest = ensure_built(directory) if build else None
+        if manifest:
+            self.load(os.path.join(directory, DIST), manifest)
+
+    def load(self, dist: str, manifest: Dict[str, Any]) -> None:
+        for served, meta in manifest["files"].items():
+            bodies = {}
+            for enc, suffix in (("identity", ""),) + ENCODINGS:
+                if enc == "identity" or enc in meta["encodings"]:
+                    with open(os.path.join(dist, served + suffix), "rb") as f:
+                        bodies[enc] = f.read()
+            self.files[served] = Asset(meta["type"], meta["etag"], meta["immutable"], bodies)
+        self.version = manifest["version"]
+
+    def page(self, name: str, headers: Mapping[str, str]) -> Optional[Response]:
+        asset = self.files.get(name)
+        return asset.response(headers) if asset is not None else None
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        asset = self.files.get(path.replace(os.sep, "/"))
+        if asset is not None and scope["method"] in ("GET", "HEAD"):
+            return asset.response(Headers(scope=scope))
+        resp = await super().get_response(path, scope)
+        resp.headers.setdefault("Cache-Control", REVALIDATE)
+        return resp
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    build(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
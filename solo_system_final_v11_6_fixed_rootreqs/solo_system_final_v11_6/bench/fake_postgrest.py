@@ -0,0 +1,174 @@
+# fake_postgrest.py — in-process stand-in for the Supabase REST API
+#
+# Speaks just enough PostgREST for SupabaseJsonStorage: player_data rows
+# (GET with select/id/version filters, POST with ignore/merge-duplicates,
+# conditional PATCH) and the player_data_apply_patch RPC from schema.sql.
+# The archive tables answer 404, so the app runs the way it does on a
+# deployment without them. Every call can be delayed (latency + jitter) and
+# failed (error rate), per method, from a seeded RNG so runs repeat.
+
+import copy
+import json
+import random
+import asyncio
+from typing import Any, Dict, List, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+class Faults:
+    """Delay and failure injection for one HTTP method."""
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def as_dict(self) -> Dict[str, float]:
+        return {"latency_ms": self.latency_ms, "jitter_ms": self.jitter_ms, "error_rate": self.error_rate}
+
+def _filters(request: Request) -> Dict[str, str]:
+    """PostgREST eq. filters from the query string (other operators are not used by the app)."""
+    out = {}
+    for key, value in request.query_params.multi_items():
+        if key not in ("select", "order", "limit", "on_conflict") and value.startswith("eq."):
+            out[key] = value[3:]
+    return out
+
+def _key(node: Any, k: str) -> Any:
+    return int(k) if isinstance(node, list) else k
+
+def apply_ops(doc: Dict[str, Any], ops: List[Dict[str, Any]]) -> None:
+    """player_data_apply_patch: jsonb_set / || / #- over string paths."""
+    for op in ops:
+        path = op["path"]
+        node: Any = doc
+        for k in path[:-1]:
+            k = _key(node, k)
+            if isinstance(node, dict) and not isinstance(node.get(k), (dict, list)):
+                node[k] = {}  # jsonb_set creates only the leaf; main.py records the parents
+            node = node[k]
+        last = _key(node, path[-1])
+        if op["op"] == "set":
+            if isinstance(node, list) and last >= len(node):
+                node.append(op["value"])
+            else:
+                node[last] = op["value"]
+        elif op["op"] == "append":
+            if not isinstance(node.get(last) if isinstance(node, dict) else node[last], list):
+                node[last] = []
+            node[last].append(op["value"])
+        elif op["op"] == "remove":
+            try:
+                node.pop(last)
+            except (KeyError, IndexError):
+                pass
+
+class FakePostgrest:
+    """ASGI app holding player_data rows in memory."""
+
+    TABLE = "player_data"
+    RPC = "player_data_apply_patch"
+
+    def __init__(self, faults: Optional[Dict[str, Faults]] = None, seed: int = 1):
+        self.faults = faults or {}
+        self.rng = random.Random(seed)
+        self.rows: Dict[str, Dict[str, Any]] = {}
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.requests: Dict[str, int] = {}
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def put(self, player: str, data: Dict[str, Any], version: int = 0) -> None:
+        self.rows[player] = {"id": player, "data": copy.deepcopy(data), "version": version, "updated_at": None}
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": dict(self.requests), "errors": self.errors,
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            return
+        request = Request(scope, receive)
+        body = await request.body()
+        method = request.method
+        self.requests[method] = self.requests.get(method, 0) + 1
+        self.bytes_in += len(body)
+        faults = self.faults.get(method) or self.faults.get("*")
+        if faults is not None:
+            delay = faults.latency_ms + self.rng.uniform(-faults.jitter_ms, faults.jitter_ms)
+            if delay > 0:
+                await asyncio.sleep(delay / 1000.0)
+            if faults.error_rate and self.rng.random() < faults.error_rate:
+                self.errors += 1
+                resp = Response('{"message":"injected failure"}', status_code=503, media_type="application/json")
+                return await self._send(resp, scope, receive, send)
+        status, payload = self.handle(method, request, json.loads(body) if body else None)
+        text = "" if status == 204 else json.dumps(payload, separators=(",", ":"))
+        await self._send(Response(text, status_code=status, media_type="application/json"), scope, receive, send)
+
+    async def _send(self, resp: Response, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        self.bytes_out += len(resp.body)
+        await resp(scope, receive, send)
+
+    def handle(self, method: str, request: Request, body: Any) -> Tuple[int, Any]:
+        path = request.url.path
+        if path == f"/rest/v1/rpc/{self.RPC}" and method == "POST":
+            return self.apply_patch(body or {})
+        if path != f"/rest/v1/{self.TABLE}":
+            return 404, {"code": "42P01", "message": f"relation {path.rsplit('/', 1)[-1]} does not exist"}
+        if method == "GET":
+            return 200, self.select(request)
+        if method == "POST":
+            return self.insert(request, body or {})
+        if method == "PATCH":
+            return self.update(request, body or {})
+        return 405, {"message": "method not allowed"}
+
+    def _matching(self, request: Request) -> List[Dict[str, Any]]:
+        f = _filters(request)
+        rows = [self.rows[f["id"]]] if "id" in f and f["id"] in self.rows else ([] if "id" in f else list(self.rows.values()))
+        if "version" in f:
+            rows = [r for r in rows if str(r["version"]) == f["version"]]
+        return rows
+
+    def _project(self, request: Request, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        select = request.query_params.get("select")
+        if not select or select == "*":
+            return rows
+        cols = select.split(",")
+        return [{c: r.get(c) for c in cols} for r in rows]
+
+    def select(self, request: Request) -> List[Dict[str, Any]]:
+        return self._project(request, self._matching(request))
+
+    def insert(self, request: Request, body: Dict[str, Any]) -> Tuple[int, Any]:
+        prefer = request.headers.get("prefer", "")
+        player = str(body.get("id"))
+        if player in self.rows and "merge-duplicates" not in prefer:
+            return (201, []) if "ignore-duplicates" in prefer else (409, {"code": "23505"})
+        row = self.rows.setdefault(player, {"id": player, "data": {}, "version": 0, "updated_at": None})
+        row.update(copy.deepcopy(body))
+        return 201, [row] if "return=representation" in prefer else None
+
+    def update(self, request: Request, body: Dict[str, Any]) -> Tuple[int, Any]:
+        rows = self._matching(request)
+        for row in rows:
+            row.update(copy.deepcopy(body))
+        if "return=representation" in request.headers.get("prefer", ""):
+            return 200, self._project(request, rows)
+        return 204, None
+
+    def apply_patch(self, body: Dict[str, Any]) -> Tuple[int, Any]:
+        row = self.rows.get(str(body.get("p_id")))
+        if row is None:
+            return 400, {"code": "P0002", "message": "player_data row not found"}
+        expected = body.get("p_expected_version")
+        if expected is not None and row["version"] != expected:
+            return 200, None
+        apply_ops(row["data"], body.get("p_ops") or [])
+        row["version"] += 1
+        return 200, {"version": row["version"], "updated_at": None}
@@ -0,0 +1,88 @@
+# fixture.py — write a large player history in the /api/export format
+#
+#   python bench/fixture.py --tasks 200 --diary 50000 --ledger 20000 > big.ndjson
+#   curl -T big.ndjson -H 'Content-Type: application/x-ndjson' http://127.0.0.1:8000/p/load1/api/import
+#
+# Records are generated and written one at a time, so any size fits in
+# memory. Ledger entries are task rewards; all but the newest --hot-ledger are
+# folded into the state's ledger_checkpoint (they land in ledger_archive on
+# import) and the state's coins, XP and tasks completed are the resulting
+# balance, so the imported document checks out against its ledger.
+
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run  # noqa: E402  (sets the app's environment, imports main)
+from run import WORDS  # noqa: E402
+
+main = run.main
+new_id = main.new_id
+
+def write(out: Any, record: Dict[str, Any]) -> None:
+    out.write(main.export_line(record))
+
+def rewards(n: int, stats: List[str], seed: int) -> Iterator[Tuple[int, str, int]]:
+    """(coins, stat, xp) per ledger entry; the same sequence on every call."""
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield rng.randint(1, 10), rng.choice(stats), rng.randint(0, 50)
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--tasks", type=int, default=200)
+    ap.add_argument("--diary", type=int, default=50000)
+    ap.add_argument("--ledger", type=int, default=20000)
+    ap.add_argument("--hot-ledger", type=int, default=100, help="newest ledger entries left unfolded")
+    ap.add_argument("--player", default="fixture")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    rng = random.Random(args.seed)
+    out = sys.stdout.buffer
+    doc = main.seed_data()
+    stats = list(doc["stat_progress"])
+    start = datetime(2020, 1, 1, 7, 0)
+
+    # one pass for the balances, a second (same sequence) for the entries
+    folded = args.ledger - min(args.hot_ledger, args.ledger)
+    checkpoint = {"seq": folded, "coins": 0, "xp": {s: 0 for s in stats}, "tasks_completed": folded}
+    balance = {"coins": 0, "xp": {s: 0 for s in stats}, "tasks_completed": args.ledger}
+    for seq, (coins, stat, xp) in enumerate(rewards(args.ledger, stats, args.seed), 1):
+        for total in (balance, checkpoint) if seq <= folded else (balance,):
+            total["coins"] += coins
+            total["xp"][stat] += xp
+
+    state = {k: v for k, v in doc.items() if k not in main.NOT_STATE}
+    state["name"] = args.player
+    state["shop"]["coins"] = balance["coins"]
+    state["stat_progress"] = {s: main.xp_progress(t) for s, t in balance["xp"].items()}
+    state["stats"] = {"tasks_completed": balance["tasks_completed"]}
+    state["ledger_checkpoint"] = checkpoint
+
+    write(out, {"type": "header", "format": main.EXPORT_FORMAT, "version": main.EXPORT_VERSION,
+                "export_id": new_id(), "player": args.player, "schema_version": main.model.SCHEMA_VERSION,
+                "exported_at": datetime.now().isoformat(timespec="seconds")})
+    write(out, {"type": "settings", "data": doc["settings"]})
+    write(out, {"type": "state", "data": state})
+    for i in range(args.tasks):
+        write(out, {"type": "task", "data": {
+            "id": new_id(), "task": f"task {i}", "deadline": None, "done": False,
+            "created": (start + timedelta(hours=i)).isoformat(), "coins": 5, "xp": rng.randint(0, 50),
+            "stat": rng.choice(stats), "failed": False}})
+    for i in range(args.diary):
+        write(out, {"type": "diary", "data": {
+            "id": new_id(), "text": f"day {i}: " + " ".join(rng.choice(WORDS) for _ in range(20)),
+            "ts": (start + timedelta(hours=i)).isoformat()}})
+    for seq, (coins, stat, xp) in enumerate(rewards(args.ledger, stats, args.seed), 1):
+        write(out, {"type": "ledger", "data": {
+            "seq": seq, "ts": (start + timedelta(hours=seq)).isoformat(), "kind": "task.reward",
+            "ref": None, "coins": coins, "stat": stat, "xp": xp, "tasks": 1}})
+    write(out, {"type": "end", "counts": {"task": args.tasks, "diary": args.diary, "ledger": args.ledger}})
+
+if __name__ == "__main__":
+    main_cli()
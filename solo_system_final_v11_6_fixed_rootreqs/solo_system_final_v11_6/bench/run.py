@@ -0,0 +1,270 @@
+# run.py — load test / benchmark for the Solo System API
+#
+#   python bench/run.py --concurrency 1,8,32 --diary 10,50000 --out bench.json
+#   python bench/run.py --baseline bench.json          # compare with an earlier run
+#
+# The app runs in this process on the supabase backend, talking to the
+# FakePostgrest stand-in (see fake_postgrest.py) through an in-memory ASGI
+# transport, and the load generator calls the app the same way. No network
+# and no Supabase project needed; with a fixed --seed runs are repeatable.
+#
+# For every document size the fake store is reset to one player document
+# with that many diary entries (plus --tasks tasks), then every scenario runs
+# at every concurrency level: `concurrency` workers issue --requests
+# requests in total. Each result reports throughput, latency percentiles,
+# error count, bytes exchanged with clients and with the fake Supabase.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from typing import Any, Callable, Dict, List, Optional
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+# before main is imported: the app reads its configuration at import time
+os.environ.setdefault("STORAGE_BACKEND", "supabase")
+os.environ.setdefault("SUPABASE_URL", "http://fake-postgrest")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+os.environ.setdefault("SCHEDULER", "0")
+# the fake has no archive tables; keep big documents whole instead of
+# retrying compaction after every write
+os.environ.setdefault("DIARY_HOT_MAX", str(10 ** 9))
+os.environ.setdefault("DIARY_HOT_DAYS", "0")
+os.environ.setdefault("LEDGER_HOT_MAX", str(10 ** 9))
+# measure the Supabase path itself: with the write journal on, injected
+# write errors would be absorbed (and replayed into the next scenario's row)
+os.environ.setdefault("JOURNAL", "0")
+
+import httpx
+
+from fake_postgrest import FakePostgrest, Faults
+
+import main
+from storage import new_id
+
+PLAYER = "bench"
+
+# name -> (method, path for a worker's n-th request given the seeded document, JSON body)
+Scenario = Callable[[Dict[str, Any], int], Any]
+
+def _task_id(doc: Dict[str, Any], n: int) -> str:
+    tasks = doc["tasks"]
+    return tasks[n % len(tasks)]["id"]
+
+SCENARIOS: Dict[str, Scenario] = {
+    "data": lambda doc, n: ("GET", "/api/data", None),
+    "data_fields": lambda doc, n: ("GET", "/api/data?fields=name,streak,shop.coins,stats", None),
+    "tasks_page": lambda doc, n: ("GET", "/api/tasks?limit=30", None),
+    "diary_page": lambda doc, n: ("GET", "/api/diary?limit=30", None),
+    "toggle": lambda doc, n: ("POST", f"/api/tasks/{_task_id(doc, n)}/toggle", None),
+    "toggle_index": lambda doc, n: ("POST", f"/api/tasks/toggle/{n % len(doc['tasks'])}", None),
+    "ping": lambda doc, n: ("POST", "/api/ping", None),
+    "shop_buy": lambda doc, n: ("POST", "/api/shop/buy/2", None),
+    "diary_add": lambda doc, n: ("POST", "/api/diary/add", {"entry": f"bench entry {n}"}),
+    "batch": lambda doc, n: ("POST", "/api/batch", {"ops": [
+        {"op": "task.toggle", "id": _task_id(doc, n)},
+        {"op": "diary.add", "entry": f"bench batch {n}"},
+        {"op": "shop.buy", "id": 2},
+    ]}),
+    "analytics": lambda doc, n: ("GET", "/api/analytics?granularity=week&from=2024-01-01&to=2024-12-31", None),
+}
+
+def build_doc(diary: int, tasks: int, rng: random.Random) -> Dict[str, Any]:
+    doc = main.seed_data()
+    doc["name"] = "bench"
+    doc["shop"]["coins"] = 10 ** 9  # never runs out during shop_buy
+    doc["tasks"] = [{"id": new_id(), "task": f"task {i}", "deadline": None, "done": False,
+                     "created": "2024-01-01T08:00:00", "coins": 5, "xp": rng.randint(0, 50),
+                     "stat": rng.choice(list(doc["stat_progress"])), "failed": False}
+                    for i in range(tasks)]
+    doc["diary"] = [{"id": new_id(), "text": f"day {i}: " + " ".join(rng.choice(WORDS) for _ in range(20)),
+                     "ts": f"2024-01-01T{i % 24:02d}:00:00"} for i in range(diary)]
+    return doc
+
+WORDS = ["trained", "read", "prayed", "slept", "early", "late", "focus", "walked", "journal", "cold",
+         "shower", "gym", "study", "calm", "tired", "strong", "meal", "water", "phone", "quiet"]
+
+def percentile(sorted_ms: List[float], q: float) -> Optional[float]:
+    if not sorted_ms:
+        return None
+    i = min(len(sorted_ms) - 1, max(0, int(round(q * (len(sorted_ms) - 1)))))
+    return round(sorted_ms[i], 3)
+
+async def reset_app(fake: FakePostgrest, doc: Dict[str, Any]) -> None:
+    """Fresh fake row and fresh in-process state (caches, indexes, hubs)."""
+    await main.players.close()
+    main.players = main.PlayerRegistry(main.MAX_RESIDENT_PLAYERS)
+    main.deadlines = main.DeadlineScheduler()
+    fake.rows.clear()
+    fake.put(PLAYER, doc)
+
+async def run_one(client: httpx.AsyncClient, fake: FakePostgrest, doc: Dict[str, Any], name: str,
+                  concurrency: int, requests: int, warmup: int) -> Dict[str, Any]:
+    make = SCENARIOS[name]
+    for n in range(warmup):
+        method, path, body = make(doc, n)
+        await client.request(method, path, json=body)
+    fake.reset_counters()
+    latencies: List[float] = []
+    errors = 0
+    bytes_in = bytes_out = 0
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors, bytes_in, bytes_out
+        for n in counter:
+            method, path, body = make(doc, warmup + n)
+            content = json.dumps(body).encode() if body is not None else b""
+            t0 = time.perf_counter()
+            try:
+                resp = await client.request(method, path, content=content or None,
+                                            headers={"Content-Type": "application/json"} if content else None)
+            except Exception:
+                errors += 1
+                continue
+            latencies.append((time.perf_counter() - t0) * 1000)
+            bytes_out += len(content)
+            bytes_in += len(resp.content)
+            if resp.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    upstream = fake.stats()
+    return {
+        "scenario": name,
+        "diary": len(doc["diary"]),
+        "tasks": len(doc["tasks"]),
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "duration_s": round(elapsed, 4),
+        "throughput_rps": round(requests / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": round(latencies[-1], 3) if latencies else None,
+            "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        },
+        "bytes": {
+            "client_in": bytes_in,
+            "client_out": bytes_out,
+            "upstream_in": upstream["bytes_in"],
+            "upstream_out": upstream["bytes_out"],
+            "per_request": round((bytes_in + bytes_out + upstream["bytes_in"] + upstream["bytes_out"]) / requests, 1),
+        },
+        "upstream_requests": upstream["requests"],
+        "upstream_errors": upstream["errors"],
+    }
+
+def git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    faults = {"*": Faults(args.latency_ms, args.jitter_ms, args.error_rate)}
+    for spec in args.fault or []:
+        # METHOD:latency_ms[:jitter_ms[:error_rate]]
+        method, *vals = spec.split(":")
+        nums = [float(v) for v in vals] + [0.0] * (3 - len(vals))
+        faults[method.upper()] = Faults(*nums[:3])
+    fake = FakePostgrest(faults, seed=args.seed)
+    rng = random.Random(args.seed)
+    remote = getattr(main.store, "inner", main.store)  # JOURNAL=1 wraps the supabase store
+    remote.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake), headers=remote.headers())
+    results = []
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench",
+                                     headers={main.PLAYER_HEADER: PLAYER}) as client:
+            for diary in args.diary:
+                doc = build_doc(diary, args.tasks, rng)
+                for name in args.scenarios:
+                    for concurrency in args.concurrency:
+                        await reset_app(fake, doc)
+                        result = await run_one(client, fake, doc, name, concurrency, args.requests, args.warmup)
+                        results.append(result)
+                        print(f"{name:>13} diary={diary:<6} c={concurrency:<3} {result['throughput_rps']:>9} rps  "
+                              f"p50={result['latency_ms']['p50']}ms p99={result['latency_ms']['p99']}ms "
+                              f"errors={result['errors']}", file=sys.stderr)
+    return {
+        "meta": {
+            "git": git_rev(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": args.seed,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "faults": {m: f.as_dict() for m, f in faults.items()},
+            "env": {k: os.environ.get(k) for k in ("CACHE_TTL", "WRITE_BEHIND_MS", "OCC_RETRIES")},
+        },
+        "results": results,
+    }
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Per-result ratios against a baseline run (current / baseline)."""
+    key = lambda r: (r["scenario"], r["diary"], r["concurrency"])
+    old = {key(r): r for r in baseline.get("results", [])}
+    out = []
+    for r in current["results"]:
+        b = old.get(key(r))
+        if not b:
+            continue
+        ratio = lambda a, z: round(a / z, 3) if a is not None and z else None
+        out.append({"scenario": r["scenario"], "diary": r["diary"], "concurrency": r["concurrency"],
+                    "throughput": ratio(r["throughput_rps"], b["throughput_rps"]),
+                    "p50": ratio(r["latency_ms"]["p50"], b["latency_ms"]["p50"]),
+                    "p99": ratio(r["latency_ms"]["p99"], b["latency_ms"]["p99"]),
+                    "bytes_per_request": ratio(r["bytes"]["per_request"], b["bytes"]["per_request"])})
+    return out
+
+def int_list(v: str) -> List[int]:
+    return [int(x) for x in v.split(",") if x]
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--scenarios", type=lambda v: v.split(","), default=list(SCENARIOS),
+                    help="comma-separated: " + ",".join(SCENARIOS))
+    ap.add_argument("--concurrency", type=int_list, default=[1, 8, 32])
+    ap.add_argument("--diary", type=int_list, default=[10, 50000], help="diary sizes of the seeded document")
+    ap.add_argument("--tasks", type=int, default=50)
+    ap.add_argument("--requests", type=int, default=200, help="requests per scenario/size/concurrency")
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="fake Supabase latency for every call")
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--fault", action="append", help="per method, e.g. POST:40:10:0.01 (latency:jitter:error rate)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="write the JSON report here (default stdout)")
+    ap.add_argument("--baseline", help="earlier JSON report to compare against")
+    args = ap.parse_args()
+    unknown = [s for s in args.scenarios if s not in SCENARIOS]
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(unknown)}")
+    report = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f))
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,87 @@
+# serialize.py — encode/decode cost of a player document
+#
+#   python bench/serialize.py --diary 10,5000,50000 --out serialize.json
+#
+# Times, per document size, what every request and write pays on its own:
+#   stdlib_encode   json.dumps(jsonable_encoder(doc)), the old response path
+#   codec_encode    codec.dumps(doc), what TimedJSONResponse and the stores use
+#   stdlib_decode / codec_decode   parsing the same bytes back
+#   migrate         model.migrate() on a document already at SCHEMA_VERSION
+#   fill_shape      the v2 shape walk, for comparison
+# Each figure is the median of --repeat runs in milliseconds. codec falls back
+# to the stdlib when orjson is missing; "backend" in the report says which ran.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import run  # noqa: E402  (sets the app's environment, imports main)
+from run import build_doc, int_list, git_rev  # noqa: E402
+
+import codec  # noqa: E402
+import model  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from storage import DocPatch  # noqa: E402
+
+def median_ms(fn: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(times), 3)
+
+def measure(doc: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    stdlib = json.dumps(jsonable_encoder(doc)).encode()
+    fast = codec.dumps(doc)
+    return {
+        "bytes": {"stdlib": len(stdlib), "codec": len(fast)},
+        "ms": {
+            "stdlib_encode": median_ms(lambda: json.dumps(jsonable_encoder(doc)).encode(), repeat),
+            "codec_encode": median_ms(lambda: codec.dumps(doc), repeat),
+            "stdlib_decode": median_ms(lambda: json.loads(stdlib), repeat),
+            "codec_decode": median_ms(lambda: codec.loads(fast), repeat),
+            "migrate": median_ms(lambda: model.migrate(DocPatch(doc), run.main.seed_data), repeat),
+            "fill_shape": median_ms(lambda: model.fill_shape(DocPatch(doc), run.main.seed_data), repeat),
+        },
+    }
+
+def main_cli() -> None:
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("--diary", type=int_list, default=[10, 5000, 50000], help="diary sizes of the document")
+    ap.add_argument("--tasks", type=int, default=50)
+    ap.add_argument("--repeat", type=int, default=20)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="write the JSON report here (default stdout)")
+    args = ap.parse_args()
+    rng = random.Random(args.seed)
+    results: List[Dict[str, Any]] = []
+    for diary in args.diary:
+        result = {"diary": diary, **measure(build_doc(diary, args.tasks, rng), args.repeat)}
+        ms = result["ms"]
+        speedup = lambda a, b: round(ms[a] / ms[b], 2) if ms[b] else None
+        result["speedup"] = {"encode": speedup("stdlib_encode", "codec_encode"),
+                             "decode": speedup("stdlib_decode", "codec_decode")}
+        results.append(result)
+        print(f"diary={diary:<6} encode {ms['stdlib_encode']:>9}ms -> {ms['codec_encode']:>9}ms  "
+              f"decode {ms['stdlib_decode']:>9}ms -> {ms['codec_decode']:>9}ms", file=sys.stderr)
+    report = {
+        "meta": {"git": git_rev(), "backend": codec.BACKEND, "repeat": args.repeat, "seed": args.seed},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,36 @@
+# codec.py — JSON encoding for documents, responses and storage payloads
+#
+# Player documents are plain JSON trees and are encoded or decoded on every
+# load, write, response and journal entry, so this goes through orjson when
+# it is installed (several times faster than the stdlib on large documents)
+# and falls back to the stdlib json module otherwise. Output is always compact
+# UTF-8; dict keys that aren't strings (int ids) are stringified, and values
+# JSON has no type for (datetimes, sets) become strings rather than errors.
+
+import json
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+def _fallback(v: Any) -> Any:
+    if isinstance(v, (set, frozenset, tuple)):
+        return list(v)
+    return str(v)
+
+def dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_fallback, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_fallback).encode()
+
+def dumps_str(obj: Any) -> str:
+    return dumps(obj).decode()
+
+def loads(data: Union[bytes, bytearray, memoryview, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
@@ -1,20 +1,40 @@
-# main.py — Solo System backend (Supabase-only, UPSERT-safe)
+# main.py — Solo System backend (Supabase / Postgres / SQLite storage)
 
 import os
+import copy
 import json
+import asyncio
+import heapq
 import random
+import re
+import time
 import logging
-from datetime import datetime, date
-from typing import Optional, Any, Dict
+import functools
+import threading
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, date, timedelta
+from typing import Optional, Any, AsyncIterator, Callable, Dict, List, Set, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import requests
-from fastapi import FastAPI, Request
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+import assets
+import codec
+import metrics
+import model
+import storage
+from metrics import span
+from storage import DocPatch, ItemIndex, WriteConflict, new_id
+from fastapi import FastAPI, Query, Request
+from starlette.requests import ClientDisconnect
+from fastapi.routing import APIRoute
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("solo")
+# httpx logs every request at INFO; keep the hot path quiet
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # === Paths & Static ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -31,40 +51,46 @@ for p in POSSIBLE_STATIC:
         break
 if not STATIC_DIR:
     STATIC_DIR = os.path.join(BASE_DIR, "static")
+# STATIC_BUILD=0 serves the files in static/ as they are (no fingerprinting,
+# no precompression), e.g. while editing them with the server running.
+STATIC_BUILD = os.getenv("STATIC_BUILD", "1") != "0"
 
-# === Supabase config (from environment) ===
-# Set these in Render → Environment:
-#   SUPABASE_URL = https://<project>.supabase.co
-#   SUPABASE_KEY = <anon or service role key>
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+# === Small helpers ===
+# APP_TIMEZONE (an IANA name such as "Asia/Kolkata") is the player's wall
+# clock: timestamps, naive task deadlines and the midnight streak roll use it.
+# Unset means the server's local time.
+def _app_tz() -> Optional[ZoneInfo]:
+    name = os.getenv("APP_TIMEZONE", "").strip()
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        log.warning("Unknown APP_TIMEZONE %r; using server local time", name)
+        return None
 
-def supabase_headers() -> Dict[str, str]:
-    if not SUPABASE_KEY:
-        return {}
-    return {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json",
-    }
+APP_TZ = _app_tz()
 
-def supabase_base_rest() -> str:
-    if not SUPABASE_URL:
-        raise RuntimeError("SUPABASE_URL is not set")
-    return SUPABASE_URL.rstrip("/") + "/rest/v1"
+def local_now() -> datetime:
+    """Naive wall-clock time in APP_TIMEZONE."""
+    return datetime.now(APP_TZ).replace(tzinfo=None) if APP_TZ else datetime.now()
 
-# === Small helpers ===
 def now_iso() -> str:
-    return datetime.now().isoformat()
+    return local_now().isoformat()
 
 def seed_data() -> Dict[str, Any]:
     return {
+        "schema_version": model.SCHEMA_VERSION,
         "name": None,
         "tasks": [],
-        "punishments": ["10m cold shower", "50 burpees", "No social media today"],
+        "punishments": [
+            {"id": new_id(), "text": "10m cold shower"},
+            {"id": new_id(), "text": "50 burpees"},
+            {"id": new_id(), "text": "No social media today"},
+        ],
         "non_negotiables": [
-            {"text": "No phone in bed", "created": now_iso(), "modified": None},
-            {"text": "No junk after 8pm", "created": now_iso(), "modified": None},
+            {"id": new_id(), "text": "No phone in bed", "created": now_iso(), "modified": None},
+            {"id": new_id(), "text": "No junk after 8pm", "created": now_iso(), "modified": None},
         ],
         "streak": 0,
         "best_streak": 0,
@@ -92,207 +118,1490 @@ def seed_data() -> Dict[str, Any]:
         "stats": {"tasks_completed": 0},
     }
 
-# === Supabase: player_data JSON store (single-row) ===
-# We store everything inside player_data(id='singleton').data (jsonb).
-
-SINGLETON_ID = "singleton"
-TABLE_NAME = "player_data"
-
-def ensure_singleton_exists() -> Dict[str, Any]:
-    """Fetch singleton. If missing, UPSERT seed data."""
-    url = f"{supabase_base_rest()}/{TABLE_NAME}?select=data&id=eq.{SINGLETON_ID}"
-    resp = requests.get(url, headers=supabase_headers(), timeout=8)
-    if resp.status_code == 200:
-        arr = resp.json()
-        if isinstance(arr, list) and arr:
-            return arr[0].get("data") or seed_data()
-        # Empty: create via UPSERT (merge duplicates)
-        payload = {"id": SINGLETON_ID, "data": seed_data()}
-        create_url = f"{supabase_base_rest()}/{TABLE_NAME}"
-        r = requests.post(
-            create_url,
-            headers={**supabase_headers(), "Prefer": "resolution=merge-duplicates,return=representation"},
-            json=payload,
-            timeout=8,
-        )
-        if r.status_code in (200, 201):
-            created = r.json()
-            if isinstance(created, list) and created:
-                return created[0].get("data") or payload["data"]
-            return payload["data"]
-        log.error("Supabase UPSERT seed failed %s: %s", r.status_code, r.text)
-        raise RuntimeError("Failed to create singleton row")
-    else:
-        log.error("Supabase GET failed %s: %s", resp.status_code, resp.text)
-        raise RuntimeError("Supabase unavailable or table missing")
-
-def load_data() -> Dict[str, Any]:
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        raise RuntimeError("Supabase env vars missing. Set SUPABASE_URL and SUPABASE_KEY.")
-    return ensure_singleton_exists()
-
-def save_data(data: Dict[str, Any]) -> bool:
-    """UPSERT to avoid 409 conflicts, always return True on success."""
-    url = f"{supabase_base_rest()}/{TABLE_NAME}"
-    payload = {"id": SINGLETON_ID, "data": data}
-    resp = requests.post(
-        url,
-        headers={**supabase_headers(), "Prefer": "resolution=merge-duplicates,return=representation"},
-        json=payload,
-        timeout=8,
-    )
-    if resp.status_code in (200, 201):
+# === Players ===
+# Every request acts on one player, named by (first match wins) a /p/<id>/
+# path prefix, the X-Player-Id header or the player_id cookie. Without any,
+# DEFAULT_PLAYER_ID is used ("singleton", the row from single-user days).
+# Each player has its own document, cache, lock and write-behind queue, so
+# players never wait on each other; MAX_RESIDENT_PLAYERS bounds how many of
+# those stay in memory (least recently used idle ones are dropped).
+DEFAULT_PLAYER_ID = os.getenv("DEFAULT_PLAYER_ID", "singleton")
+MAX_RESIDENT_PLAYERS = int(os.getenv("MAX_RESIDENT_PLAYERS", "1000"))
+PLAYER_HEADER = "X-Player-Id"
+PLAYER_COOKIE = "player_id"
+PLAYER_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+PLAYER_PATH_RE = re.compile(r"^/p/([^/]+)(/.*)?$")
+
+current_player: ContextVar[str] = ContextVar("current_player", default=DEFAULT_PLAYER_ID)
+
+# === Storage backend ===
+# STORAGE_BACKEND picks where the player document lives (see storage.py):
+#   supabase  single jsonb row in player_data (default when SUPABASE_URL is set)
+#   postgres  normalized tables from schema.sql (DATABASE_URL)
+#   sqlite    same tables in a local WAL file (SQLITE_PATH, default data/solo.db)
+# Every backend bumps a version per write and rejects writes against a stale
+# version (WriteConflict), so several uvicorn workers can share one store.
+store = storage.create_storage(seed_data, BASE_DIR, DEFAULT_PLAYER_ID)
+
+# === In-process document cache ===
+# Reads are served from memory. Within CACHE_TTL seconds of the last check the
+# cached document is returned as-is; after that a one-column version probe
+# decides whether the full document has to be refetched. save_data() writes
+# through, so the cache always holds what we last persisted.
+CACHE_TTL = float(os.getenv("CACHE_TTL", "2"))
+
+class DocCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.data: Optional[Dict[str, Any]] = None
+        self.version: Optional[int] = None
+        self.checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.probes = 0
+        self.invalidations = 0
+
+    def fresh(self) -> bool:
+        return self.data is not None and time.monotonic() - self.checked < self.ttl
+
+    def put(self, data: Dict[str, Any], version: Optional[int]) -> None:
+        self.data = data
+        self.version = version
+        self.checked = time.monotonic()
+
+    def touch(self) -> None:
+        self.checked = time.monotonic()
+
+    def invalidate(self) -> None:
+        self.data = None
+        self.version = None
+        self.checked = 0.0
+        self.invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "probes": self.probes,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+            "ttl": self.ttl,
+            "cached": self.data is not None,
+            "version": self.version,
+        }
+
+async def load_data(player: Optional["Player"] = None) -> Dict[str, Any]:
+    """The current player's document (seeded on first access)."""
+    player = player or players.current()
+    cache = player.cache
+    if cache.data is not None:
+        # unflushed write-behind edits make the cached copy the source of truth
+        if cache.fresh() or player.writer.dirty:
+            cache.hits += 1
+            metrics.CACHE_LOOKUPS.inc("hit")
+            return cache.data
+        if cache.version is not None:
+            cache.probes += 1
+            with span("store_probe"):
+                version = await store.probe(player.id)
+            if version is not None and version == cache.version:
+                cache.touch()
+                cache.hits += 1
+                metrics.CACHE_LOOKUPS.inc("probe_hit")
+                return cache.data
+    cache.misses += 1
+    metrics.CACHE_LOOKUPS.inc("miss")
+    data, version = await load_migrated(player.id)
+    cache.put(data, version)
+    schedule_compaction(player)
+    deadlines.register(player.id, data)
+    return data
+
+# === Schema migrations ===
+# Tasks, punishments, non-negotiables and diary entries carry an "id" that
+# never changes, so endpoints address items by id instead of list position
+# (Player.index maps id -> position); containers and counters handlers read
+# are guaranteed to exist. Documents written before either get upgraded on
+# first load by model.migrate(), which runs only the steps newer than their
+# schema_version (see model.py).
+async def load_migrated(player_id: str) -> Tuple[Dict[str, Any], Optional[int]]:
+    """store.load() plus schema migrations and the ledger check, persisted before anyone sees them."""
+    for _ in range(OCC_RETRIES):
+        with span("store_load"):
+            data, version = await store.load(player_id)
+        p = DocPatch(data)
+        steps = model.migrate(p, seed_data)
+        rebuilt = open_ledger(p)
+        if not steps and not rebuilt:
+            return data, version
+        try:
+            ok, new_version = await persist(player_id, data, p.changes, version)
+        except WriteConflict:
+            continue  # another worker wrote (or migrated) first; use theirs
+        if ok:
+            log.info("Migrated %s to schema v%s (%s; %s ops)", player_id, model.SCHEMA_VERSION,
+                     ", ".join(steps) or "ledger", len(p.ops))
+            return data, new_version
+        break
+    raise RuntimeError("Failed to save migrated document")
+
+# === Delta writes ===
+# Handlers record their edits in a DocPatch; save_data() hands just those ops
+# to the backend: the supabase store replays them server-side in one RPC, the
+# row stores touch only the rows they name. The write stays the size of the
+# edit instead of the size of the whole (ever-growing) document.
+async def persist(player_id: str, data: Dict[str, Any], ops: Optional[List[Dict[str, Any]]] = None,
+                  expected: Optional[int] = None) -> Tuple[bool, Optional[int]]:
+    """Write through the backend. Returns (ok, new version); no cache side effects.
+
+    With `expected` the write only lands if the store is still at that
+    version, else WriteConflict.
+    """
+    with span("store_write"):
+        return await store.write(player_id, data, ops, expected)
+
+
+# === Write-behind queue (optional) ===
+# With WRITE_BEHIND_MS > 0, save_data() returns as soon as the edit is applied
+# to the cached document; a background task coalesces everything queued in
+# that window (or up to WRITE_BEHIND_MAX_OPS ops) into a single remote write.
+# Failed flushes are retried with backoff; shutdown flushes what is left. If
+# another worker wrote in between, the queued mutations are re-run on a fresh
+# copy of the row before writing.
+WRITE_BEHIND_MS = int(os.getenv("WRITE_BEHIND_MS", "0"))
+WRITE_BEHIND_MAX_OPS = int(os.getenv("WRITE_BEHIND_MAX_OPS", "64"))
+WRITE_BEHIND_DURABLE_TIMEOUT = float(os.getenv("WRITE_BEHIND_DURABLE_TIMEOUT", "15"))
+OCC_RETRIES = int(os.getenv("OCC_RETRIES", "5"))
+
+Mutation = Callable[[DocPatch], Any]
+
+def compact_ops(ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop `set` ops overwritten by a later `set` on the same path.
+
+    Only safe while no `remove` sits in between (it shifts list indices).
+    """
+    out: List[Optional[Dict[str, Any]]] = []
+    last_set: Dict[Tuple[str, ...], int] = {}
+    for op in ops:
+        if op["op"] == "remove":
+            last_set.clear()
+        elif op["op"] == "set":
+            key = tuple(op["path"])
+            prev = last_set.get(key)
+            if prev is not None:
+                out[prev] = None
+            last_set[key] = len(out)
+        out.append(op)
+    return [op for op in out if op is not None]
+
+class WriteBehind:
+    def __init__(self, player: "Player", window_ms: int, max_ops: int):
+        self.player = player
+        self.window = window_ms / 1000.0
+        self.max_ops = max_ops
+        self.doc: Optional[Dict[str, Any]] = None
+        self.ops: List[Dict[str, Any]] = []
+        self.replay: List[Mutation] = []  # queued mutations, for conflict re-apply
+        self.full = False      # next flush must write the whole document
+        self.base: Optional[int] = None  # row version the queued edits sit on
+        self.seq = 0           # edits enqueued
+        self.done_seq = 0      # edits known durable
+        self.flushes = 0
+        self.failures = 0
+        self.conflicts = 0
+        self.task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._deep: Optional[asyncio.Event] = None
+        self._durable: Optional[asyncio.Condition] = None
+        self._stopping = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    @property
+    def dirty(self) -> bool:
+        return self.done_seq < self.seq
+
+    def start(self) -> None:
+        if self.window <= 0 or self.enabled:
+            return
+        self._wake = asyncio.Event()
+        self._deep = asyncio.Event()
+        self._durable = asyncio.Condition()
+        self._stopping = False
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if not self.enabled:
+            return
+        self._stopping = True
+        self._wake.set()
+        self._deep.set()
+        await self.task
+        self.task = None
+
+    def cancel(self) -> None:
+        """Stop the flusher of an idle queue (nothing pending, nothing to flush)."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def enqueue(self, data: Dict[str, Any], ops: Optional[List[Dict[str, Any]]],
+                base: Optional[int], fn: Optional[Mutation] = None) -> int:
+        if not self.dirty:
+            self.base = base
+        if ops is None or (self.dirty and data is not self.doc):
+            # unknown diff or a replaced document (e.g. reset): resend it whole
+            self.full = True
+            self.ops = []
+        else:
+            self.ops.extend(ops)
+        if fn is not None:
+            self.replay.append(fn)
+        self.doc = data
+        self.seq += 1
+        self._wake.set()
+        if self.full or len(self.ops) >= self.max_ops:
+            self._deep.set()
+        return self.seq
+
+    async def wait(self, seq: int, timeout: float = WRITE_BEHIND_DURABLE_TIMEOUT) -> bool:
+        """Block until edit `seq` has reached Supabase (False on timeout)."""
+        async with self._durable:
+            try:
+                await asyncio.wait_for(self._durable.wait_for(lambda: self.done_seq >= seq), timeout)
+            except asyncio.TimeoutError:
+                return False
         return True
-    # Fallback to PATCH with filter (some PostgREST versions prefer PATCH)
-    patch_url = f"{supabase_base_rest()}/{TABLE_NAME}?id=eq.{SINGLETON_ID}"
-    resp2 = requests.patch(
-        patch_url,
-        headers={**supabase_headers(), "Prefer": "return=representation"},
-        json={"data": data},
-        timeout=8,
-    )
-    if resp2.status_code in (200, 204):
+
+    async def flush(self) -> bool:
+        if not self.dirty:
+            return True
+        doc, ops, full, seq, fns = self.doc, self.ops, self.full, self.seq, self.replay
+        self.ops, self.full, self.replay = [], False, []
+        try:
+            ok, version = await persist(self.player.id, doc, None if full else compact_ops(ops), self.base)
+        except WriteConflict:
+            self.conflicts += 1
+            ok, version = await self._rebase(fns)
+            doc = self.player.cache.data
+        if not ok:
+            # put the batch back in front of anything queued meanwhile
+            self.ops = ops + self.ops
+            self.full = self.full or full
+            self.replay = fns + self.replay
+            self.failures += 1
+            return False
+        self.flushes += 1
+        self.done_seq = seq
+        self.base = version
+        if not self.dirty and self.player.cache.data is doc:
+            self.player.cache.put(doc, version)
+        async with self._durable:
+            self._durable.notify_all()
         return True
-    log.error("Supabase save failed %s/%s: %s | %s", resp.status_code, resp2.status_code, resp.text, resp2.text)
-    return False
+
+    async def _rebase(self, fns: List[Mutation]) -> Tuple[bool, Optional[int]]:
+        # Another worker moved the row. Under the write lock (no new local
+        # edits), re-run every queued mutation on a fresh copy and write that.
+        async with self.player.lock:
+            fns = fns + self.replay
+            self.ops, self.full, self.replay = [], False, []
+            for _ in range(OCC_RETRIES):
+                fresh, version = await load_migrated(self.player.id)
+                p = DocPatch(fresh)
+                for fn in fns:
+                    fn(p)
+                try:
+                    ok, new_version = await persist(self.player.id, fresh, p.changes, version)
+                except WriteConflict:
+                    continue
+                if ok:
+                    self.player.cache.put(fresh, new_version)
+                    self.doc = fresh
+                    return True, new_version
+                break
+            self.replay = fns
+            return False, None
+
+    async def _run(self) -> None:
+        backoff = 0.5
+        while True:
+            await self._wake.wait()
+            if not self._stopping and not self._deep.is_set():
+                try:
+                    await asyncio.wait_for(self._deep.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            self._wake.clear()
+            self._deep.clear()
+            if await self.flush():
+                backoff = 0.5
+            else:
+                if self._stopping and backoff >= 2.0:
+                    log.error("Write-behind: giving up with %s unflushed edits for %s at shutdown",
+                              self.seq - self.done_seq, self.player.id)
+                    return
+                log.warning("Write-behind flush failed; retrying in %.1fs", backoff)
+                try:
+                    # stop() sets _deep, which cuts the backoff short
+                    await asyncio.wait_for(self._deep.wait(), backoff)
+                except asyncio.TimeoutError:
+                    pass
+                backoff = min(backoff * 2, 30.0)
+            if self._stopping and not self.dirty:
+                return
+            if self.dirty:
+                self._wake.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "window_ms": int(self.window * 1000),
+            "pending_edits": self.seq - self.done_seq,
+            "pending_ops": len(self.ops),
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "conflicts": self.conflicts,
+        }
+
+# === Change events ===
+# Successful mutations publish a small event (the handler's lean response) to
+# the player's EventHub, which /api/events streams to every connected tab as
+# server-sent events. Each subscriber has a bounded queue; one that falls
+# behind is disconnected and resumes with Last-Event-ID from the hub's replay
+# backlog, or gets a "resync" event when its position is no longer there
+# (e.g. after a restart: ids carry a per-process epoch). Events only reach
+# clients connected to the worker that made the change.
+EVENT_BACKLOG = max(1, int(os.getenv("EVENT_BACKLOG", "256")))
+EVENT_QUEUE_MAX = max(1, int(os.getenv("EVENT_QUEUE_MAX", "64")))
+EVENT_HEARTBEAT = float(os.getenv("EVENT_HEARTBEAT", "15"))
+EVENT_EPOCH = new_id()[:6]
+
+Event = Tuple[int, str, str]  # (seq, kind, JSON payload)
+
+class Subscriber:
+    def __init__(self, maxsize: int):
+        self.queue: "asyncio.Queue[Optional[Event]]" = asyncio.Queue(maxsize)
+
+    def end(self) -> None:
+        # drop whatever is queued; the stream stops at the None
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+class EventHub:
+    """One player's change events: replay backlog plus live subscriber queues."""
+
+    def __init__(self, backlog: int, queue_max: int):
+        self.seq = 0
+        self.backlog: "deque[Event]" = deque(maxlen=backlog)
+        self.queue_max = queue_max
+        self.subscribers: Set[Subscriber] = set()
+        self.published = 0
+        self.overflows = 0
+
+    def event_id(self, seq: Optional[int] = None) -> str:
+        return f"{EVENT_EPOCH}-{self.seq if seq is None else seq}"
+
+    def publish(self, kind: str, data: Any) -> None:
+        self.seq += 1
+        event = (self.seq, kind, codec.dumps_str(data))
+        self.backlog.append(event)
+        self.published += 1
+        for sub in list(self.subscribers):
+            try:
+                sub.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.subscribers.discard(sub)
+                sub.end()
+                self.overflows += 1
+
+    def subscribe(self) -> Subscriber:
+        sub = Subscriber(self.queue_max)
+        self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        self.subscribers.discard(sub)
+
+    def since(self, last_id: str) -> Optional[List[Event]]:
+        """Events after `last_id`, or None when they can't be replayed."""
+        epoch, _, n = last_id.rpartition("-")
+        if epoch != EVENT_EPOCH or not n.isdigit() or int(n) > self.seq:
+            return None
+        seq = int(n)
+        if seq < self.seq and (not self.backlog or self.backlog[0][0] > seq + 1):
+            return None  # fell out of the backlog
+        return [e for e in self.backlog if e[0] > seq]
+
+    def close(self) -> None:
+        for sub in list(self.subscribers):
+            sub.end()
+        self.subscribers.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": len(self.subscribers),
+            "published": self.published,
+            "overflows": self.overflows,
+            "last_id": self.event_id(),
+        }
+
+class Player:
+    """One resident player: cached document, write lock and write-behind queue."""
+
+    def __init__(self, player_id: str):
+        self.id = player_id
+        self.cache = DocCache(CACHE_TTL)
+        self.index = ItemIndex()
+        # serializes this player's local writers; other players don't wait
+        self.lock = asyncio.Lock()
+        self.writer = WriteBehind(self, WRITE_BEHIND_MS, WRITE_BEHIND_MAX_OPS)
+        self.writer.start()
+        self.compaction: Optional[asyncio.Task] = None
+        self.events = EventHub(EVENT_BACKLOG, EVENT_QUEUE_MAX)
+
+    @property
+    def idle(self) -> bool:
+        return (not self.lock.locked() and not self.writer.dirty and not self.compacting
+                and not self.events.subscribers)
+
+    @property
+    def compacting(self) -> bool:
+        return self.compaction is not None and not self.compaction.done()
+
+class PlayerRegistry:
+    """Resident players, least recently used first."""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, limit)
+        self.resident: "OrderedDict[str, Player]" = OrderedDict()
+        self.loaded = 0
+        self.evictions = 0
+
+    def get(self, player_id: str) -> Player:
+        player = self.resident.get(player_id)
+        if player is not None:
+            self.resident.move_to_end(player_id)
+            return player
+        player = self.resident[player_id] = Player(player_id)
+        self.loaded += 1
+        self._evict()
+        return player
+
+    def current(self) -> Player:
+        return self.get(current_player.get())
+
+    def _evict(self) -> None:
+        # Busy players (lock held, unflushed edits) are skipped and stay
+        # resident until a later pass; the newest entry is never a candidate.
+        for player_id in list(self.resident)[:-1]:
+            if len(self.resident) <= self.limit:
+                break
+            player = self.resident[player_id]
+            if not player.idle:
+                continue
+            del self.resident[player_id]
+            player.writer.cancel()
+            store.forget(player_id)
+            self.evictions += 1
+
+    async def close(self) -> None:
+        for p in self.resident.values():
+            p.events.close()
+        compactions = [p.compaction for p in self.resident.values() if p.compacting]
+        await asyncio.gather(*compactions, return_exceptions=True)
+        await asyncio.gather(*(p.writer.stop() for p in self.resident.values()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "resident": len(self.resident),
+            "limit": self.limit,
+            "loaded": self.loaded,
+            "evictions": self.evictions,
+        }
+
+players = PlayerRegistry(MAX_RESIDENT_PLAYERS)
+
+async def save_data(player: Player, data: Dict[str, Any], ops: Optional[List[Dict[str, Any]]] = None,
+                    durable: bool = False, fn: Optional[Mutation] = None) -> bool:
+    """Persist `data`, sending only `ops` when given (see DocPatch).
+
+    Write-through: on success the cache holds `data`; on failure it is
+    invalidated, since handlers mutate the cached document in place. In
+    write-behind mode the edit is queued instead and True returned at once,
+    unless `durable` asks to wait for the flush. Raises WriteConflict when the
+    row moved since it was read (see mutate()).
+    """
+    cache, writer = player.cache, player.writer
+    base = cache.version
+    if writer.enabled:
+        if ops is not None and not ops:
+            return True
+        cache.put(data, base)
+        seq = writer.enqueue(data, ops, base, fn)
+        return await writer.wait(seq) if durable else True
+    try:
+        ok, version = await persist(player.id, data, ops, base)
+    except WriteConflict:
+        cache.invalidate()
+        raise
+    if ok:
+        cache.put(data, version)
+    else:
+        cache.invalidate()
+    return ok
+
+# === Mutations ===
+# Every write goes through mutate(): load, apply `fn` to a DocPatch, save.
+# The player's lock serializes local writers; a WriteConflict (another
+# worker got there first) re-reads the row and re-applies `fn`, so `fn` must
+# be a pure function of the document it is given. Returning a Response from
+# `fn` aborts without saving. When `event` is given and the edit changed
+# something, the result is published to the player's connected clients.
+async def mutate(fn: Mutation, durable: bool = False, player: Optional[Player] = None,
+                 event: Optional[str] = None) -> Any:
+    player = player or players.current()
+    writer = player.writer
+    async with player.lock:
+        for _ in range(OCC_RETRIES):
+            d = await load_data(player)
+            p = DocPatch(d, player.index)
+            try:
+                with span("apply"):
+                    result = fn(p)
+            except Exception:
+                player.cache.invalidate()  # fn may have half-edited the cached copy
+                raise
+            if isinstance(result, Response):
+                return result
+            try:
+                if not await save_data(player, d, p.changes, fn=fn):
+                    return JSONResponse({"error": "Failed to save"}, status_code=500)
+            except WriteConflict:
+                log.info("version conflict for %s; re-applying", player.id)
+                continue
+            break
+        else:
+            return JSONResponse({"error": "Conflicting updates, please retry"}, status_code=409)
+        seq = writer.seq
+        if event and p.changes:
+            player.events.publish(event, result)  # under the lock, so in commit order
+    # wait outside the lock: a conflicting flush needs it to re-apply edits
+    if durable and writer.enabled and not await writer.wait(seq):
+        return JSONResponse({"error": "Save not confirmed yet"}, status_code=503)
+    schedule_compaction(player)
+    return result
+
+# === Diary archive ===
+# The hot document keeps the newest DIARY_HOT_MAX diary entries from the last
+# DIARY_HOT_DAYS days; older ones move to the storage archive (see
+# storage.py), which is indexed for /api/diary/search. Compaction copies the
+# entries to the archive first and only then removes them from the document,
+# so a crash in between leaves duplicates the archive ignores, never a loss.
+# It runs in the background after writes and loads that leave the diary over
+# budget, trimming to 3/4 of DIARY_HOT_MAX so it doesn't run on every add.
+DIARY_HOT_MAX = max(1, int(os.getenv("DIARY_HOT_MAX", "200")))
+DIARY_HOT_DAYS = float(os.getenv("DIARY_HOT_DAYS", "30"))
+
+def diary_overflow(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Diary entries due for the archive, oldest first."""
+    diary = d.get("diary") or []
+    cutoff = (local_now() - timedelta(days=DIARY_HOT_DAYS)).isoformat() if DIARY_HOT_DAYS > 0 else ""
+    old = 0
+    while old < len(diary) and isinstance(diary[old], dict) and str(diary[old].get("ts") or "") < cutoff:
+        old += 1
+    if len(diary) <= DIARY_HOT_MAX and not old:
+        return []
+    keep = DIARY_HOT_MAX * 3 // 4 if len(diary) > DIARY_HOT_MAX else len(diary)
+    n = max(old, len(diary) - keep)
+    return [e for e in diary[:n] if isinstance(e, dict) and e.get("id")]
+
+async def compact_diary(player: Player) -> int:
+    """Move overflowing diary entries to the archive; returns how many moved."""
+    entries = diary_overflow(await load_data(player))
+    if not entries or not await store.archive_diary(player.id, entries):
+        return 0
+    ids = {e["id"] for e in entries}
+
+    def apply(p: DocPatch):
+        diary = p.doc.get("diary") or []
+        for i in range(len(diary) - 1, -1, -1):  # back to front keeps positions valid
+            if isinstance(diary[i], dict) and diary[i].get("id") in ids:
+                p.remove(("diary", i))
+        return len(ids)
+    result = await mutate(apply, player=player)
+    if isinstance(result, Response):
+        return 0
+    player.events.publish("diary.archived", {"ids": sorted(ids)})
+    return result
+
+async def _run_compaction(player: Player) -> None:
+    try:
+        moved = await compact_diary(player)
+        if moved:
+            log.info("archived %d diary entries for %s", moved, player.id)
+    except Exception:
+        log.exception("diary compaction failed for %s", player.id)
+    try:
+        moved = await compact_ledger(player)
+        if moved:
+            log.info("checkpointed %d ledger entries for %s", moved, player.id)
+    except Exception:
+        log.exception("ledger compaction failed for %s", player.id)
+
+def schedule_compaction(player: Player) -> None:
+    """Start a background compaction if the diary or ledger is over budget (one at a time)."""
+    d = player.cache.data
+    if player.compacting or d is None or not (diary_overflow(d) or ledger_overflow(d)):
+        return
+    player.compaction = asyncio.get_running_loop().create_task(_run_compaction(player))
+
+# === Coin/XP ledger ===
+# Every change to coins, stat XP and tasks completed is an entry appended to
+# the document's "ledger" list: {"seq", "ts", "kind", "ref", "coins", "stat",
+# "xp", "tasks"}, the last four being deltas. shop.coins, stat_progress and
+# stats.tasks_completed stay as the materialized balance: post() appends an
+# entry and moves them by its deltas, so reads are still plain lookups and
+# a write is one small append. Levels follow from a stat's total XP, so
+# untoggling a task reverses exactly what its reward entry did, level-ups
+# included. "ledger_checkpoint" holds the balance as of its seq; once the
+# list passes LEDGER_HOT_MAX, the oldest entries are archived and folded
+# into it (same crash-safe order as the diary). Loading a document rebuilds
+# the balance from the checkpoint plus the hot entries and repairs drift.
+LEDGER_HOT_MAX = max(1, int(os.getenv("LEDGER_HOT_MAX", "500")))
+
+def xp_total(sp: Any) -> int:
+    """Total XP behind a {"level", "xp"} pair (level n needs 100 * n to pass)."""
+    sp = sp if isinstance(sp, dict) else {}
+    level = max(1, int(sp.get("level") or 1))
+    return 50 * level * (level - 1) + max(0, int(sp.get("xp") or 0))
+
+def xp_progress(total: int) -> Dict[str, int]:
+    level, xp = 1, max(0, total)
+    while xp >= 100 * level:
+        xp -= 100 * level
+        level += 1
+    return {"level": level, "xp": xp}
+
+def fold_ledger(checkpoint: Optional[Dict[str, Any]], entries: List[Any]) -> Dict[str, Any]:
+    """The balance after applying `entries` (those past the checkpoint) to it."""
+    cp = checkpoint or {}
+    out = {"seq": int(cp.get("seq") or 0), "coins": int(cp.get("coins") or 0),
+           "xp": dict(cp.get("xp") or {}), "tasks_completed": int(cp.get("tasks_completed") or 0)}
+    for e in entries:
+        if not isinstance(e, dict) or int(e.get("seq") or 0) <= out["seq"]:
+            continue
+        out["seq"] = int(e["seq"])
+        out["coins"] += int(e.get("coins") or 0)
+        out["tasks_completed"] += int(e.get("tasks") or 0)
+        if e.get("stat") and e.get("xp"):
+            out["xp"][e["stat"]] = out["xp"].get(e["stat"], 0) + int(e["xp"])
+    return out
+
+def ledger_seq(d: Dict[str, Any]) -> int:
+    ledger = d.get("ledger") or []
+    if ledger and isinstance(ledger[-1], dict):
+        return int(ledger[-1].get("seq") or 0)
+    return int((d.get("ledger_checkpoint") or {}).get("seq") or 0)
+
+def post(p: DocPatch, kind: str, stamp: str, ref: Any = None, coins: int = 0,
+         stat: Optional[str] = None, xp: int = 0, tasks: int = 0, booked: Optional[str] = None) -> Dict[str, Any]:
+    """Append a ledger entry and move the materialized balance by it.
+
+    The daily rollups count it on the day of `booked` (default `stamp`).
+    """
+    entry = {"seq": ledger_seq(p.doc) + 1, "ts": stamp, "kind": kind,
+             "ref": str(ref) if ref is not None else None,
+             "coins": coins, "stat": stat, "xp": xp, "tasks": tasks}
+    p.append(("ledger",), entry)
+    if coins:
+        p.set(("shop", "coins"), int(p.get(("shop", "coins"), 0)) + coins)
+    if stat and (xp or p.get(("stat_progress", stat)) is None):
+        p.set(("stat_progress", stat), xp_progress(xp_total(p.get(("stat_progress", stat))) + xp))
+    if tasks:
+        p.set(("stats", "tasks_completed"), int(p.get(("stats", "tasks_completed"), 0)) + tasks)
+    if kind == "shop.spend":
+        rollup(p, booked or stamp, spent=-coins)
+    else:
+        rollup(p, booked or stamp, earned=coins, done={stat: tasks} if stat and tasks else None,
+               xp={stat: xp} if stat and xp else None)
+    return entry
+
+def last_reward(d: Dict[str, Any], task_id: Any) -> Optional[Dict[str, Any]]:
+    """The hot reward entry of a task that is currently done, if still in the list."""
+    ref = str(task_id)
+    for e in reversed(d.get("ledger") or []):
+        if isinstance(e, dict) and e.get("ref") == ref:
+            return e if e.get("kind") == "task.reward" else None
+    return None
+
+def open_ledger(p: DocPatch) -> bool:
+    """Checkpoint pre-ledger documents at their balance; rebuild drifted ones.
+
+    Returns True if anything changed.
+    """
+    d = p.doc
+    stats = d["stat_progress"]
+    if not isinstance(d.get("ledger_checkpoint"), dict):
+        # entries already in the list (posted after a reset) count as folded
+        p.set(("ledger_checkpoint",), {
+            "seq": ledger_seq(d),
+            "coins": d["shop"]["coins"],
+            "xp": {name: xp_total(sp) for name, sp in stats.items()},
+            "tasks_completed": d["stats"]["tasks_completed"],
+        })
+        return True
+    bal = fold_ledger(d["ledger_checkpoint"], d.get("ledger") or [])
+    changed = False
+    if d["shop"]["coins"] != bal["coins"]:
+        p.set(("shop", "coins"), bal["coins"])
+        changed = True
+    if d["stats"]["tasks_completed"] != bal["tasks_completed"]:
+        p.set(("stats", "tasks_completed"), bal["tasks_completed"])
+        changed = True
+    for name, total in bal["xp"].items():
+        if xp_total(stats.get(name)) != total:
+            p.set(("stat_progress", name), xp_progress(total))
+            changed = True
+    if changed:
+        log.warning("Rebuilt the coin/XP balance from the ledger (seq %s)", bal["seq"])
+    return changed
+
+def ledger_overflow(d: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Ledger entries due for the archive, oldest first."""
+    ledger = d.get("ledger") or []
+    if len(ledger) <= LEDGER_HOT_MAX:
+        return []
+    return [e for e in ledger[: len(ledger) - LEDGER_HOT_MAX * 3 // 4] if isinstance(e, dict)]
+
+async def compact_ledger(player: Player) -> int:
+    """Archive the oldest ledger entries and fold them into the checkpoint."""
+    entries = ledger_overflow(await load_data(player))
+    if not entries or not await store.archive_ledger(player.id, entries):
+        return 0
+    last = int(entries[-1].get("seq") or 0)
+
+    def apply(p: DocPatch):
+        ledger = p.doc.get("ledger") or []
+        n = 0
+        while n < len(ledger) and isinstance(ledger[n], dict) and int(ledger[n].get("seq") or 0) <= last:
+            n += 1
+        if not n:
+            return 0
+        p.set(("ledger_checkpoint",), fold_ledger(p.doc.get("ledger_checkpoint"), ledger[:n]))
+        for i in range(n - 1, -1, -1):  # back to front keeps positions valid
+            p.remove(("ledger", i))
+        return n
+    result = await mutate(apply, player=player)
+    return 0 if isinstance(result, Response) else result
+
+# === Daily rollups ===
+# rollup() adds an event's counts to the document's "rollups" buckets for its
+# day, ISO week and month at once: tasks done/failed and XP per stat, coins
+# earned and spent, punishments drawn, missed days, logins and the highest
+# streak. post() (task rewards, shop spending), the ping/midnight roll and
+# the deadline scheduler feed it, so /api/analytics only reads buckets: a
+# range costs one lookup per period, plus day lookups for partial periods at
+# its edges. Day buckets older than ROLLUP_DAYS are dropped; week and month
+# buckets are kept.
+ROLLUP_DAYS = int(os.getenv("ROLLUP_DAYS", "400"))
+GRANULARITIES = ("day", "week", "month")
+ANALYTICS_MAX_BUCKETS = 2000
+
+def period_start(day: date, granularity: str) -> date:
+    if granularity == "week":
+        return day - timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+def next_period(start: date, granularity: str) -> date:
+    if granularity == "week":
+        return start + timedelta(days=7)
+    if granularity == "month":
+        return date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return start + timedelta(days=1)
+
+def period_key(day: date, granularity: str) -> str:
+    if granularity == "week":
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    if granularity == "month":
+        return f"{day.year}-{day.month:02d}"
+    return day.isoformat()
+
+def merge_bucket(into: Dict[str, Any], counts: Dict[str, Any]) -> Dict[str, Any]:
+    """Add `counts` into `into`; per-stat counts are dicts, the streak is a max."""
+    for k, v in counts.items():
+        if not v:
+            continue
+        if isinstance(v, dict):
+            sub = into[k] = dict(into.get(k) or {})
+            for name, n in v.items():
+                sub[name] = sub.get(name, 0) + n
+        elif k == "streak":
+            into[k] = max(into.get(k, 0), v)
+        else:
+            into[k] = into.get(k, 0) + v
+    return into
+
+def rollup(p: DocPatch, stamp: Optional[str], **counts: Any) -> None:
+    """Count an event in the day, week and month buckets of `stamp`."""
+    day = login_date(stamp)
+    if day is None or not any(counts.values()):
+        return
+    days = p.get(("rollups", "day")) or {}
+    fresh_day = day.isoformat() not in days
+    for granularity in GRANULARITIES:
+        path = ("rollups", granularity, period_key(day, granularity))
+        p.set(path, merge_bucket(dict(p.get(path) or {}), counts))
+    if fresh_day and ROLLUP_DAYS > 0:
+        cutoff = (day - timedelta(days=ROLLUP_DAYS)).isoformat()
+        for key in [k for k in days if k < cutoff]:
+            p.remove(("rollups", "day", key))
+
+def bucket_summary(bucket: Dict[str, Any]) -> Dict[str, Any]:
+    done, failed = bucket.get("done") or {}, bucket.get("failed") or {}
+    rates = {}
+    for stat in set(done) | set(failed):
+        settled = max(0, done.get(stat, 0)) + failed.get(stat, 0)
+        if settled:
+            rates[stat] = round(max(0, done.get(stat, 0)) / settled, 4)
+    return {
+        "done": done,
+        "failed": failed,
+        "xp": bucket.get("xp") or {},
+        "completion_rate": rates,
+        "earned": bucket.get("earned", 0),
+        "spent": bucket.get("spent", 0),
+        "punishments": bucket.get("punishments", 0),
+        "missed": bucket.get("missed", 0),
+        "logins": bucket.get("logins", 0),
+        "streak": bucket.get("streak", 0),
+    }
+
+# === Deadline scheduler ===
+# Overdue tasks and the daily streak roll are settled here, on the server,
+# whether or not a client is connected. Open tasks with a deadline sit in a
+# min-heap keyed on due time; the loop sleeps until the head is due (or the
+# next midnight in APP_TIMEZONE), marks due tasks failed and draws a
+# punishment for each. Handlers update the heap per task as they add,
+# toggle, delete or extend tasks. Superseded heap entries are skipped when
+# popped (`tracked` holds each task's live due time) and swept out once they
+# make up half the heap. A player's tasks are re-scanned whenever their
+# document is loaded from the store (at startup for store.player_ids(),
+# then on every cache miss) or replaced by a reset or an import, so changes
+# made by another worker are picked up too. Failing a task re-checks
+# it in the document, so several workers running schedulers is harmless.
+SCHEDULER = os.getenv("SCHEDULER", "1") != "0"
+SCHEDULER_RETRY = 60.0  # seconds before retrying a failed write
+
+def deadline_ts(deadline: Any) -> Optional[float]:
+    """Epoch seconds of a task deadline; naive values are APP_TIMEZONE wall time."""
+    if not deadline:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(deadline))
+    except ValueError:
+        return None
+    if dt.tzinfo is None and APP_TZ:
+        dt = dt.replace(tzinfo=APP_TZ)
+    return dt.timestamp()
+
+def next_midnight() -> float:
+    tomorrow = local_now().date() + timedelta(days=1)
+    return datetime.combine(tomorrow, datetime.min.time(), tzinfo=APP_TZ).timestamp()
+
+def login_date(stamp: Any) -> Optional[date]:
+    try:
+        return date.fromisoformat(str(stamp).split("T")[0]) if stamp else None
+    except ValueError:
+        return None
+
+def draw_punishment(p: DocPatch, pick: float, stamp: str, **extra: Any) -> Optional[Dict[str, Any]]:
+    """Append a punishment drawn from the pool (by `pick` in [0, 1)) to ongoing_punishments."""
+    pool = p.doc.get("punishments") or []
+    if not pool:
+        return None
+    choice = pool[int(pick * len(pool))]
+    if isinstance(choice, dict):
+        choice = choice.get("text")
+    rollup(p, stamp, punishments=1)
+    return p.append(("ongoing_punishments",), {"text": choice, "ts": stamp, **extra})
+
+def roll_day(p: DocPatch, today: date, pick: float, stamp: str) -> Optional[str]:
+    """Settle days missed before `today`: streak to 0 and one punishment per gap.
+
+    Runs at midnight and from /api/ping; `last_rolled` makes a second call
+    on the same day a no-op, and a gap (last login more than a day ago) is
+    punished only by the first roll that sees it.
+    """
+    d = p.doc
+    if d.get("last_rolled") == today.isoformat():
+        return None
+    lastd = login_date(d.get("last_login"))
+    triggered = None
+    if lastd is not None and (today - lastd).days > 1:
+        rolled = login_date(d.get("last_rolled"))
+        if rolled is None or rolled < lastd + timedelta(days=2):
+            if d.get("streak"):
+                p.set(("streak",), 0)
+            rollup(p, stamp, missed=1)
+            fired = draw_punishment(p, pick, stamp)
+            triggered = fired["text"] if fired else None
+    p.set(("last_rolled",), today.isoformat())
+    return triggered
+
+async def fail_overdue(player: Player, due: Dict[str, float]) -> Any:
+    """Mark the tasks in `due` (id -> deadline_ts) failed, one punishment each."""
+    stamp = now_iso()
+    picks = {task_id: random.random() for task_id in due}
+
+    def apply(p: DocPatch):
+        failed, fired = [], []
+        for task_id, when in due.items():
+            i = p.find("tasks", task_id)
+            task = p.doc["tasks"][i] if i is not None else None
+            # the document decides: done, already failed or moved on since
+            # (compared as times: a store may hand the deadline back reformatted)
+            if not task or task.get("done") or task.get("failed") or deadline_ts(task.get("deadline")) != when:
+                continue
+            p.set(("tasks", i, "failed"), True)
+            rollup(p, stamp, failed={task.get("stat") or "discipline": 1})
+            failed.append(task)
+            punishment = draw_punishment(p, picks[task_id], stamp, task=task_id)
+            if punishment:
+                fired.append(punishment)
+        return {"tasks": failed, "punishments": fired}
+    return await mutate(apply, player=player, event="tasks.failed")
+
+async def roll_streak(player: Player, today: date) -> Any:
+    pick = random.random()
+    stamp = now_iso()
+
+    def apply(p: DocPatch):
+        triggered = roll_day(p, today, pick, stamp)
+        return {"streak": p.doc.get("streak", 0), "punishment": triggered,
+                "ongoing_punishments": p.doc.get("ongoing_punishments", [])}
+    return await mutate(apply, player=player, event="streak.updated")
+
+class DeadlineScheduler:
+    """Min-heap of (when, player, task id, due) over open tasks with deadlines."""
+
+    def __init__(self):
+        self.heap: List[Tuple[float, str, str, float]] = []
+        self.tracked: Dict[str, Dict[str, float]] = {}  # player -> task id -> deadline_ts
+        self.stale = 0
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.failed = 0
+        self.rolls = 0
+
+    def register(self, player_id: str, doc: Dict[str, Any]) -> None:
+        """(Re)scan a player's tasks; called whenever their document is loaded or replaced.
+
+        The document may have changed elsewhere since the last scan (another
+        worker, an import, a migration), so it replaces what was tracked;
+        tasks whose due time is unchanged keep their heap entry.
+        """
+        old = self.tracked.pop(player_id, None) or {}
+        tasks = self.tracked[player_id] = {}
+        for task in doc.get("tasks") or []:
+            if not isinstance(task, dict):
+                continue
+            task_id = task.get("id")
+            due = deadline_ts(task.get("deadline"))
+            if task_id and due is not None and not task.get("done") and not task.get("failed") \
+                    and old.get(task_id) == due:
+                tasks[task_id] = old.pop(task_id)
+            else:
+                self.track(player_id, task)
+        self.stale += len(old)
+        self._sweep()
+
+    def track(self, player_id: str, task: Dict[str, Any]) -> None:
+        """(Re)schedule one task after it changed."""
+        tasks = self.tracked.get(player_id)
+        task_id = task.get("id")
+        if tasks is None or not task_id:
+            return
+        due = deadline_ts(task.get("deadline"))
+        if due is None or task.get("done") or task.get("failed"):
+            self.untrack(player_id, task_id)
+            return
+        if tasks.get(task_id) == due:
+            return
+        if task_id in tasks:
+            self.stale += 1
+        tasks[task_id] = due
+        heapq.heappush(self.heap, (due, player_id, task_id, due))
+        if self.heap[0][0] >= due:
+            self.wakeup.set()  # new head: the loop is sleeping until a later time
+        self._sweep()
+
+    def untrack(self, player_id: str, task_id: Any) -> None:
+        if (self.tracked.get(player_id) or {}).pop(task_id, None) is not None:
+            self.stale += 1
+            self._sweep()
+
+    def _live(self, entry: Tuple[float, str, str, float]) -> bool:
+        return (self.tracked.get(entry[1]) or {}).get(entry[2]) == entry[3]
+
+    def _sweep(self) -> None:
+        if self.stale > 64 and self.stale * 2 > len(self.heap):
+            self.heap = [e for e in self.heap if self._live(e)]
+            heapq.heapify(self.heap)
+            self.stale = 0
+
+    def start(self) -> None:
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self) -> None:
+        try:
+            for player_id in await store.player_ids():
+                await load_data(players.get(player_id))  # registers via load_data
+        except Exception:
+            log.exception("scheduler: loading players failed")
+        midnight = next_midnight()
+        log.info("Deadline scheduler on (%s tasks, tz=%s)", sum(map(len, self.tracked.values())), APP_TZ or "local")
+        while True:
+            now = time.time()
+            try:
+                if now >= midnight:
+                    midnight = next_midnight()
+                    await self.roll(local_now().date())
+                    continue
+                if self.heap and self.heap[0][0] <= now:
+                    await self.fire(now)
+                    continue
+            except Exception:
+                log.exception("scheduler pass failed")
+            self.wakeup.clear()
+            wake = min(self.heap[0][0] if self.heap else midnight, midnight)
+            try:
+                # capped, so a changed wall clock is noticed within the hour
+                await asyncio.wait_for(self.wakeup.wait(), max(0.0, min(wake - now, 3600.0)))
+            except asyncio.TimeoutError:
+                pass
+
+    async def fire(self, now: float) -> None:
+        due: Dict[str, Dict[str, float]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self._live(entry):
+                self.stale = max(0, self.stale - 1)
+                continue
+            due.setdefault(entry[1], {})[entry[2]] = entry[3]
+        for player_id, tasks in due.items():
+            try:
+                result = await fail_overdue(players.get(player_id), tasks)
+            except Exception:
+                log.exception("failing overdue tasks of %s", player_id)
+                result = None
+            if not isinstance(result, dict):
+                for task_id, when in tasks.items():
+                    heapq.heappush(self.heap, (now + SCHEDULER_RETRY, player_id, task_id, when))
+                continue
+            self.failed += len(result["tasks"])
+            live = self.tracked.get(player_id) or {}
+            for task_id, when in tasks.items():
+                if live.get(task_id) == when:
+                    del live[task_id]
+
+    async def roll(self, today: date) -> None:
+        for player_id in list(self.tracked):
+            try:
+                await roll_streak(players.get(player_id), today)
+            except Exception:
+                log.exception("streak roll failed for %s", player_id)
+        self.rolls += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "players": len(self.tracked),
+            "tracked": sum(map(len, self.tracked.values())),
+            "heap": len(self.heap),
+            "next_due": datetime.fromtimestamp(self.heap[0][0], APP_TZ).replace(tzinfo=None).isoformat()
+                        if self.heap else None,
+            "failed": self.failed,
+            "rolls": self.rolls,
+        }
+
+deadlines = DeadlineScheduler()
+
+def task_changed(result: Any) -> Any:
+    """Reschedule the task in a handler's result; returns the result."""
+    if isinstance(result, dict) and isinstance(result.get("task"), dict):
+        deadlines.track(current_player.get(), result["task"])
+    return result
+
+def task_deleted(result: Any) -> Any:
+    if isinstance(result, dict) and result.get("ok") and result.get("id"):
+        deadlines.untrack(current_player.get(), result["id"])
+    return result
 
 # === FastAPI app & static ===
-app = FastAPI()
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await store.start()
+    if WRITE_BEHIND_MS > 0:
+        log.info("Write-behind on (window=%sms, max_ops=%s)", WRITE_BEHIND_MS, WRITE_BEHIND_MAX_OPS)
+    if SCHEDULER:
+        deadlines.start()
+    try:
+        yield
+    finally:
+        await deadlines.stop()
+        await players.close()
+        await store.close()
+
+class TimedJSONResponse(JSONResponse):
+    """Default response class: one timed encode through codec (orjson when installed)."""
+
+    def render(self, content: Any) -> bytes:
+        with span("json_encode"):
+            return codec.dumps(content)
+
+class FastRoute(APIRoute):
+    """Wraps what a handler returns in TimedJSONResponse itself.
+
+    FastAPI would first run it through jsonable_encoder, a full copy of the
+    (possibly very large) document before it is encoded; handlers only
+    return JSON-ready data, so that pass is skipped.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any):
+        if asyncio.iscoroutinefunction(endpoint):
+            handler = endpoint
+
+            @functools.wraps(handler)
+            async def endpoint(*args: Any, **kw: Any) -> Any:
+                result = await handler(*args, **kw)
+                return result if isinstance(result, Response) else TimedJSONResponse(result)
+        super().__init__(path, endpoint, **kwargs)
+
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
+app.router.route_class = FastRoute
+
+@app.exception_handler(storage.StorageUnavailable)
+async def storage_unavailable(request: Request, exc: storage.StorageUnavailable):
+    # the store is down and this player has no local copy yet (see storage.JournaledStorage)
+    log.warning("Storage unavailable: %s", exc)
+    return JSONResponse({"error": "Storage unavailable, please retry"}, status_code=503, headers={"Retry-After": "5"})
+static_files = assets.AssetFiles(STATIC_DIR, build=STATIC_BUILD)
+app.mount("/static", static_files, name="static")
 
 @app.get("/sw.js")
-async def sw():
+async def sw(request: Request):
+    built = static_files.page("sw.js", request.headers)
+    if built is not None:
+        return built
     fp = os.path.join(STATIC_DIR, "sw.js")
     if os.path.exists(fp):
-        return FileResponse(fp, media_type="application/javascript")
+        return FileResponse(fp, media_type="application/javascript", headers={"Cache-Control": assets.REVALIDATE})
     return JSONResponse({"detail": "sw not found"}, status_code=404)
 
 @app.get("/")
-async def root():
+async def root(request: Request):
+    built = static_files.page("index.html", request.headers)
+    if built is not None:
+        return built
     fp = os.path.join(STATIC_DIR, "index.html")
     if os.path.exists(fp):
-        return FileResponse(fp)
+        return FileResponse(fp, headers={"Cache-Control": assets.REVALIDATE})
     return JSONResponse({"detail": "index not found"}, status_code=404)
 
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
+# === Request timing ===
+# Every request gets a Server-Timing header (total plus the spans it ran
+# through: store_load, supabase_get, json_encode, apply, store_write, ...)
+# and lands in the /metrics histograms under its endpoint's name.
+# SERVER_TIMING=0 keeps the header off responses; /metrics is unaffected.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") != "0"
+
+def route_label(scope: Dict[str, Any]) -> str:
+    """Bounded metrics label: the matched endpoint, not the raw path."""
+    # a mount's "endpoint" is the mounted app (the /static files), not a function
+    name = getattr(scope.get("endpoint"), "__name__", None)
+    if name:
+        return name
+    return "static" if scope.get("path", "").startswith("/static/") else "unmatched"
+
 @app.middleware("http")
 async def add_version_header(request: Request, call_next):
+    spans = metrics.begin_request()
+    start = time.perf_counter()
     resp = await call_next(request)
+    elapsed = time.perf_counter() - start
+    route = route_label(request.scope)
+    metrics.REQUEST_SECONDS.observe(elapsed, request.method, route, str(resp.status_code))
+    size = resp.headers.get("content-length")
+    if size and size.isdigit():
+        metrics.RESPONSE_BYTES.observe(int(size), route)
     try:
         resp.headers["X-App-Version"] = "v11-supabase"
-        if request.url.path in ["/", "/index.html", "/static/index.html"]:
-            resp.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+        if SERVER_TIMING:
+            resp.headers["Server-Timing"] = metrics.server_timing(spans, elapsed)
     except Exception:
         pass
     return resp
 
+@app.middleware("http")
+async def resolve_player(request: Request, call_next):
+    # Registered last, so it runs first: strips /p/<id> before routing.
+    player_id = None
+    from_path = False
+    m = PLAYER_PATH_RE.match(request.scope["path"])
+    if m:
+        player_id, rest = m.group(1), m.group(2) or "/"
+        request.scope["path"] = rest
+        request.scope["raw_path"] = rest.encode()
+        from_path = True
+    else:
+        player_id = request.headers.get(PLAYER_HEADER) or request.cookies.get(PLAYER_COOKIE)
+    player_id = player_id or DEFAULT_PLAYER_ID
+    if not PLAYER_ID_RE.match(player_id):
+        return JSONResponse({"error": "Invalid player id"}, status_code=400)
+    current_player.set(player_id)
+    resp = await call_next(request)
+    if from_path and request.cookies.get(PLAYER_COOKIE) != player_id:
+        # later /api calls from the page carry the player without the prefix
+        resp.set_cookie(PLAYER_COOKIE, player_id, max_age=365 * 24 * 3600, samesite="lax")
+    return resp
+
 # === API endpoints ===
 
+# Responses stay small for long-lived players: /api/data?fields= returns only
+# the named (dotted) keys, tasks and diary are paged newest-first through
+# /api/tasks and /api/diary, and mutations answer with the changed item plus
+# the counters it moved rather than the whole document.
+PAGE_LIMIT = 50
+PAGE_MAX = 200
+
+def select_fields(d: Dict[str, Any], fields: str) -> Dict[str, Any]:
+    """Copy of `d` limited to comma-separated (dotted) keys; unknown keys are skipped."""
+    out: Dict[str, Any] = {}
+    for name in fields.split(","):
+        path = [k for k in name.strip().split(".") if k]
+        src: Any = d
+        dst = out
+        for i, key in enumerate(path):
+            if not isinstance(src, dict) or key not in src:
+                break
+            if i == len(path) - 1:
+                dst[key] = src[key]
+                break
+            if dst.get(key) is src[key]:
+                break  # the whole parent is already selected
+            if not isinstance(dst.get(key), dict):
+                dst[key] = {}
+            src, dst = src[key], dst[key]
+    return out
+
+def page(player: "Player", d: Dict[str, Any], key: str, limit: int, after: Optional[str]) -> Any:
+    """Newest-first slice of list `key` ending before item `after` (an id)."""
+    items = d.get(key) or []
+    end = len(items)
+    if after:
+        player.index.bind(d)
+        end = player.index.position(key, after)
+        if end is None:
+            return JSONResponse({"error": "Unknown cursor"}, status_code=400)
+    start = max(0, end - max(1, min(limit, PAGE_MAX)))
+    chunk = items[start:end][::-1]
+    nxt = chunk[-1].get("id") if start > 0 and chunk and isinstance(chunk[-1], dict) else None
+    return {key: chunk, "next": nxt, "total": len(items)}
+
+def counters(d: Dict[str, Any], stat: Optional[str] = None) -> Dict[str, Any]:
+    """The numbers a mutation may have moved (coins, tasks completed, one stat's level/XP)."""
+    out: Dict[str, Any] = {
+        "coins": d["shop"]["coins"],
+        "tasks_completed": d["stats"]["tasks_completed"],
+    }
+    if stat:
+        out["stat_progress"] = {stat: d["stat_progress"].get(stat)}
+    return out
+
+def revalidated_json(request: Request, content: Any) -> Response:
+    """JSON with an ETag of its body; a client that already has it gets an empty 304."""
+    with span("json_encode"):
+        body = codec.dumps(content)
+    etag = f'"{assets.digest(body)}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": f"Cookie, {PLAYER_HEADER}"}
+    if assets.etag_matches(request.headers, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
 @app.get("/api/data")
-async def api_get_data():
-    d = load_data()
-    return {"data": d, "missed_day": False, "punishment": None}
+async def api_get_data(request: Request, fields: Optional[str] = None):
+    d = await load_data()
+    if fields:
+        d = select_fields(d, fields)
+    return revalidated_json(request, {"data": d, "missed_day": False, "punishment": None})
 
-@app.post("/api/tasks/add")
-async def api_add_task(req: Request):
-    body = await req.json()
+@app.get("/api/tasks")
+async def api_get_tasks(limit: int = PAGE_LIMIT, after: Optional[str] = None):
+    player = players.current()
+    return page(player, await load_data(player), "tasks", limit, after)
+
+def new_task(body: Dict[str, Any]) -> Mutation:
     task = (body.get("task") or "").strip()
     deadline = (body.get("deadline") or "").strip() or None
     coins = int(body.get("coins") or 5)
     xp = int(body.get("xp") or 0)
     stat = (body.get("stat") or "discipline").strip().lower()
+    created = now_iso()
+    task_id = new_id()
 
-    d = load_data()
-    if task:
-        d.setdefault("tasks", []).append({
-            "task": task,
-            "deadline": deadline,
-            "done": False,
-            "created": now_iso(),
-            "coins": coins,
-            "xp": xp,
-            "stat": stat,
-            "failed": False
-        })
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"tasks": d.get("tasks", [])}
+    def apply(p: DocPatch):
+        if task:
+            p.append(("tasks",), {
+                "id": task_id,
+                "task": task,
+                "deadline": deadline,
+                "done": False,
+                "created": created,
+                "coins": coins,
+                "xp": xp,
+                "stat": stat,
+                "failed": False
+            })
+            return {"task": p.doc["tasks"][-1]}
+        return {"task": None}
+    return apply
+
+@app.post("/api/tasks/add")
+async def api_add_task(req: Request):
+    return task_changed(await mutate(new_task(await req.json()), event="task.added"))
+
+# Items are addressed by id (/api/<list>/{item_id}/<action>). The older
+# /api/<list>/<action>/{idx} routes take a list position and stay as a shim
+# for clients that haven't picked up ids yet.
+def at_index(p: DocPatch, key: str, idx: int) -> Optional[int]:
+    return idx if 0 <= idx < len(p.doc.get(key) or []) else None
+
+def toggle_task(p: DocPatch, i: int, stamp: str) -> Dict[str, Any]:
+    d = p.doc
+    task = d["tasks"][i]
+    done = p.set(("tasks", i, "done"), not task.get("done", False))
+    if done:
+        stat = task.get("stat", "discipline")
+        post(p, "task.reward", stamp, task.get("id"), coins=int(task.get("coins", 5) or 0), stat=stat,
+             xp=int(task.get("xp", 0) or 0), tasks=1)
+        return {"ok": True, "task": task, **counters(d, stat)}
+    # undo exactly what the reward did; rewards from before the ledger (or
+    # already archived) fall back to the task's own numbers
+    reward = last_reward(d, task.get("id")) or {
+        "coins": int(task.get("coins", 5) or 0), "stat": task.get("stat", "discipline"),
+        "xp": int(task.get("xp", 0) or 0), "tasks": 1}
+    stat = reward.get("stat") or task.get("stat", "discipline")
+    coins = int(p.get(("shop", "coins"), 0))
+    total = xp_total(p.get(("stat_progress", stat)))
+    completed = int(p.get(("stats", "tasks_completed"), 0))
+    post(p, "task.revert", stamp, task.get("id"), coins=-min(int(reward.get("coins") or 0), coins), stat=stat,
+         xp=-min(int(reward.get("xp") or 0), total), tasks=-min(int(reward.get("tasks") or 0), completed),
+         booked=reward.get("ts"))  # off the day the reward was counted on
+    return {"ok": True, "task": task, **counters(d, stat)}
 
 @app.post("/api/tasks/toggle/{task_id}")
 async def api_toggle_task(task_id: int):
-    d = load_data()
-    tasks = d.setdefault("tasks", [])
-    if task_id < 0 or task_id >= len(tasks):
-        return JSONResponse({"error": "Invalid task index"}, status_code=400)
-    task = tasks[task_id]
-    before = task.get("done", False)
-    task["done"] = not before
-
-    if task["done"]:
-        d.setdefault("shop", {}).setdefault("coins", 0)
-        d["shop"]["coins"] += int(task.get("coins", 5) or 0)
-        # Award XP
-        stat = task.get("stat", "discipline")
-        if "stat_progress" not in d:
-            d["stat_progress"] = {}
-        if stat not in d["stat_progress"]:
-            d["stat_progress"][stat] = {"level": 1, "xp": 0}
-        sp = d["stat_progress"][stat]
-        sp["xp"] += int(task.get("xp", 0) or 0)
-        while sp["xp"] >= 100 * sp.get("level", 1):
-            sp["xp"] -= 100 * sp.get("level", 1)
-            sp["level"] += 1
-        d.setdefault("stats", {})["tasks_completed"] = d.get("stats", {}).get("tasks_completed", 0) + 1
-    else:
-        d.setdefault("shop", {}).setdefault("coins", 0)
-        d["shop"]["coins"] = max(0, d["shop"]["coins"] - int(task.get("coins", 5) or 0))
-        stat = task.get("stat", "discipline")
-        if "stat_progress" not in d:
-            d["stat_progress"] = {}
-        if stat not in d["stat_progress"]:
-            d["stat_progress"][stat] = {"level": 1, "xp": 0}
-        sp = d["stat_progress"][stat]
-        sp["xp"] = max(0, sp["xp"] - int(task.get("xp", 0) or 0))
-        d.setdefault("stats", {})["tasks_completed"] = max(0, d.get("stats", {}).get("tasks_completed", 0) - 1)
-
-    if not save_data(d):
-        return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"ok": True, "data": d}
+    stamp = now_iso()
+
+    def apply(p: DocPatch):
+        i = at_index(p, "tasks", task_id)
+        if i is None:
+            return JSONResponse({"error": "Invalid task index"}, status_code=400)
+        return toggle_task(p, i, stamp)
+    return task_changed(await mutate(apply, event="task.toggled"))
+
+def toggle_task_id(item_id: str) -> Mutation:
+    stamp = now_iso()
+
+    def apply(p: DocPatch):
+        i = p.find("tasks", item_id)
+        if i is None:
+            return JSONResponse({"error": "Task not found"}, status_code=404)
+        return toggle_task(p, i, stamp)
+    return apply
+
+@app.post("/api/tasks/{item_id}/toggle")
+async def api_toggle_task_by_id(item_id: str):
+    return task_changed(await mutate(toggle_task_id(item_id), event="task.toggled"))
 
 @app.post("/api/tasks/delete/{idx}")
 async def api_delete_task(idx: int):
-    d = load_data()
-    if 0 <= idx < len(d.get("tasks", [])):
-        d["tasks"].pop(idx)
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"tasks": d.get("tasks", [])}
+    def apply(p: DocPatch):
+        i = at_index(p, "tasks", idx)
+        if i is None:
+            return {"ok": False, "id": None}
+        return {"ok": True, "id": p.remove(("tasks", i)).get("id")}
+    return task_deleted(await mutate(apply, event="task.deleted"))
+
+def delete_task_id(item_id: str) -> Mutation:
+    def apply(p: DocPatch):
+        i = p.find("tasks", item_id)
+        if i is None:
+            return JSONResponse({"error": "Task not found"}, status_code=404)
+        p.remove(("tasks", i))
+        return {"ok": True, "id": item_id}
+    return apply
+
+@app.post("/api/tasks/{item_id}/delete")
+async def api_delete_task_by_id(item_id: str):
+    return task_deleted(await mutate(delete_task_id(item_id), event="task.deleted"))
+
+def new_punishment(body: Dict[str, Any]) -> Mutation:
+    txt = (body.get("punishment") or "").strip()
+    item_id = new_id()
+
+    def apply(p: DocPatch):
+        if txt:
+            return {"punishment": p.append(("punishments",), {"id": item_id, "text": txt})}
+        return {"punishment": None}
+    return apply
 
 @app.post("/api/punishments/add")
 async def api_add_punishment(req: Request):
-    body = await req.json()
-    txt = (body.get("punishment") or "").strip()
-    d = load_data()
-    if txt:
-        d.setdefault("punishments", []).append(txt)
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"punishments": d.get("punishments", [])}
+    return await mutate(new_punishment(await req.json()), event="punishment.added")
 
 @app.get("/api/punishments")
 async def api_get_punishments():
-    d = load_data()
+    d = await load_data()
     return {"punishments": d.get("punishments", [])}
 
 @app.post("/api/punishments/delete/{idx}")
 async def api_delete_punishment(idx: int):
-    d = load_data()
-    if 0 <= idx < len(d.get("punishments", [])):
-        d["punishments"].pop(idx)
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"punishments": d.get("punishments", [])}
+    def apply(p: DocPatch):
+        i = at_index(p, "punishments", idx)
+        if i is None:
+            return {"ok": False, "id": None}
+        removed = p.remove(("punishments", i))
+        return {"ok": True, "id": removed.get("id") if isinstance(removed, dict) else None}
+    return await mutate(apply, event="punishment.deleted")
+
+def delete_punishment_id(item_id: str) -> Mutation:
+    def apply(p: DocPatch):
+        i = p.find("punishments", item_id)
+        if i is None:
+            return JSONResponse({"error": "Punishment not found"}, status_code=404)
+        p.remove(("punishments", i))
+        return {"ok": True, "id": item_id}
+    return apply
+
+@app.post("/api/punishments/{item_id}/delete")
+async def api_delete_punishment_by_id(item_id: str):
+    return await mutate(delete_punishment_id(item_id), event="punishment.deleted")
 
 @app.post("/api/nonneg/add")
 async def api_add_nonneg(req: Request):
@@ -300,148 +1609,770 @@ async def api_add_nonneg(req: Request):
     txt = (body.get("rule") or "").strip()
     if not txt:
         return JSONResponse({"error": "Empty"}, status_code=400)
-    d = load_data()
-    d.setdefault("non_negotiables", []).append({"text": txt, "created": now_iso()})
-    if not save_data(d):
-        return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"ok": True, "data": d}
+    created = now_iso()
+    item_id = new_id()
+
+    def apply(p: DocPatch):
+        return {"ok": True, "item": p.append(("non_negotiables",), {"id": item_id, "text": txt, "created": created})}
+    return await mutate(apply, event="nonneg.added")
+
+def edit_nonneg(p: DocPatch, i: int, txt: str, modified: str) -> Any:
+    if not txt:
+        return JSONResponse({"error": "Empty"}, status_code=400)
+    p.set(("non_negotiables", i, "text"), txt)
+    p.set(("non_negotiables", i, "modified"), modified)
+    return {"ok": True, "item": p.doc["non_negotiables"][i]}
 
 @app.post("/api/nonneg/delete/{idx}")
 async def api_delete_nonneg(idx: int):
-    d = load_data()
-    if idx < 0 or idx >= len(d.get("non_negotiables", [])):
-        return JSONResponse({"error": "Invalid index"}, status_code=400)
-    d["non_negotiables"].pop(idx)
-    if not save_data(d):
-        return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"ok": True, "data": d}
+    def apply(p: DocPatch):
+        i = at_index(p, "non_negotiables", idx)
+        if i is None:
+            return JSONResponse({"error": "Invalid index"}, status_code=400)
+        return {"ok": True, "id": p.remove(("non_negotiables", i)).get("id")}
+    return await mutate(apply, event="nonneg.deleted")
+
+@app.post("/api/nonneg/{item_id}/delete")
+async def api_delete_nonneg_by_id(item_id: str):
+    def apply(p: DocPatch):
+        i = p.find("non_negotiables", item_id)
+        if i is None:
+            return JSONResponse({"error": "Not found"}, status_code=404)
+        p.remove(("non_negotiables", i))
+        return {"ok": True, "id": item_id}
+    return await mutate(apply, event="nonneg.deleted")
 
 @app.post("/api/nonneg/edit/{idx}")
 async def api_edit_nonneg(idx: int, req: Request):
     body = await req.json()
     txt = (body.get("rule") or "").strip()
-    d = load_data()
-    if idx < 0 or idx >= len(d.get("non_negotiables", [])):
-        return JSONResponse({"error": "Invalid index"}, status_code=400)
-    if not txt:
-        return JSONResponse({"error": "Empty"}, status_code=400)
-    d["non_negotiables"][idx]["text"] = txt
-    d["non_negotiables"][idx]["modified"] = now_iso()
-    if not save_data(d):
-        return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"ok": True, "data": d}
+    modified = now_iso()
+
+    def apply(p: DocPatch):
+        i = at_index(p, "non_negotiables", idx)
+        if i is None:
+            return JSONResponse({"error": "Invalid index"}, status_code=400)
+        return edit_nonneg(p, i, txt, modified)
+    return await mutate(apply, event="nonneg.edited")
+
+def edit_nonneg_id(item_id: str, body: Dict[str, Any]) -> Mutation:
+    txt = (body.get("rule") or "").strip()
+    modified = now_iso()
+
+    def apply(p: DocPatch):
+        i = p.find("non_negotiables", item_id)
+        if i is None:
+            return JSONResponse({"error": "Not found"}, status_code=404)
+        return edit_nonneg(p, i, txt, modified)
+    return apply
+
+@app.post("/api/nonneg/{item_id}/edit")
+async def api_edit_nonneg_by_id(item_id: str, req: Request):
+    return await mutate(edit_nonneg_id(item_id, await req.json()), event="nonneg.edited")
+
+def new_diary_entry(body: Dict[str, Any]) -> Mutation:
+    entry = (body.get("entry") or "").strip()
+    ts = now_iso()
+    item_id = new_id()
+
+    def apply(p: DocPatch):
+        if entry:
+            return {"entry": p.append(("diary",), {"id": item_id, "text": entry, "ts": ts})}
+        return {"entry": None}
+    return apply
 
 @app.post("/api/diary/add")
 async def api_diary_add(req: Request):
-    body = await req.json()
-    entry = (body.get("entry") or "").strip()
-    d = load_data()
-    if entry:
-        d.setdefault("diary", []).append({"text": entry, "ts": now_iso()})
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"diary": d.get("diary", [])}
+    return await mutate(new_diary_entry(await req.json()), event="diary.added")
+
+@app.get("/api/diary")
+async def api_get_diary(limit: int = PAGE_LIMIT, after: Optional[str] = None):
+    player = players.current()
+    return page(player, await load_data(player), "diary", limit, after)
+
+def parse_day(v: Optional[str], end: bool = False) -> Optional[datetime]:
+    """ISO date or datetime; a bare date as `end` means the end of that day."""
+    if not v:
+        return None
+    dt = datetime.fromisoformat(v)
+    if dt.tzinfo:
+        dt = dt.astimezone(APP_TZ).replace(tzinfo=None)  # the diary stores naive wall-clock ts
+    if end and len(v) <= 10:
+        dt += timedelta(days=1)
+    return dt
+
+@app.get("/api/diary/search")
+async def api_diary_search(q: Optional[str] = None, start: Optional[str] = Query(None, alias="from"),
+                           end: Optional[str] = Query(None, alias="to"), limit: int = PAGE_LIMIT):
+    """Diary entries (hot and archived) containing every word of `q`, within [from, to]."""
+    words = re.findall(r"\w+", (q or "").lower())
+    try:
+        lo, hi = parse_day(start), parse_day(end, end=True)
+    except ValueError:
+        return JSONResponse({"error": "from/to must be ISO dates"}, status_code=400)
+    if not words and lo is None and hi is None:
+        return JSONResponse({"error": "Give q, from or to"}, status_code=400)
+    limit = max(1, min(limit, PAGE_MAX))
+    player = players.current()
+    d = await load_data(player)
+    lo_s, hi_s = lo.isoformat() if lo else None, hi.isoformat() if hi else None
+    hits: List[Dict[str, Any]] = []
+    for e in d.get("diary") or []:
+        if not isinstance(e, dict):
+            continue
+        ts = str(e.get("ts") or "")
+        if (lo_s and ts < lo_s) or (hi_s and ts >= hi_s):
+            continue
+        if words and not set(words) <= set(re.findall(r"\w+", str(e.get("text") or "").lower())):
+            continue
+        hits.append(e)
+    seen = {e.get("id") for e in hits}
+    archived = await store.search_diary(player.id, " ".join(words) or None, lo, hi, limit)
+    hits += [e for e in archived if e.get("id") not in seen]
+    hits.sort(key=lambda e: str(e.get("ts") or ""), reverse=True)
+    return {"diary": hits[:limit], "count": len(hits[:limit])}
 
 @app.get("/api/shop")
 async def api_shop_get():
-    d = load_data()
-    shop = d.setdefault("shop", {"coins": 0, "items": [], "catalog": []})
-    return {"shop": shop, "catalog": shop.get("catalog", [])}
+    shop = (await load_data())["shop"]
+    return {"shop": shop, "catalog": shop["catalog"]}
 
-@app.post("/api/shop/buy/{item_id}")
-async def api_shop_buy(item_id: int):
-    d = load_data()
-    catalog = {int(it.get("id")): it for it in d.get("shop", {}).get("catalog", []) if it.get("id") is not None}
-    item = catalog.get(item_id)
-    if not item:
-        return JSONResponse({"error": "Item not found"}, status_code=404)
-    if d.get("shop", {}).get("coins", 0) < int(item.get("price", 0)):
-        return JSONResponse({"error": "Not enough coins"}, status_code=400)
-    d["shop"]["coins"] = d["shop"].get("coins", 0) - int(item.get("price", 0))
-    effect = item.get("effect")
-    val = item.get("value", None)
-    if effect == "skip_punishment":
-        if d.get("ongoing_punishments"):
-            d["ongoing_punishments"].pop(0)
-        else:
-            d["shop"]["skip_tokens"] = d["shop"].get("skip_tokens", 0) + (val or 1)
-    elif effect == "xp_boost":
-        d["shop"]["xp_boost_active"] = True
-    elif effect == "extra_time":
-        import datetime as _dt
-        tasks = [t for t in d.get("tasks", []) if t.get("deadline")]
-        try:
-            tasks_sorted = sorted(tasks, key=lambda x: x.get("deadline") or "")
-            if tasks_sorted:
-                td = tasks_sorted[0]["deadline"]
+def shop_buy(item_id: int) -> Mutation:
+    stamp = now_iso()
+
+    def apply(p: DocPatch):
+        d = p.doc
+        catalog = {int(it.get("id")): it for it in d.get("shop", {}).get("catalog", []) if it.get("id") is not None}
+        item = catalog.get(item_id)
+        if not item:
+            return JSONResponse({"error": "Item not found"}, status_code=404)
+        if d.get("shop", {}).get("coins", 0) < int(item.get("price", 0)):
+            return JSONResponse({"error": "Not enough coins"}, status_code=400)
+        post(p, "shop.spend", stamp, item_id, coins=-int(item.get("price", 0)))
+        effect = item.get("effect")
+        val = item.get("value", None)
+        extended = None
+        if effect == "skip_punishment":
+            if d.get("ongoing_punishments"):
+                p.remove(("ongoing_punishments", 0))
+            else:
+                p.set(("shop", "skip_tokens"), d["shop"].get("skip_tokens", 0) + (val or 1))
+        elif effect == "xp_boost":
+            p.set(("shop", "xp_boost_active"), True)
+        elif effect == "extra_time":
+            import datetime as _dt
+            # earliest deadline still open (ties: first in list); done and
+            # failed tasks have nothing left to extend
+            dated = [(t.get("deadline"), i) for i, t in enumerate(d.get("tasks", []))
+                     if t.get("deadline") and not t.get("done") and not t.get("failed")]
+            if dated:
+                td, i = min(dated)
                 try:
                     tdt = _dt.datetime.fromisoformat(td)
                     tdt = tdt + _dt.timedelta(minutes=int(val or 60))
-                    tasks_sorted[0]["deadline"] = tdt.isoformat()
+                    p.set(("tasks", i, "deadline"), tdt.isoformat())
+                    extended = d["tasks"][i]
                 except Exception:
                     pass
-        except Exception:
-            pass
-    d["shop"].setdefault("items", [])
-    if item.get("name") not in d["shop"]["items"]:
-        d["shop"]["items"].append(item.get("name"))
-    if not save_data(d):
-        return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"shop": d.get("shop")}
+        if item.get("name") not in d["shop"].get("items", []):
+            p.append(("shop", "items"), item.get("name"))
+        # the catalog didn't change; leave it out
+        result = {"shop": {k: v for k, v in d["shop"].items() if k != "catalog"}}
+        if extended:
+            result["task"] = extended
+        return result
+    return apply
+
+@app.post("/api/shop/buy/{item_id}")
+async def api_shop_buy(item_id: int):
+    return task_changed(await mutate(shop_buy(item_id), event="shop.bought"))
+
+def change_settings(body: Any) -> Mutation:
+    def apply(p: DocPatch):
+        if isinstance(body, dict):
+            changes = body["settings"] if isinstance(body.get("settings"), dict) else body
+            for k, v in changes.items():
+                if (p.doc.get("settings") or {}).get(k, object()) != v:
+                    p.set(("settings", k), v)
+        return {"settings": p.doc.get("settings", {})}
+    return apply
 
 @app.post("/api/settings")
 async def api_save_settings(req: Request):
-    body = await req.json()
-    d = load_data()
-    if isinstance(body, dict):
-        if "settings" in body and isinstance(body["settings"], dict):
-            d.setdefault("settings", {}).update(body["settings"])
-        else:
-            d.setdefault("settings", {}).update(body)
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"settings": d.get("settings", {})}
+    return await mutate(change_settings(await req.json()), event="settings.changed")
 
 @app.get("/api/stats")
 async def api_get_stats():
-    d = load_data()
+    d = await load_data()
     return {"stats": d.get("stats", {}), "attributes": d.get("attributes", {}), "stat_progress": d.get("stat_progress", {})}
 
+@app.get("/api/ledger")
+async def api_get_ledger(limit: int = PAGE_LIMIT, before: Optional[int] = None):
+    """Coin/XP ledger entries newest first (hot, then archived), plus the current balance."""
+    limit = max(1, min(limit, PAGE_MAX))
+    player = players.current()
+    d = await load_data(player)
+    hot = [e for e in d.get("ledger") or [] if isinstance(e, dict)
+           and (before is None or int(e.get("seq") or 0) < before)]
+    entries = hot[::-1][:limit]
+    if len(entries) < limit:
+        oldest = int(entries[-1]["seq"]) if entries else before
+        entries += await store.ledger_history(player.id, oldest, limit - len(entries))
+    nxt = entries[-1].get("seq") if len(entries) == limit and int(entries[-1].get("seq") or 0) > 1 else None
+    return {
+        "ledger": entries,
+        "next": nxt,
+        "balance": {
+            "coins": d["shop"]["coins"],
+            "tasks_completed": d["stats"]["tasks_completed"],
+            "xp": {name: xp_total(sp) for name, sp in d["stat_progress"].items()},
+            "seq": ledger_seq(d),
+        },
+    }
+
+@app.get("/api/analytics")
+async def api_analytics(start: Optional[str] = Query(None, alias="from"), end: Optional[str] = Query(None, alias="to"),
+                        granularity: str = "day"):
+    """Rollup buckets per day/week/month within [from, to] (dates; default the last 30 days)."""
+    if granularity not in GRANULARITIES:
+        return JSONResponse({"error": "granularity must be day, week or month"}, status_code=400)
+    try:
+        hi = date.fromisoformat(end) if end else local_now().date()
+        lo = date.fromisoformat(start) if start else hi - timedelta(days=29)
+    except ValueError:
+        return JSONResponse({"error": "from/to must be ISO dates"}, status_code=400)
+    if lo > hi:
+        return JSONResponse({"error": "from is after to"}, status_code=400)
+    period_days = {"day": 1, "week": 7, "month": 28}[granularity]
+    if (hi - lo).days // period_days > ANALYTICS_MAX_BUCKETS:
+        return JSONResponse({"error": "Range too long for this granularity"}, status_code=400)
+    rollups = (await load_data()).get("rollups") or {}
+    days = rollups.get("day") or {}
+    kept_from = (local_now().date() - timedelta(days=ROLLUP_DAYS)) if ROLLUP_DAYS > 0 else date.min
+    buckets = []
+    totals: Dict[str, Any] = {}
+    cur = period_start(lo, granularity)
+    while cur <= hi:
+        nxt = next_period(cur, granularity)
+        a, b = max(cur, lo), min(nxt - timedelta(days=1), hi)
+        if granularity != "day" and (a, b) != (cur, nxt - timedelta(days=1)) and a >= kept_from:
+            # a period cut by the range: add up its days instead
+            bucket: Dict[str, Any] = {}
+            for i in range((b - a).days + 1):
+                merge_bucket(bucket, days.get((a + timedelta(days=i)).isoformat()) or {})
+        else:
+            bucket = (rollups.get(granularity) or {}).get(period_key(cur, granularity)) or {}
+        merge_bucket(totals, bucket)
+        buckets.append({"period": period_key(cur, granularity), "from": a.isoformat(), "to": b.isoformat(),
+                        **bucket_summary(bucket)})
+        cur = nxt
+    return {"granularity": granularity, "from": lo.isoformat(), "to": hi.isoformat(),
+            "buckets": buckets, "totals": bucket_summary(totals)}
+
 @app.post("/api/ping")
 async def api_ping():
-    d = load_data()
-    today = date.today()
-    last = d.get("last_login")
-    triggered = None
-    lastd = None
-    if last:
+    stamp = now_iso()
+    today = local_now().date()
+    # drawn once per request so a conflict retry picks the same one
+    pick = random.random()
+
+    def apply(p: DocPatch):
+        d = p.doc
+        lastd = login_date(d.get("last_login"))
+        # missed days are usually settled at midnight already (see roll_day)
+        triggered = roll_day(p, today, pick, stamp)
+        if lastd != today:
+            if lastd is None or (today - lastd).days == 1:
+                p.set(("streak",), 1 if lastd is None else d.get("streak", 0) + 1)
+                p.set(("best_streak",), max(d.get("best_streak", 0), d.get("streak", 0)))
+            p.set(("last_login",), stamp)
+            rollup(p, stamp, logins=1, streak=d.get("streak", 0))
+        return {"streak": d.get("streak", 0), "punishment": triggered, "shop": d.get("shop", {}), "ongoing_punishments": d.get("ongoing_punishments", [])}
+    return await mutate(apply, event="streak.updated")
+
+# === Batch mutations ===
+# POST /api/batch {"ops": [{"op": "task.add", "task": "..."}, {"op": "task.toggle", "id": "..."}, ...]}
+# applies the ops in order to one loaded document and saves once. Each op
+# takes the body its single endpoint takes, plus "id" for the item it acts
+# on. It is all or nothing: the first failing op rolls back the ones before
+# it and its error is returned with its position ("failed") and name. The results (each op's
+# usual response, tagged with "op" and "event") are published as one
+# "batch" event. The service worker replays offline edits through here.
+BATCH_MAX_OPS = int(os.getenv("BATCH_MAX_OPS", "200"))
+
+def item_id_arg(args: Dict[str, Any]) -> str:
+    item_id = args.get("id")
+    if not isinstance(item_id, str) or not item_id:
+        raise ValueError("id is required")
+    return item_id
+
+def catalog_id_arg(args: Dict[str, Any]) -> int:
+    try:
+        return int(args.get("id"))
+    except (TypeError, ValueError):
+        raise ValueError("id must be a catalog item number")
+
+def settings_arg(args: Dict[str, Any]) -> Dict[str, Any]:
+    # {"op": "settings", "settings": {...}}, or the changes inline beside "op"
+    if isinstance(args.get("settings"), dict):
+        return args["settings"]
+    return {k: v for k, v in args.items() if k not in ("op", "id")}
+
+# op -> (builds the mutation from the op's fields, event kind, post-commit hook)
+BATCH_OPS: Dict[str, Tuple[Callable[[Dict[str, Any]], Mutation], str, Callable[[Any], Any]]] = {
+    "task.add": (new_task, "task.added", task_changed),
+    "task.toggle": (lambda a: toggle_task_id(item_id_arg(a)), "task.toggled", task_changed),
+    "task.delete": (lambda a: delete_task_id(item_id_arg(a)), "task.deleted", task_deleted),
+    "punishment.add": (new_punishment, "punishment.added", lambda r: r),
+    "punishment.delete": (lambda a: delete_punishment_id(item_id_arg(a)), "punishment.deleted", lambda r: r),
+    "nonneg.edit": (lambda a: edit_nonneg_id(item_id_arg(a), a), "nonneg.edited", lambda r: r),
+    "diary.add": (new_diary_entry, "diary.added", lambda r: r),
+    "shop.buy": (lambda a: shop_buy(catalog_id_arg(a)), "shop.bought", task_changed),
+    "settings": (lambda a: change_settings(settings_arg(a)), "settings.changed", lambda r: r),
+}
+
+@app.post("/api/batch")
+async def api_batch(req: Request):
+    try:
+        body = await req.json()
+    except ValueError:
+        return JSONResponse({"error": "Body must be JSON"}, status_code=400)
+    ops = body.get("ops") if isinstance(body, dict) else body
+    if not isinstance(ops, list) or not ops:
+        return JSONResponse({"error": "ops must be a non-empty list"}, status_code=400)
+    if len(ops) > BATCH_MAX_OPS:
+        return JSONResponse({"error": f"At most {BATCH_MAX_OPS} ops per batch"}, status_code=413)
+    # build every mutation up front (ids and timestamps are fixed here, so a
+    # conflict retry replays the same batch) and reject bad input unapplied
+    steps: List[Tuple[str, Mutation]] = []
+    for n, op in enumerate(ops):
+        name = op.get("op") if isinstance(op, dict) else None
+        if name not in BATCH_OPS:
+            return JSONResponse({"error": f"Unknown op {name!r}", "failed": n}, status_code=400)
         try:
-            lastd = date.fromisoformat(last.split("T")[0])
-        except Exception:
-            lastd = None
-    if lastd != today:
-        if lastd is None:
-            d["streak"] = 1
-            d["best_streak"] = max(d.get("best_streak", 0), d.get("streak", 0))
-        else:
-            delta = (today - lastd).days
-            if delta == 1:
-                d["streak"] = d.get("streak", 0) + 1
-                d["best_streak"] = max(d.get("best_streak", 0), d.get("streak", 0))
-            elif delta > 1:
-                d["streak"] = 0
-                p = random.choice(d.get("punishments", [])) if d.get("punishments") else None
-                if p:
-                    d.setdefault("ongoing_punishments", []).append({"text": p, "ts": now_iso()})
-                    triggered = p
-        d["last_login"] = datetime.now().isoformat()
-        if not save_data(d):
-            return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"streak": d.get("streak", 0), "punishment": triggered, "shop": d.get("shop", {}), "ongoing_punishments": d.get("ongoing_punishments", [])}
+            steps.append((name, BATCH_OPS[name][0](op)))
+        except ValueError as e:
+            return JSONResponse({"error": str(e), "failed": n, "op": name}, status_code=400)
+
+    def apply(p: DocPatch):
+        results = []
+        for n, (name, fn) in enumerate(steps):
+            result = fn(p)
+            if isinstance(result, Response):
+                p.rollback()  # nothing of the batch may stay in the cached document
+                err = json.loads(result.body)
+                return JSONResponse({**err, "failed": n, "op": name}, status_code=result.status_code)
+            results.append({"op": name, "event": BATCH_OPS[name][1], **result})
+        return {"ok": True, "results": results}
+    result = await mutate(apply, event="batch")
+    if not isinstance(result, Response):
+        for r in result["results"]:
+            BATCH_OPS[r["op"]][2](r)
+    return result
+
+@app.get("/api/cache/stats")
+async def api_cache_stats():
+    player = players.current()
+    return {
+        **player.cache.stats(),
+        "player": player.id,
+        "write_behind": player.writer.stats(),
+        "events": player.events.stats(),
+        "scheduler": deadlines.stats(),
+        "players": players.stats(),
+        "storage": store.stats(),
+    }
+
+# === Metrics & profiler ===
+# GET /metrics is the Prometheus scrape target (histograms and counters from
+# metrics.py plus the gauges below, read at scrape time). With METRICS_TOKEN
+# set it wants "Authorization: Bearer <token>". PROFILER=1 turns on
+# /api/profile/start|stop: a sampling profiler over the event loop thread
+# that answers with collapsed stacks (feed them to flamegraph.pl/speedscope).
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+PROFILER = os.getenv("PROFILER", "0") == "1"
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "120"))
+
+metrics.Gauge("solo_players_resident", "Players held in memory.", lambda: {(): len(players.resident)})
+metrics.Gauge("solo_cached_documents", "Resident players with a cached document.",
+              lambda: {(): sum(p.cache.data is not None for p in players.resident.values())})
+metrics.Gauge("solo_write_behind_pending_edits", "Edits applied in memory but not yet written.",
+              lambda: {(): sum(p.writer.seq - p.writer.done_seq for p in players.resident.values())})
+metrics.Gauge("solo_event_subscribers", "Open /api/events streams.",
+              lambda: {(): sum(len(p.events.subscribers) for p in players.resident.values())})
+metrics.Gauge("solo_journal_pending", "Writes held in the local journal until the store is back.",
+              lambda: {(): (store.stats().get("journal") or {}).get("pending", 0)})
+metrics.Gauge("solo_storage_circuit_open", "1 while the storage circuit breaker is open.",
+              lambda: {(): int(not store.available())})
+metrics.Gauge("solo_scheduler_pending", "Deadlines and rolls waiting in the scheduler.", lambda: {(): len(deadlines.heap)})
+profiler = metrics.SamplingProfiler()
+metrics.Gauge("solo_profiler_running", "1 while the sampling profiler runs.", lambda: {(): int(profiler.running)})
+
+@app.get("/metrics")
+async def api_metrics(req: Request):
+    if METRICS_TOKEN and req.headers.get("authorization") != f"Bearer {METRICS_TOKEN}":
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/profile")
+async def api_profile_status():
+    if not PROFILER:
+        return JSONResponse({"error": "Profiler disabled (set PROFILER=1)"}, status_code=404)
+    return profiler.stats()
+
+@app.post("/api/profile/start")
+async def api_profile_start(interval_ms: float = 5, seconds: float = 30):
+    if not PROFILER:
+        return JSONResponse({"error": "Profiler disabled (set PROFILER=1)"}, status_code=404)
+    limit = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    # handlers run on the event loop thread, which is the one worth sampling
+    if not profiler.start(threading.get_ident(), max(interval_ms, 1) / 1000.0, limit):
+        return JSONResponse({"error": "Profiler already running"}, status_code=409)
+    return {"ok": True, "interval_ms": max(interval_ms, 1), "seconds": limit}
+
+@app.post("/api/profile/stop")
+async def api_profile_stop():
+    if not PROFILER:
+        return JSONResponse({"error": "Profiler disabled (set PROFILER=1)"}, status_code=404)
+    profiler.stop()
+    return Response(profiler.collapsed(), media_type="text/plain",
+                    headers={"X-Profile-Samples": str(profiler.samples)})
+
+@app.post("/api/flush")
+async def api_flush():
+    """Wait until queued write-behind edits are durable."""
+    writer = players.current().writer
+    if writer.enabled and writer.dirty and not await writer.wait(writer.seq):
+        return JSONResponse({"error": "Flush timed out"}, status_code=503)
+    return {"ok": True}
 
 @app.post("/api/reset")
 async def api_reset():
     default = seed_data()
-    if not save_data(default):
-        return JSONResponse({"error": "Failed to save"}, status_code=500)
-    return {"status": "reset", "data": default}
+
+    def apply(p: DocPatch):
+        p.replace(copy.deepcopy(default))
+        return {"status": "reset", "data": p.doc}
+    player = players.current()
+    await store.clear_archive(player.id)
+    result = await mutate(apply, durable=True)
+    if not isinstance(result, Response):
+        deadlines.register(player.id, result["data"])
+        player.events.publish("reset", {"status": "reset"})
+    return result
+
+# === Export / import ===
+# GET /api/export streams the current player as NDJSON, one record a line:
+#   {"type": "header", "format": "solo-export", "version": 1, "export_id", "player", "schema_version", "exported_at"}
+#   {"type": "settings", "data": {...}}
+#   {"type": "state", "data": {...}}       every other top-level key but the lists below
+#   {"type": "task" | "diary" | "ledger", "data": {...}}   one per item, oldest first
+#   {"type": "end", "counts": {"task": n, "diary": n, "ledger": n}}
+# Diary and ledger include their archived entries, read EXPORT_PAGE at a
+# time, and the body goes out in EXPORT_CHUNK-byte writes, so memory stays
+# flat however long the history. A file without its "end" line was cut short.
+#
+# POST /api/import replaces the current player with such a stream (the request
+# body), IMPORT_BATCH records per durable write. Each write also moves the
+# document's "import" checkpoint (export id, last line applied, counts), so
+# posting the same file again after a broken upload skips what already
+# landed; ?restart=1 starts over. Progress: an "import.progress" event per
+# batch and GET /api/import. Ledger entries the imported checkpoint already
+# folds go straight to the ledger archive; everything else joins the document
+# and the usual compaction moves overflow out after every batch. Records from
+# older exports are upgraded by model.migrate() like stored documents.
+EXPORT_FORMAT = "solo-export"
+EXPORT_VERSION = 1
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", str(64 * 1024)))
+EXPORT_PAGE = 500
+IMPORT_BATCH = max(1, int(os.getenv("IMPORT_BATCH", "500")))
+IMPORT_MAX_LINE = 1024 * 1024
+ITEM_LISTS = {"task": "tasks", "diary": "diary", "ledger": "ledger"}
+RECORD_TYPES = ("header", "settings", "state", "end") + tuple(ITEM_LISTS)
+NOT_STATE = ("tasks", "diary", "ledger", "settings", "import", "schema_version")
+
+importing: Set[str] = set()  # players with an import running in this process
+
+class ImportFailed(ValueError):
+    def __init__(self, line: int, message: str, status: int = 400):
+        super().__init__(message)
+        self.line = line
+        self.status = status
+
+def export_line(record: Dict[str, Any]) -> bytes:
+    return codec.dumps(record) + b"\n"
+
+@app.get("/api/export")
+async def api_export():
+    player = players.current()
+    d = await load_data(player)
+    # the hot part is taken here in one go (no await in between): one snapshot
+    tasks, diary, ledger = list(d.get("tasks") or []), list(d.get("diary") or []), list(d.get("ledger") or [])
+    folded = int((d.get("ledger_checkpoint") or {}).get("seq") or 0)
+    head = b"".join(export_line(r) for r in (
+        {"type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION, "export_id": new_id(),
+         "player": player.id, "schema_version": d.get("schema_version"), "exported_at": now_iso()},
+        {"type": "settings", "data": d.get("settings") or {}},
+        {"type": "state", "data": {k: v for k, v in d.items() if k not in NOT_STATE}},
+    ))
+
+    async def records() -> AsyncIterator[Tuple[str, Any]]:
+        for task in tasks:
+            yield "task", task
+        hot = {e.get("id") for e in diary if isinstance(e, dict)}
+        offset = 0
+        while True:
+            page = await store.export_diary(player.id, offset, EXPORT_PAGE)
+            for entry in page:
+                if entry.get("id") not in hot:  # else archived since the snapshot
+                    yield "diary", entry
+            if len(page) < EXPORT_PAGE:
+                break
+            offset += len(page)
+        for entry in diary:
+            yield "diary", entry
+        after = 0
+        while after < folded:
+            page = await store.export_ledger(player.id, after, EXPORT_PAGE)
+            for entry in page:
+                after = int(entry.get("seq") or 0)
+                if after > folded:
+                    break  # folded since the snapshot; still in `ledger`
+                yield "ledger", entry
+            if len(page) < EXPORT_PAGE:
+                break
+        for entry in ledger:
+            yield "ledger", entry
+
+    async def stream() -> AsyncIterator[bytes]:
+        counts = {kind: 0 for kind in ITEM_LISTS}
+        buf = bytearray(head)
+        async for kind, item in records():
+            buf += export_line({"type": kind, "data": item})
+            counts[kind] += 1
+            if len(buf) >= EXPORT_CHUNK:
+                yield bytes(buf)
+                buf.clear()
+        buf += export_line({"type": "end", "counts": counts})
+        yield bytes(buf)
+
+    filename = f"solo-{player.id}-{local_now().date().isoformat()}.ndjson"
+    return StreamingResponse(stream(), media_type="application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"',
+                                      "Cache-Control": "no-store"})
+
+async def ndjson_lines(req: Request) -> AsyncIterator[Tuple[int, bytes]]:
+    """(line number, line) pairs of the request body as it arrives."""
+    pending = b""
+    n = 0
+    async for chunk in req.stream():
+        parts = (pending + chunk).split(b"\n")
+        pending = parts.pop()
+        for part in parts:
+            n += 1
+            yield n, part
+        if len(pending) > IMPORT_MAX_LINE:
+            raise ImportFailed(n + 1, f"Line longer than {IMPORT_MAX_LINE} bytes")
+    if pending.strip():
+        yield n + 1, pending
+
+def parse_record(n: int, raw: bytes) -> Dict[str, Any]:
+    try:
+        record = codec.loads(raw)
+    except ValueError as e:
+        raise ImportFailed(n, f"Not JSON: {e}")
+    kind = record.get("type") if isinstance(record, dict) else None
+    if kind not in RECORD_TYPES:
+        raise ImportFailed(n, f"Unknown record type {kind!r}")
+    if kind not in ("header", "end") and not isinstance(record.get("data"), dict):
+        raise ImportFailed(n, f"{kind} record needs an object in data")
+    return record
+
+def migrate_records(records: List[Dict[str, Any]], version: int) -> None:
+    """Upgrade records of an older export in place, with the steps stored documents get."""
+    if version >= model.SCHEMA_VERSION:
+        return
+    for r in records:
+        kind, data = r["type"], r["data"]
+        key = ITEM_LISTS.get(kind, kind)
+        doc = dict(data) if kind == "state" else {key: [data] if kind in ITEM_LISTS else data}
+        doc["schema_version"] = version
+        model.migrate(DocPatch(doc), seed_data)
+        if kind == "state":
+            r["data"] = {k: doc[k] for k in data}
+        else:
+            r["data"] = doc[key][0] if kind in ITEM_LISTS else doc[key]
+
+class ImportJob:
+    """One POST /api/import: buffers records and applies them a batch at a time."""
+
+    def __init__(self, player: Player, header: Dict[str, Any], checkpoint: Optional[Dict[str, Any]]):
+        self.player = player
+        self.version = int(header.get("schema_version") or 0)
+        self.fresh = checkpoint is None  # the first write replaces the document
+        self.checkpoint = checkpoint or {
+            "id": header.get("export_id"), "from": header.get("player"), "line": 1,
+            "counts": {kind: 0 for kind in ITEM_LISTS}, "skipped": 0,
+            "started": now_iso(), "finished": None, "done": False,
+        }
+        self.batch: List[Dict[str, Any]] = []
+
+    def add(self, record: Dict[str, Any]) -> None:
+        if record["type"] in ("task", "diary") and not record["data"].get("id"):
+            record["data"]["id"] = new_id()
+        self.batch.append(record)
+
+    async def flush(self, line: int, finish: bool = False) -> Dict[str, Any]:
+        records, self.batch = self.batch, []
+        migrate_records(records, self.version)
+        d = await load_data(self.player)
+        folded = 0 if self.fresh else int((d.get("ledger_checkpoint") or {}).get("seq") or 0)
+        archived: List[Dict[str, Any]] = []
+        rest: List[Dict[str, Any]] = []
+        for r in records:
+            if r["type"] == "state" and isinstance(r["data"].get("ledger_checkpoint"), dict):
+                folded = int(r["data"]["ledger_checkpoint"].get("seq") or 0)
+            if r["type"] == "ledger" and int(r["data"].get("seq") or 0) <= folded:
+                archived.append(r["data"])  # already in the checkpoint's balance
+            else:
+                rest.append(r)
+        if archived and not await store.archive_ledger(self.player.id, archived):
+            raise ImportFailed(self.checkpoint["line"], "Could not archive ledger entries (is ledger_archive "
+                               "installed? see schema.sql); post the file again to resume", 503)
+        fresh, base = self.fresh, self.checkpoint
+
+        def apply(p: DocPatch):
+            if fresh:
+                p.replace(seed_data())
+            counts = {**base["counts"], "ledger": base["counts"]["ledger"] + len(archived)}
+            skipped = base["skipped"]
+            for r in rest:
+                kind, data = r["type"], r["data"]
+                if kind == "settings":
+                    p.set(("settings",), {**p.doc["settings"], **data})
+                elif kind == "state":
+                    for key, value in data.items():
+                        if key not in NOT_STATE:
+                            p.set((key,), value)
+                elif kind == "ledger" or p.find(ITEM_LISTS[kind], data["id"]) is None:
+                    p.append((ITEM_LISTS[kind],), data)
+                    counts[kind] += 1
+                else:
+                    skipped += 1  # same id twice
+            cp = {**base, "line": line, "counts": counts, "skipped": skipped}
+            if finish:
+                open_ledger(p)
+                cp.update(done=True, finished=now_iso())
+            p.set(("import",), cp)
+            return cp
+        result = await mutate(apply, durable=True, player=self.player)
+        if isinstance(result, Response):
+            raise ImportFailed(base["line"], json.loads(result.body).get("error", "Failed to save"), result.status_code)
+        self.fresh = False
+        self.checkpoint = result
+        self.player.events.publish("import.done" if finish else "import.progress", result)
+        # keep the document at its usual size while the history streams in
+        if self.player.compacting:
+            await asyncio.gather(self.player.compaction, return_exceptions=True)
+        await _run_compaction(self.player)
+        return result
+
+async def run_import(player: Player, req: Request, restart: bool) -> Dict[str, Any]:
+    lines = ndjson_lines(req)
+    n, header = 0, None
+    async for n, raw in lines:
+        if raw.strip():
+            header = parse_record(n, raw)
+            break
+    if header is None or header["type"] != "header" or header.get("format") != EXPORT_FORMAT:
+        raise ImportFailed(n, f"Expected a {EXPORT_FORMAT} header line first")
+    if int(header.get("version") or 0) > EXPORT_VERSION or int(header.get("schema_version") or 0) > model.SCHEMA_VERSION:
+        raise ImportFailed(n, "Export is from a newer version of the app")
+    prior = (await load_data(player)).get("import")
+    resume = (not restart and isinstance(prior, dict) and not prior.get("done")
+              and header.get("export_id") and prior.get("id") == header.get("export_id"))
+    job = ImportJob(player, header, dict(prior) if resume else None)
+    if job.fresh:
+        await store.clear_archive(player.id)
+    else:
+        log.info("Resuming import %s for %s after line %s", prior["id"], player.id, prior["line"])
+    async for n, raw in lines:
+        if n <= job.checkpoint["line"] or not raw.strip():
+            continue
+        try:
+            record = parse_record(n, raw)
+        except ImportFailed:
+            if job.batch:
+                await job.flush(n - 1)  # everything before the bad line is kept
+            raise
+        if record["type"] == "end":
+            result = await job.flush(n, finish=True)
+            deadlines.register(player.id, await load_data(player))
+            return {"ok": True, "import": result}
+        if record["type"] == "header":
+            raise ImportFailed(n, "Second header line")
+        job.add(record)
+        if len(job.batch) >= IMPORT_BATCH:
+            await job.flush(n)
+    if job.batch:
+        await job.flush(n)  # keep what arrived
+    raise ImportFailed(n, "Upload ended before the end line; post the file again to resume")
+
+@app.post("/api/import")
+async def api_import(req: Request, restart: bool = False):
+    player = players.current()
+    if player.id in importing:
+        return JSONResponse({"error": "An import is already running for this player"}, status_code=409)
+    importing.add(player.id)
+    try:
+        return await run_import(player, req, restart)
+    except ImportFailed as e:
+        return JSONResponse({"error": str(e), "line": e.line, "import": (player.cache.data or {}).get("import")},
+                            status_code=e.status)
+    except ClientDisconnect:
+        log.info("Import for %s interrupted; the checkpoint is kept", player.id)
+        return JSONResponse({"error": "Upload interrupted"}, status_code=400)
+    finally:
+        importing.discard(player.id)
+
+@app.get("/api/import")
+async def api_import_status():
+    player = players.current()
+    return {"import": (await load_data(player)).get("import"), "running": player.id in importing}
+
+def sse(event_id: str, kind: str, data: str) -> str:
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+@app.get("/api/events")
+async def api_events(req: Request):
+    """Server-sent change events for the current player (see EventHub)."""
+    player = players.current()
+    hub = player.events
+    last = req.headers.get("last-event-id") or req.query_params.get("last_event_id")
+    # subscribe and read the backlog without awaiting in between, so no
+    # event is missed or sent twice
+    sub = hub.subscribe()
+    replay = hub.since(last) if last else []
+
+    async def stream():
+        try:
+            if replay is None:
+                yield sse(hub.event_id(), "resync", "{}")
+            elif not last:
+                yield sse(hub.event_id(), "hello", "{}")
+            for seq, kind, data in replay or []:
+                yield sse(hub.event_id(seq), kind, data)
+            while True:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), EVENT_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if event is None:
+                    break
+                seq, kind, data = event
+                yield sse(hub.event_id(seq), kind, data)
+        finally:
+            hub.unsubscribe(sub)
+    return StreamingResponse(stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -0,0 +1,229 @@
+# metrics.py — Solo System request timing, Prometheus metrics and profiler
+#
+# Both main.py and storage.py time their stages with `span("name")`. A span
+# feeds the solo_stage_duration_seconds histogram and, while a request is in
+# flight, that request's Server-Timing header (see begin_request()), so one
+# slow response shows whether the time went to the Supabase GET, the JSON
+# encode or the write and its fallbacks. render() emits everything in the
+# Prometheus text format for /metrics; there is no client library to install.
+# SamplingProfiler is the opt-in live profiler behind PROFILER=1.
+
+import sys
+import time
+import threading
+from collections import Counter as Tally
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+Labels = Tuple[str, ...]
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()  # the profiler and sqlite threads observe too
+        REGISTRY.append(self)
+
+    def _labels(self, values: Labels, extra: str = "") -> str:
+        parts = [f'{k}="{_escape(str(v))}"' for k, v in zip(self.labels, values)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, n: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + n
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{self._labels(k)} {_fmt(v)}" for k, v in sorted(self.values.items())]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self.series: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self.lock:
+            row = self.series.get(labels)
+            if row is None:
+                row = self.series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def samples(self) -> List[str]:
+        out = []
+        with self.lock:
+            for labels, row in sorted(self.series.items()):
+                for bound, n in zip(self.buckets + (float("inf"),), row):
+                    le = 'le="%s"' % _fmt(bound)
+                    out.append(f"{self.name}_bucket{self._labels(labels, le)} {_fmt(n)}")
+                out.append(f"{self.name}_sum{self._labels(labels)} {_fmt(row[-1])}")
+                out.append(f"{self.name}_count{self._labels(labels)} {_fmt(row[-2])}")
+        return out
+
+class Gauge(Metric):
+    """Read at scrape time from `fn`, which returns {label values: value}."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Dict[Labels, float]], labels: Iterable[str] = ()):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{self._labels(k)} {_fmt(v)}" for k, v in sorted(self.fn().items())]
+
+REGISTRY: List[Metric] = []
+
+def render() -> str:
+    return "\n".join(line for m in REGISTRY for line in m.render()) + "\n"
+
+REQUEST_SECONDS = Histogram("solo_request_duration_seconds", "Time spent handling a request.",
+                            ("method", "route", "status"))
+RESPONSE_BYTES = Histogram("solo_response_bytes", "Response body size.", ("route",), BYTES_BUCKETS)
+STAGE_SECONDS = Histogram("solo_stage_duration_seconds", "Time spent in one stage of a request or background job.",
+                          ("stage",))
+STORAGE_BYTES = Histogram("solo_storage_payload_bytes", "Bytes sent to or received from the storage backend.",
+                          ("op",), BYTES_BUCKETS)
+STORAGE_WRITES = Counter("solo_storage_writes_total", "Document writes by the path that landed them.", ("path",))
+STORAGE_FALLBACKS = Counter("solo_storage_fallbacks_total", "Writes retried on a slower path after the first try failed.",
+                            ("from", "to"))
+STORAGE_ERRORS = Counter("solo_storage_errors_total", "Failed storage calls (HTTP errors, bad statuses, exceptions).",
+                         ("op",))
+CACHE_LOOKUPS = Counter("solo_cache_lookups_total", "Document cache lookups by outcome.", ("result",))
+
+# === Spans ===
+# begin_request() gives the running request its own tally; spans opened in
+# that context (including tasks it spawns) add to it. Spans outside a request
+# (write-behind flushes, the scheduler) only reach the histogram.
+_spans: ContextVar[Optional[Dict[str, List[float]]]] = ContextVar("solo_spans", default=None)
+
+def begin_request() -> Dict[str, List[float]]:
+    spans: Dict[str, List[float]] = {}
+    _spans.set(spans)
+    return spans
+
+class span:
+    """`with span("stage"):` times the block into STAGE_SECONDS and the request's Server-Timing."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> "span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, self.name)
+        spans = _spans.get()
+        if spans is not None:
+            total = spans.setdefault(self.name, [0.0, 0])
+            total[0] += elapsed
+            total[1] += 1
+
+def server_timing(spans: Dict[str, List[float]], total: float) -> str:
+    """Server-Timing value: total first, then each stage (summed when it ran more than once)."""
+    parts = [f"total;dur={total * 1000:.1f}"]
+    for name, (elapsed, n) in spans.items():
+        parts.append(f"{name};dur={elapsed * 1000:.1f}" + (f';desc="x{n}"' if n > 1 else ""))
+    return ", ".join(parts)
+
+# === Sampling profiler ===
+# Off unless PROFILER=1 (main.py). A daemon thread snapshots one thread's
+# stack (the event loop's) every `interval` seconds and tallies it in the
+# collapsed "frame;frame;frame count" form flamegraph tools read. It never
+# runs longer than `limit` seconds, so a forgotten start can't linger.
+class SamplingProfiler:
+    def __init__(self):
+        self.thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+        self.stacks: Tally = Tally()
+        self.samples = 0
+        self.started = 0.0
+        self.interval = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, thread_id: int, interval: float, limit: float) -> bool:
+        if self.running:
+            return False
+        self.stacks = Tally()
+        self.samples = 0
+        self.interval = interval
+        self.started = time.monotonic()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, args=(thread_id, interval, limit),
+                                       name="solo-profiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def _run(self, thread_id: int, interval: float, limit: float) -> None:
+        deadline = time.monotonic() + limit
+        while not self.stop_event.wait(interval) and time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "samples": self.samples,
+            "interval_ms": round(self.interval * 1000, 3),
+            "seconds": round(time.monotonic() - self.started, 3) if self.started else 0,
+            "stacks": len(self.stacks),
+        }
@@ -0,0 +1,174 @@
+# model.py — Solo System player document: shape, schema version, migrations
+#
+# The document stays a tree of plain dicts and lists at runtime: DocPatch
+# edits it in place and records path ops, the supabase store replays those
+# ops inside jsonb, and the row stores map list items to table rows, all by
+# path. The TypedDicts below describe that tree for readers and type
+# checkers; they cost nothing per request (no object graph to build from
+# the decoded JSON and to flatten again before encoding).
+#
+# Every document carries "schema_version". load_migrated() in main.py runs the
+# steps in MIGRATIONS that are newer than the document's version, through a
+# DocPatch so the upgrade is persisted like any other edit, and stamps the
+# version. A document at SCHEMA_VERSION skips the walk entirely, and
+# handlers can rely on the shape documented here instead of re-checking it.
+
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypedDict
+
+from storage import DocPatch, new_id
+
+SCHEMA_VERSION = 3
+
+class Task(TypedDict, total=False):
+    id: str
+    task: str
+    deadline: Optional[str]
+    done: bool
+    failed: bool
+    coins: int
+    xp: int
+    stat: str
+    created: str
+
+class TextItem(TypedDict, total=False):
+    """Punishments and non-negotiables (the latter add created/modified)."""
+    id: str
+    text: str
+    created: str
+    modified: Optional[str]
+
+class DiaryEntry(TypedDict, total=False):
+    id: str
+    text: str
+    ts: str
+
+class CatalogItem(TypedDict):
+    id: int
+    name: str
+    price: int
+    effect: str
+    value: int
+
+class Shop(TypedDict):
+    coins: int
+    items: List[Dict[str, Any]]
+    catalog: List[CatalogItem]
+
+class StatProgress(TypedDict):
+    level: int
+    xp: int
+
+class LedgerEntry(TypedDict, total=False):
+    seq: int
+    ts: str
+    kind: str
+    ref: Any
+    coins: int
+    stat: Optional[str]
+    xp: int
+    tasks: int
+
+class Document(TypedDict, total=False):
+    schema_version: int
+    name: Optional[str]
+    tasks: List[Task]
+    punishments: List[TextItem]
+    non_negotiables: List[TextItem]
+    diary: List[DiaryEntry]
+    streak: int
+    best_streak: int
+    last_login: Optional[str]
+    shop: Shop
+    ongoing_punishments: List[Dict[str, Any]]
+    stat_progress: Dict[str, StatProgress]
+    attributes: Dict[str, int]
+    settings: Dict[str, Any]
+    stats: Dict[str, int]
+    ledger: List[LedgerEntry]
+    ledger_checkpoint: Dict[str, Any]
+    rollups: Dict[str, Dict[str, Dict[str, Any]]]
+
+def _int(v: Any, default: int = 0) -> int:
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return default
+
+# === Migrations ===
+# Each step takes the DocPatch of the document being loaded and the seed
+# factory, and edits only through the patch.
+ID_LISTS = ("tasks", "punishments", "non_negotiables", "diary")
+
+def give_ids(p: DocPatch, seed: Callable[[], Document]) -> None:
+    """v1: every task, punishment, non-negotiable and diary entry gets an id;
+    bare punishment strings become {"id", "text"} (as schema.sql does in bulk)."""
+    for key in ID_LISTS:
+        for i, item in enumerate(p.doc.get(key) or []):
+            if isinstance(item, dict) and item.get("id"):
+                continue
+            fixed = dict(item) if isinstance(item, dict) else {"text": item}
+            fixed["id"] = new_id()
+            p.set((key, i), fixed)
+
+def fill_shape(p: DocPatch, seed: Callable[[], Document]) -> None:
+    """v2: the containers and counters handlers use exist with the right types."""
+    d, fresh = p.doc, seed()
+    for key, default in fresh.items():
+        if key == "schema_version":
+            continue
+        cur = d.get(key)
+        if key not in d or (isinstance(default, (list, dict)) and not isinstance(cur, type(default))):
+            p.set((key,), default)
+    for key in ("shop", "stats"):
+        for sub, default in fresh[key].items():
+            cur = d[key].get(sub)
+            if not isinstance(cur, type(default)):
+                p.set((key, sub), _int(cur, default) if isinstance(default, int) else default)
+    for sub, default in fresh["settings"].items():
+        if sub not in d["settings"]:
+            p.set(("settings", sub), default)
+    for name, sp in fresh["stat_progress"].items():
+        if not isinstance(d["stat_progress"].get(name), dict):
+            p.set(("stat_progress", name), sp)
+    for name, sp in d["stat_progress"].items():
+        fixed = {"level": max(1, _int(sp.get("level"), 1)), "xp": max(0, _int(sp.get("xp")))} \
+            if isinstance(sp, dict) else {"level": 1, "xp": 0}
+        if fixed != sp:
+            p.set(("stat_progress", name), fixed)
+    for key in ("streak", "best_streak"):
+        if not isinstance(d.get(key), int):
+            p.set((key,), _int(d.get(key)))
+    for i, task in enumerate(d["tasks"]):
+        fixed = dict(task)
+        fixed["coins"] = _int(task.get("coins"))
+        fixed["xp"] = _int(task.get("xp"))
+        fixed["stat"] = str(task.get("stat") or "discipline").strip().lower()
+        fixed["done"] = bool(task.get("done"))
+        if fixed != task:
+            p.set(("tasks", i), fixed)
+
+def clean_settings(p: DocPatch, seed: Callable[[], Document]) -> None:
+    """v3: drop the "op"/"id" keys that batched settings changes used to leave in settings."""
+    settings = p.doc.get("settings")
+    if isinstance(settings, dict):
+        for key in ("op", "id"):
+            if key in settings:
+                p.remove(("settings", key))
+
+MIGRATIONS: List[Tuple[int, Callable[[DocPatch, Callable[[], Document]], None]]] = [
+    (1, give_ids),
+    (2, fill_shape),
+    (3, clean_settings),
+]
+
+def migrate(p: DocPatch, seed: Callable[[], Document]) -> List[str]:
+    """Bring p.doc up to SCHEMA_VERSION. Returns the names of the steps run."""
+    current = _int(p.doc.get("schema_version"))
+    ran = []
+    for version, step in MIGRATIONS:
+        if version > current:
+            step(p, seed)
+            ran.append(step.__name__)
+    if current < SCHEMA_VERSION:
+        p.set(("schema_version",), SCHEMA_VERSION)
+    return ran
@@ -64,3 +64,147 @@ CREATE TABLE IF NOT EXISTS stat_progress (
   UNIQUE(player_id, stat_name)
 );
 
+-- player_data: the jsonb document store main.py reads and writes.
+-- version is bumped by every write and is what writers condition on (optimistic
+-- concurrency across uvicorn workers) and what the in-process cache probes.
+CREATE TABLE IF NOT EXISTS player_data (
+  id text PRIMARY KEY,
+  data jsonb NOT NULL DEFAULT '{}'::jsonb,
+  version bigint NOT NULL DEFAULT 0,
+  updated_at timestamptz NOT NULL DEFAULT now()
+);
+ALTER TABLE player_data ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
+ALTER TABLE player_data ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now();
+
+-- Delta writes: main.py sends only the edited paths instead of the whole document.
+-- p_ops is a JSON array of {"op": "set"|"append"|"remove", "path": [...], "value": ...}.
+-- With p_expected_version the patch only applies if the row is still at that
+-- version; otherwise NULL is returned and the caller re-reads and retries.
+-- Returns {"version": <new>, "updated_at": <ts>}.
+DROP FUNCTION IF EXISTS player_data_apply_patch(text, jsonb);
+CREATE OR REPLACE FUNCTION player_data_apply_patch(p_id text, p_ops jsonb, p_expected_version bigint DEFAULT NULL)
+RETURNS jsonb
+LANGUAGE plpgsql
+AS $$
+DECLARE
+  doc jsonb;
+  cur bigint;
+  op jsonb;
+  p text[];
+  stamp timestamptz := now();
+BEGIN
+  SELECT data, version INTO doc, cur FROM player_data WHERE id = p_id FOR UPDATE;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'player_data row % not found', p_id USING ERRCODE = 'P0002';
+  END IF;
+  IF p_expected_version IS NOT NULL AND cur <> p_expected_version THEN
+    RETURN NULL;
+  END IF;
+  FOR op IN SELECT * FROM jsonb_array_elements(p_ops) LOOP
+    p := ARRAY(SELECT jsonb_array_elements_text(op->'path'));
+    CASE op->>'op'
+      WHEN 'set' THEN
+        doc := jsonb_set(doc, p, op->'value', true);
+      WHEN 'append' THEN
+        doc := jsonb_set(doc, p, COALESCE(doc #> p, '[]'::jsonb) || jsonb_build_array(op->'value'), true);
+      WHEN 'remove' THEN
+        doc := doc #- p;
+      ELSE
+        RAISE EXCEPTION 'unknown patch op %', op->>'op';
+    END CASE;
+  END LOOP;
+  UPDATE player_data SET data = doc, version = cur + 1, updated_at = stamp WHERE id = p_id;
+  RETURN jsonb_build_object('version', cur + 1, 'updated_at', stamp);
+END;
+$$;
+
+-- Normalized storage (STORAGE_BACKEND=postgres): the tables above hold the
+-- lists, players.data keeps the rest of the document. external_id is the
+-- player key main.py looks rows up by; version is what writers condition on.
+-- extra holds item fields that have no column of their own.
+ALTER TABLE players ADD COLUMN IF NOT EXISTS external_id text UNIQUE;
+ALTER TABLE players ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS failed boolean DEFAULT false;
+ALTER TABLE tasks ADD COLUMN IF NOT EXISTS extra jsonb;
+ALTER TABLE non_negotiables ADD COLUMN IF NOT EXISTS modified timestamptz;
+ALTER TABLE non_negotiables ADD COLUMN IF NOT EXISTS extra jsonb;
+ALTER TABLE shop_items ADD COLUMN IF NOT EXISTS extra jsonb;
+ALTER TABLE diary ADD COLUMN IF NOT EXISTS extra jsonb;
+CREATE INDEX IF NOT EXISTS tasks_player ON tasks(player_id);
+CREATE INDEX IF NOT EXISTS diary_player ON diary(player_id);
+CREATE INDEX IF NOT EXISTS punishments_player ON punishments(player_id);
+CREATE INDEX IF NOT EXISTS non_negotiables_player ON non_negotiables(player_id);
+CREATE INDEX IF NOT EXISTS shop_items_player ON shop_items(player_id);
+ALTER TABLE punishments ADD COLUMN IF NOT EXISTS extra jsonb;
+
+-- Stable item ids: every task, punishment, non-negotiable and diary entry
+-- carries an "id" that endpoints address it by. This backfills ids in
+-- existing player_data rows (bare punishment strings become {"id", "text"});
+-- the server does the same lazily for any document it loads without them.
+CREATE OR REPLACE FUNCTION solo_with_ids(items jsonb)
+RETURNS jsonb
+LANGUAGE sql
+AS $$
+  SELECT coalesce(jsonb_agg(
+           CASE
+             WHEN jsonb_typeof(e) = 'object' AND coalesce(e->>'id', '') <> '' THEN e
+             WHEN jsonb_typeof(e) = 'object' THEN e || jsonb_build_object('id', substr(md5(random()::text || clock_timestamp()::text), 1, 12))
+             ELSE jsonb_build_object('id', substr(md5(random()::text || clock_timestamp()::text), 1, 12), 'text', e #>> '{}')
+           END ORDER BY ord), '[]'::jsonb)
+  FROM jsonb_array_elements(CASE WHEN jsonb_typeof(items) = 'array' THEN items ELSE '[]'::jsonb END)
+       WITH ORDINALITY AS t(e, ord)
+$$;
+
+UPDATE player_data p
+   SET data = m.data, version = p.version + 1, updated_at = now()
+  FROM (
+    SELECT id, data || jsonb_build_object(
+             'tasks', solo_with_ids(data->'tasks'),
+             'punishments', solo_with_ids(data->'punishments'),
+             'non_negotiables', solo_with_ids(data->'non_negotiables'),
+             'diary', solo_with_ids(data->'diary')) AS data
+      FROM player_data
+  ) m
+ WHERE p.id = m.id AND p.data IS DISTINCT FROM m.data;
+
+-- Diary archive (cold tier): entries older than DIARY_HOT_DAYS, or beyond the
+-- newest DIARY_HOT_MAX, move here out of the hot document (both the supabase
+-- and postgres backends). player_id is the app-level player id
+-- (player_data.id / players.external_id). /api/diary/search queries tsv.
+CREATE TABLE IF NOT EXISTS diary_archive (
+  player_id text NOT NULL,
+  id text NOT NULL,
+  entry text,
+  ts timestamptz,
+  extra jsonb,
+  tsv tsvector GENERATED ALWAYS AS (to_tsvector('simple', coalesce(entry, ''))) STORED,
+  PRIMARY KEY (player_id, id)
+);
+CREATE INDEX IF NOT EXISTS diary_archive_tsv ON diary_archive USING gin (tsv);
+CREATE INDEX IF NOT EXISTS diary_archive_ts ON diary_archive (player_id, ts DESC);
+
+-- Coin/XP ledger: append-only reward and spend entries. The hot ones live in
+-- the document ("ledger"; the ledger table for STORAGE_BACKEND=postgres);
+-- entries folded into the document's ledger_checkpoint move to
+-- ledger_archive, keyed by (player id, seq). /api/ledger pages through both.
+CREATE TABLE IF NOT EXISTS ledger (
+  id serial PRIMARY KEY,
+  player_id uuid REFERENCES players(id) ON DELETE CASCADE,
+  seq bigint,
+  ts timestamptz,
+  kind text,
+  ref text,
+  coins integer DEFAULT 0,
+  stat text,
+  xp integer DEFAULT 0,
+  tasks integer DEFAULT 0,
+  extra jsonb
+);
+CREATE INDEX IF NOT EXISTS ledger_player ON ledger(player_id);
+
+CREATE TABLE IF NOT EXISTS ledger_archive (
+  player_id text NOT NULL,
+  seq bigint NOT NULL,
+  entry jsonb NOT NULL,
+  PRIMARY KEY (player_id, seq)
+);
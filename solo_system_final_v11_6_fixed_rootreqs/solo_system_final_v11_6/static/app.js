@@ -1,7 +1,7 @@
 /* app.js - Solo System v5 (cleaned) */
 const VERSION = "v5";
 const API = (p)=>`/api${p}`;
-let STATE = { data:null, current:'main', notified:{} };
+let STATE = { data:null, current:'main', notified:{}, more:{} };
 
 function el(id){ return document.getElementById(id); }
 function setVh(){ document.documentElement.style.setProperty('--vh', (window.innerHeight * 0.01) + 'px'); }
@@ -11,6 +11,26 @@ setVh();
 
 async function apiGet(path){ const r = await fetch(API(path)); if(!r.ok) throw new Error('HTTP '+r.status); return r.json(); }
 async function apiPost(path, body){ const r = await fetch(API(path), { method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(body||{}) }); return r.json(); }
+// items with a stable id go through /<list>/<id>/<action>; the positional route is the fallback
+function itemPath(list, items, i, action){ const it = (items||[])[i]; return (it && it.id) ? '/'+list+'/'+encodeURIComponent(it.id)+'/'+action : '/'+list+'/'+action+'/'+i; }
+
+/* lean loading: the document without its long lists, then tasks/diary in newest-first pages */
+const PAGE = 30;
+const DOC_FIELDS = 'name,streak,best_streak,last_login,shop,non_negotiables,punishments,settings,stats,stat_progress,ongoing_punishments';
+async function loadPage(list, more){
+  const cur = more ? STATE.more[list] : null;
+  const r = await apiGet('/'+list+'?limit='+PAGE+(cur ? '&after='+encodeURIComponent(cur) : ''));
+  STATE.data[list] = more ? (STATE.data[list]||[]).concat(r[list]||[]) : (r[list]||[]);
+  STATE.more[list] = r.next;
+}
+function moreButton(list, render){ if(!STATE.more[list]) return null; const b = document.createElement('button'); b.className='btn mt12'; b.textContent='Load more'; b.onclick = async ()=>{ await loadPage(list, true); render(); }; return b; }
+// mutations answer with the changed item plus counters; patch STATE instead of reloading
+function applyCounters(r){ const d = STATE.data; if(!d || !r) return; if(r.coins !== undefined){ d.shop = d.shop||{}; d.shop.coins = r.coins; } if(r.tasks_completed !== undefined){ d.stats = d.stats||{}; d.stats.tasks_completed = r.tasks_completed; } if(r.stat_progress){ d.stat_progress = Object.assign(d.stat_progress||{}, r.stat_progress); } }
+function failed(r){ if(r && r.error){ alert(r.error); loadData(true); return true; } return false; }
+function rerender(){ setActive(STATE.current); }
+// by id, so applying a response and the matching server event twice is harmless
+function upsertItem(list, item, front){ const d = STATE.data; if(!d || !item || !Array.isArray(d[list])) return; const i = item.id ? d[list].findIndex(x=>x && x.id===item.id) : -1; if(i >= 0) d[list][i] = item; else if(front) d[list].unshift(item); else d[list].push(item); }
+function dropItem(list, id, i){ const items = STATE.data && STATE.data[list]; if(!Array.isArray(items)) return; const at = id ? items.findIndex(x=>x && x.id===id) : i; if(at >= 0 && at < items.length) items.splice(at, 1); }
 
 function setActive(view){
   STATE.current = view;
@@ -87,7 +107,7 @@ function renderTasks(){
   if(tasks.length===0){ const li=document.createElement('li'); li.textContent='No tasks yet'; ul.appendChild(li); }
   tasks.forEach((t,i)=>{ 
     const li = document.createElement('li'); li.id = 'task-'+i;
-    const title = document.createElement('div'); title.innerHTML = (t.done? '✅ ' : '⬜ ') + '<strong>'+t.task+'</strong>' + (t.deadline? ' ' + fmtDeadline(t.deadline):'');
+    const title = document.createElement('div'); title.innerHTML = (t.done? '✅ ' : (t.failed? '❌ ' : '⬜ ')) + '<strong>'+t.task+'</strong>' + (t.deadline? ' ' + fmtDeadline(t.deadline):'');
     li.appendChild(title);
     const meta = document.createElement('div'); meta.className='muted'; meta.textContent = 'coins:'+ (t.coins||0) + ' xp:'+ (t.xp||0) + ' → ' + (t.stat||'discipline');
     li.appendChild(meta);
@@ -100,6 +120,7 @@ function renderTasks(){
     ul.appendChild(li);
   });
   root.appendChild(ul);
+  const more = moreButton('tasks', renderTasks); if(more) root.appendChild(more);
 }
 
 function renderNonneg(){
@@ -132,8 +153,10 @@ function startEditNon(i){
 async function saveEditNon(i){
   const val = document.getElementById('edit-'+i).value.trim();
   if(!val) return alert('Empty');
-  await apiPost('/nonneg/edit/'+i, {rule: val});
-  await loadData(true);
+  const r = await apiPost(itemPath('nonneg', STATE.data.non_negotiables, i, 'edit'), {rule: val});
+  if(failed(r)) return;
+  upsertItem('non_negotiables', r.item);
+  rerender();
 }
 
 async function renderShop(){
@@ -157,8 +180,10 @@ function renderDiary(){
   const btn = document.createElement('button'); btn.className='btn'; btn.textContent='Add'; btn.onclick = addDiary;
   row.appendChild(inp); row.appendChild(btn); root.appendChild(row);
   const ul = document.createElement('ul'); ul.className='list';
+  if(!Array.isArray(d.diary)){ loadPage('diary').then(renderDiary).catch(console.error); }
   (d.diary||[]).forEach(e=>{ const li=document.createElement('li'); li.textContent = (e.ts||'') + ' — ' + e.text; ul.appendChild(li); });
   root.appendChild(ul);
+  const more = moreButton('diary', renderDiary); if(more) root.appendChild(more);
 }
 
 function renderStats(){
@@ -213,15 +238,17 @@ function renderSettings(){
   const pinp = document.createElement('input'); pinp.id='punishmentInput'; pinp.className='input'; pinp.placeholder='Add a punishment (e.g. 10m cold shower)';
   const pbtn = document.createElement('button'); pbtn.className='btn'; pbtn.textContent='Add'; pbtn.onclick = addPunishment;
   prow.appendChild(pinp); prow.appendChild(pbtn); root.appendChild(prow);
-  const pul = document.createElement('ul'); pul.className='list'; (STATE.data.punishments||[]).forEach((p,idx)=>{ const li=document.createElement('li'); li.textContent = p + ' '; const db=document.createElement('button'); db.className='btn'; db.textContent='Delete'; db.onclick = ()=>deletePunishment(idx); li.appendChild(db); pul.appendChild(li); }); root.appendChild(pul);
+  const pul = document.createElement('ul'); pul.className='list'; (STATE.data.punishments||[]).forEach((p,idx)=>{ const li=document.createElement('li'); li.textContent = (p && p.text !== undefined ? p.text : p) + ' '; const db=document.createElement('button'); db.className='btn'; db.textContent='Delete'; db.onclick = ()=>deletePunishment(idx); li.appendChild(db); pul.appendChild(li); }); root.appendChild(pul);
 }
 
 /* CRUD + helpers */
 async function loadData(force=false){
   try {
     await apiPost('/ping').catch(()=>{});
-    const r = await apiGet('/data');
+    const r = await apiGet('/data?fields='+DOC_FIELDS);
     STATE.data = r.data;
+    await loadPage('tasks');
+    STATE.data.diary = null;  // fetched when the diary view opens
 
     const greet = el('greet');
     if (STATE.data.name) {
@@ -230,7 +257,6 @@ async function loadData(force=false){
       greet.innerHTML = '<input id="nameInline" class="input" placeholder="Enter your name (optional)" style="width:160px;display:inline-block;vertical-align:middle"> <button class="btn" onclick="saveName()">Save</button>';
     }
 
-    checkOverdue();
     setActive(STATE.current);   // <-- forces re-render current panel
     return STATE.data;
   } catch (e) {
@@ -242,62 +268,34 @@ async function loadData(force=false){
 
 async function saveName(){ const eln = document.getElementById('nameInline'); const val = eln ? eln.value.trim() : ''; await apiPost('/name', {name: val}); await loadData(true); }
 
-async function addTask(){ const ti = document.getElementById('newTask'); const di = document.getElementById('newDeadline'); if(!ti) return; const t = ti.value.trim(); let dl_raw = di ? di.value.trim() : ''; let dl = dl_raw; if(dl && dl.indexOf('T')===-1 && dl.indexOf(' ')!==-1) dl = dl.replace(' ','T'); if(!t) return; const coins = parseInt(document.getElementById('newCoins').value) || 5; const xp = parseInt(document.getElementById('newXp').value) || 0; const stat = document.getElementById('newStat').value || 'discipline'; await apiPost('/tasks/add', {task:t, deadline:dl, coins: coins, xp: xp, stat: stat}); if(ti) ti.value=''; if(di) di.value=''; const nc = document.getElementById('newCoins'); if(nc) nc.value=''; const nx = document.getElementById('newXp'); if(nx) nx.value=''; await loadData(true); }
-async function toggleTask(i){ await apiPost('/tasks/toggle/'+i); await loadData(true); }
+async function addTask(){ const ti = document.getElementById('newTask'); const di = document.getElementById('newDeadline'); if(!ti) return; const t = ti.value.trim(); let dl_raw = di ? di.value.trim() : ''; let dl = dl_raw; if(dl && dl.indexOf('T')===-1 && dl.indexOf(' ')!==-1) dl = dl.replace(' ','T'); if(!t) return; const coins = parseInt(document.getElementById('newCoins').value) || 5; const xp = parseInt(document.getElementById('newXp').value) || 0; const stat = document.getElementById('newStat').value || 'discipline'; const r = await apiPost('/tasks/add', {task:t, deadline:dl, coins: coins, xp: xp, stat: stat}); if(failed(r)) return; upsertItem('tasks', r.task, true); if(ti) ti.value=''; if(di) di.value=''; const nc = document.getElementById('newCoins'); if(nc) nc.value=''; const nx = document.getElementById('newXp'); if(nx) nx.value=''; rerender(); }
+async function toggleTask(i){ const r = await apiPost(itemPath('tasks', STATE.data.tasks, i, 'toggle')); if(failed(r)) return; upsertItem('tasks', r.task); applyCounters(r); rerender(); }
 function startEditTask(i){ const t = STATE.data.tasks[i]; const li = document.getElementById('task-'+i); if(!li) return; li.innerHTML=''; const row = document.createElement('div'); row.className='row'; row.style.flexDirection='column'; const itask = document.createElement('input'); itask.className='input'; itask.id='edit-task-'+i; itask.value = t.task; const idl = document.createElement('input'); idl.className='input'; idl.id='edit-deadline-'+i; idl.value = t.deadline || ''; const actionRow = document.createElement('div'); actionRow.className='row mt12'; const icoins = document.createElement('input'); icoins.className='input'; icoins.id='edit-coins-'+i; icoins.style.width='100px'; icoins.value = t.coins||0; const ixp = document.createElement('input'); ixp.className='input'; ixp.id='edit-xp-'+i; ixp.style.width='100px'; ixp.value = t.xp||0; const istat = document.createElement('select'); istat.className='input'; istat.id='edit-stat-'+i; istat.style.width='160px'; ['discipline','strength','intelligence','spirituality'].forEach(s=>{ const o=document.createElement('option'); o.value=s; o.textContent = s; istat.appendChild(o); }); istat.value = t.stat || 'discipline'; const save = document.createElement('button'); save.className='btn'; save.textContent='Save'; save.onclick = ()=>saveEditTask(i); const cancel = document.createElement('button'); cancel.className='btn'; cancel.textContent='Cancel'; cancel.onclick = ()=>loadData(true); actionRow.appendChild(icoins); actionRow.appendChild(ixp); actionRow.appendChild(istat); actionRow.appendChild(save); actionRow.appendChild(cancel); row.appendChild(itask); row.appendChild(idl); row.appendChild(actionRow); li.appendChild(row); }
 
 async function saveEditTask(i){ const task = document.getElementById('edit-task-'+i).value.trim(); const dl = document.getElementById('edit-deadline-'+i).value.trim(); const coins = parseInt(document.getElementById('edit-coins-'+i).value) || 0; const xp = parseInt(document.getElementById('edit-xp-'+i).value) || 0; const stat = document.getElementById('edit-stat-'+i).value || 'discipline'; await apiPost('/tasks/edit/'+i, {task:task, deadline: dl, coins: coins, xp: xp, stat: stat}); await loadData(true); }
-async function deleteTask(i){ if(!confirm('Delete task?')) return; await apiPost('/tasks/delete/'+i); await loadData(true); }
+async function deleteTask(i){ if(!confirm('Delete task?')) return; const t = STATE.data.tasks[i]; const r = await apiPost(itemPath('tasks', STATE.data.tasks, i, 'delete')); if(failed(r)) return; dropItem('tasks', t && t.id, i); rerender(); }
 
-async function addNon(){ const inp = document.getElementById('nnText'); const rule = inp ? inp.value.trim() : ''; if(!rule) return; await apiPost('/nonneg/add', {rule}); if(inp) inp.value=''; await loadData(true); }
-async function delNon(i){ if(!confirm('Delete this non-negotiable?')) return; await apiPost('/nonneg/delete/'+i); await loadData(true); }
+async function addNon(){ const inp = document.getElementById('nnText'); const rule = inp ? inp.value.trim() : ''; if(!rule) return; const r = await apiPost('/nonneg/add', {rule}); if(failed(r)) return; STATE.data.non_negotiables = STATE.data.non_negotiables||[]; upsertItem('non_negotiables', r.item); if(inp) inp.value=''; rerender(); }
+async function delNon(i){ if(!confirm('Delete this non-negotiable?')) return; const n = STATE.data.non_negotiables[i]; const r = await apiPost(itemPath('nonneg', STATE.data.non_negotiables, i, 'delete')); if(failed(r)) return; dropItem('non_negotiables', n && n.id, i); rerender(); }
 
-async function buy(id){ const r = await apiPost('/shop/buy/'+id); if(r.error) alert(r.error); await loadData(true); }
-async function addDiary(){ const txtEl = document.getElementById('diaryText'); const txt = txtEl ? txtEl.value.trim() : ''; if(!txt) return; await apiPost('/diary/add', {entry: txt}); if(txtEl) txtEl.value = ''; await loadData(true); }
-async function saveSettings(){ const soundsEl = document.getElementById('setSounds'); const sounds = soundsEl ? soundsEl.checked : false; await apiPost('/settings', {settings:{sounds}}); await loadData(true); alert('Saved'); }
+async function buy(id){ const r = await apiPost('/shop/buy/'+id); if(failed(r)) return; Object.assign(STATE.data.shop, r.shop); upsertItem('tasks', r.task); rerender(); }
+async function addDiary(){ const txtEl = document.getElementById('diaryText'); const txt = txtEl ? txtEl.value.trim() : ''; if(!txt) return; const r = await apiPost('/diary/add', {entry: txt}); if(failed(r)) return; upsertItem('diary', r.entry, true); if(txtEl) txtEl.value = ''; rerender(); }
+async function saveSettings(){ const soundsEl = document.getElementById('setSounds'); const sounds = soundsEl ? soundsEl.checked : false; const r = await apiPost('/settings', {settings:{sounds}}); if(failed(r)) return; STATE.data.settings = r.settings; rerender(); alert('Saved'); }
 async function resetAll(){ if(!confirm('Reset all data to defaults? This cannot be undone.')) return; await apiPost('/reset'); await loadData(true); alert('Reset complete'); }
 
-async function addPunishment(){ const txtEl = document.getElementById('punishmentInput'); const txt = txtEl ? txtEl.value.trim() : ''; if(!txt) return alert('Enter a punishment'); await apiPost('/punishments/add', {punishment: txt}); if(txtEl) txtEl.value=''; await loadData(true); }
-async function deletePunishment(idx){ if(!confirm('Delete punishment?')) return; await apiPost('/punishments/delete/'+idx); await loadData(true); }
-
-/* overdue check & notification modal */
-async function checkOverdue(){
-  try {
-    const tasks = (STATE.data && Array.isArray(STATE.data.tasks)) ? STATE.data.tasks : [];
-    const now = Date.now();
-    for (let t of tasks) {
-      if (!t || !t.deadline) continue;
-      if (t.__overdueNotified) continue; // don’t repeat
-
-      let d = Date.parse(t.deadline);
-      if (isNaN(d)) continue;
-
-      if (d < now) {
-        t.__overdueNotified = true;
-
-        // Pick a punishment (if any)
-        let punishmentText = "";
-        if (STATE.data && Array.isArray(STATE.data.punishments) && STATE.data.punishments.length > 0) {
-          const randomIndex = Math.floor(Math.random() * STATE.data.punishments.length);
-          const chosen = STATE.data.punishments[randomIndex];
-          punishmentText = `  Your punishment is: ${chosen}`;
-        }
-
-        // Show custom modal
-        showNotification(
-          "Missed deadline!",
-          `You missed the task: ${t.task || "Unnamed Task"}${punishmentText}`
-        );
-
-        // Optionally inform backend
-        if (typeof apiPost === 'function' && t.id !== undefined) {
-          try { await apiPost('/tasks/mark_overdue/' + t.id); } catch(e) {}
-        }
-      }
-    }
-  } catch(e) {
-    console.error("Overdue check failed:", e);
-  }
+async function addPunishment(){ const txtEl = document.getElementById('punishmentInput'); const txt = txtEl ? txtEl.value.trim() : ''; if(!txt) return alert('Enter a punishment'); const r = await apiPost('/punishments/add', {punishment: txt}); if(failed(r)) return; STATE.data.punishments = STATE.data.punishments||[]; upsertItem('punishments', r.punishment); if(txtEl) txtEl.value=''; rerender(); }
+async function deletePunishment(idx){ if(!confirm('Delete punishment?')) return; const pn = STATE.data.punishments[idx]; const r = await apiPost(itemPath('punishments', STATE.data.punishments, idx, 'delete')); if(failed(r)) return; dropItem('punishments', pn && pn.id, idx); rerender(); }
+
+/* missed deadlines: the server marks overdue tasks failed and draws the
+   punishment (see the deadline scheduler in main.py); this just tells the user */
+function notifyFailed(r){
+  (r.tasks||[]).forEach(t=>upsertItem('tasks', t));
+  const fired = r.punishments||[];
+  if(fired.length) STATE.data.ongoing_punishments = (STATE.data.ongoing_punishments||[]).concat(fired);
+  (r.tasks||[]).forEach(t=>{
+    const p = fired.find(x=>x.task===t.id);
+    showNotification("Missed deadline!", `You missed the task: ${t.task || "Unnamed Task"}` + (p ? `  Your punishment is: ${p.text}` : ''));
+  });
 }
 
 
@@ -349,6 +347,52 @@ async function resetAll(){
 }
 
 
+/* live updates: the server pushes change events (/api/events, SSE), so other
+   tabs and devices stay in sync without polling; EventSource reconnects and
+   resumes from the last event id on its own */
+const EVENT_HANDLERS = {
+  'task.added': r=>upsertItem('tasks', r.task, true),
+  'task.toggled': r=>{ upsertItem('tasks', r.task); applyCounters(r); },
+  'task.deleted': r=>dropItem('tasks', r.id),
+  'punishment.added': r=>upsertItem('punishments', r.punishment),
+  'punishment.deleted': r=>dropItem('punishments', r.id),
+  'nonneg.added': r=>upsertItem('non_negotiables', r.item),
+  'nonneg.edited': r=>upsertItem('non_negotiables', r.item),
+  'nonneg.deleted': r=>dropItem('non_negotiables', r.id),
+  'diary.added': r=>upsertItem('diary', r.entry, true),
+  'diary.archived': r=>(r.ids||[]).forEach(id=>dropItem('diary', id)),
+  'shop.bought': r=>{ Object.assign(STATE.data.shop, r.shop); upsertItem('tasks', r.task); },
+  'settings.changed': r=>{ STATE.data.settings = r.settings; },
+  'streak.updated': r=>{ STATE.data.streak = r.streak; if(r.shop) STATE.data.shop = r.shop; if(r.ongoing_punishments) STATE.data.ongoing_punishments = r.ongoing_punishments; if(r.punishment) showNotification('Missed a day!', 'Your punishment is: '+r.punishment); },
+  'tasks.failed': notifyFailed,
+  'batch': r=>(r.results||[]).forEach(x=>{ const h = EVENT_HANDLERS[x.event]; if(h) h(x); }),
+  'reset': ()=>loadData(true),
+  'import.done': ()=>loadData(true),
+  'resync': ()=>loadData(true),
+};
+function connectEvents(){
+  if(!window.EventSource) return;
+  const es = new EventSource(API('/events'));
+  Object.keys(EVENT_HANDLERS).forEach(type=>es.addEventListener(type, async ev=>{
+    if(!STATE.data) return;
+    try { await EVENT_HANDLERS[type](JSON.parse(ev.data || '{}')); } catch(e){ console.error('event '+type, e); return; }
+    // don't wipe what the user is typing; their next action re-renders
+    const a = document.activeElement; if(a && (a.tagName === 'INPUT' || a.tagName === 'TEXTAREA')) return;
+    rerender();
+  }));
+}
+
+/* offline edits: the service worker answers {queued:true} and replays them
+   through /api/batch when we're back; reload once it has */
+function bindOutbox(){
+  window.addEventListener('online', ()=>{ const sw = navigator.serviceWorker.controller; if(sw) sw.postMessage({type:'replay'}); });
+  navigator.serviceWorker.addEventListener('message', ev=>{
+    const m = ev.data || {};
+    if(m.type === 'outbox-replayed') loadData(true);
+    if(m.type === 'outbox-rejected') alert('Offline changes could not be applied: '+m.error);
+  });
+}
+
 /* init wrapper with fallback so UI never locks */
 (function(){
   const FALLBACK_MS = 9000;
@@ -358,9 +402,11 @@ async function resetAll(){
     try {
       bindDock();
       if (typeof loadData === 'function') await loadData();
+      connectEvents();
       // register service worker safely (non-blocking)
       if ('serviceWorker' in navigator) {
         navigator.serviceWorker.register('/sw.js?v'+VERSION).catch(()=>{});
+        bindOutbox();
       }
       done = true;
       clearTimeout(to);
@@ -374,9 +420,6 @@ async function resetAll(){
   else document.addEventListener('DOMContentLoaded', safeInit);
 })();
 
-/* periodic overdue checks */
-setInterval(()=>{ try{ checkOverdue(); }catch(e){} }, 30000);
-
 /* gentle fallback: hide stuck OK after 8s (does NOT simulate click) */
 window.addEventListener('load', ()=> {
   setTimeout(()=> {
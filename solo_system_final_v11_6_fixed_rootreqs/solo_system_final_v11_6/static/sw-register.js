@@ -5,7 +5,7 @@ if ('serviceWorker' in navigator) {
       for (const r of regs) {
         try { await r.unregister(); } catch(e) {}
       }
-      await navigator.serviceWorker.register('/sw.js?v11.7');
+      await navigator.serviceWorker.register('/sw.js');
     } catch (err) {
       console.error('Service Worker registration failed:', err);
     }
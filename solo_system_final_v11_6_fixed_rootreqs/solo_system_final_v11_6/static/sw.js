@@ -1,15 +1,18 @@
 'use strict';
-const CACHE_NAME = "solo-cache-v11.7";
+/* assets.py rewrites this file into static/dist: CACHE_NAME gets the build's
+   version and the /static/ links below become content-hashed names. */
+const CACHE_NAME = "solo-cache-dev";
 const ASSETS = [
   "/",
-  "/static/index.html?v11.7",
-  "/static/styles.css?v11.7",
-  "/static/app.js?v11.7",
-  "/static/sw-register.js?v11.7",
+  "/static/styles.css",
+  "/static/app.js",
+  "/static/sw-register.js",
   "/static/manifest.json",
   "/static/icon-192.svg",
   "/static/icon-512.svg"
 ];
+// content-hashed names (app.3f2a9c1d04.js) never change; serve them from the cache
+const HASHED = /^\/static\/.+\.[0-9a-f]{10}\.[a-z0-9]+$/;
 
 self.addEventListener("install", event => {
   event.waitUntil(
@@ -29,9 +32,145 @@ self.addEventListener("activate", event => {
   self.clients.claim();
 });
 
+/* offline outbox: mutations that can't reach the server are kept in
+   IndexedDB as /api/batch ops and replayed in one request per player once
+   we're back online (background sync, the page's 'online' event, or the
+   next API call). Only id-based routes are queued; positions go stale. */
+const OUTBOX_DB = "solo-outbox";
+const OUTBOX_TAG = "solo-outbox";
+const OUTBOX_ROUTES = [
+  [/^\/api\/tasks\/add$/, (m, b) => ({ ...b, op: 'task.add' })],
+  [/^\/api\/tasks\/([^/]+)\/toggle$/, m => ({ op: 'task.toggle', id: decodeURIComponent(m[1]) })],
+  [/^\/api\/tasks\/([^/]+)\/delete$/, m => ({ op: 'task.delete', id: decodeURIComponent(m[1]) })],
+  [/^\/api\/punishments\/add$/, (m, b) => ({ ...b, op: 'punishment.add' })],
+  [/^\/api\/punishments\/([^/]+)\/delete$/, m => ({ op: 'punishment.delete', id: decodeURIComponent(m[1]) })],
+  [/^\/api\/nonneg\/([^/]+)\/edit$/, (m, b) => ({ ...b, op: 'nonneg.edit', id: decodeURIComponent(m[1]) })],
+  [/^\/api\/diary\/add$/, (m, b) => ({ ...b, op: 'diary.add' })],
+  [/^\/api\/shop\/buy\/(\d+)$/, m => ({ op: 'shop.buy', id: Number(m[1]) })],
+  [/^\/api\/settings$/, (m, b) => ({ op: 'settings', settings: b.settings || b })],
+];
+
+function outboxOp(url, body){
+  const m = /^(\/p\/[^/]+)?(\/api\/.*)$/.exec(new URL(url).pathname);
+  if (!m) return null;
+  for (const [re, build] of OUTBOX_ROUTES) {
+    const r = re.exec(m[2]);
+    if (r) return { prefix: m[1] || '', op: build(r, body || {}) };
+  }
+  return null;
+}
+
+function outboxDb(){
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(OUTBOX_DB, 1);
+    req.onupgradeneeded = () => req.result.createObjectStore('ops', { autoIncrement: true });
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function outboxTx(mode, fn){
+  const db = await outboxDb();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction('ops', mode);
+    const out = fn(tx.objectStore('ops'));
+    tx.oncomplete = () => resolve(out && 'result' in out ? out.result : undefined);
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+async function outboxPending(){
+  const entries = [];
+  await outboxTx('readonly', store => {
+    store.openCursor().onsuccess = ev => {
+      const cur = ev.target.result;
+      if (cur) { entries.push({ key: cur.key, ...cur.value }); cur.continue(); }
+    };
+  });
+  return entries;
+}
+
+async function notifyClients(msg){
+  const all = await self.clients.matchAll({ includeUncontrolled: true });
+  all.forEach(c => c.postMessage(msg));
+}
+
+let replaying = null;
+function replayOutbox(){
+  // one replay at a time; callers queue behind the running one
+  replaying = (replaying || Promise.resolve()).then(async () => {
+    const entries = await outboxPending().catch(() => []);
+    let sent = 0;
+    while (entries.length) {
+      // consecutive ops of one player go in one batch, in the order they were made
+      const prefix = entries[0].prefix;
+      let n = 0;
+      while (n < entries.length && entries[n].prefix === prefix) n++;
+      const group = entries.splice(0, n);
+      let res;
+      try {
+        res = await fetch(prefix + '/api/batch', {
+          method: 'POST', credentials: 'same-origin',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({ ops: group.map(e => e.op) }),
+        });
+      } catch (e) {
+        break; // still offline; keep everything for the next attempt
+      }
+      if (res.status >= 500) break;
+      // applied, or rejected as a whole (e.g. the item was deleted elsewhere):
+      // either way replaying it again won't change the outcome
+      await outboxTx('readwrite', store => group.forEach(e => store.delete(e.key)));
+      sent += group.length;
+      if (!res.ok) {
+        const err = await res.json().catch(() => ({}));
+        await notifyClients({ type: 'outbox-rejected', error: err.error || ('HTTP ' + res.status), dropped: group.length });
+      }
+    }
+    if (sent) await notifyClients({ type: 'outbox-replayed', count: sent });
+  }).catch(() => {});
+  return replaying;
+}
+
+async function sendMutation(request){
+  const body = await request.clone().text();
+  await replayOutbox(); // earlier offline edits go first
+  try {
+    return await fetch(request);
+  } catch (err) {
+    let parsed = {};
+    try { parsed = body ? JSON.parse(body) : {}; } catch (e) { /* not JSON */ }
+    const queued = outboxOp(request.url, parsed);
+    if (!queued) return new Response(JSON.stringify({ error: 'Offline' }), { status: 503, headers: { 'Content-Type': 'application/json' } });
+    await outboxTx('readwrite', store => store.add(queued));
+    if (self.registration.sync) self.registration.sync.register(OUTBOX_TAG).catch(() => {});
+    return new Response(JSON.stringify({ queued: true }), { status: 202, headers: { 'Content-Type': 'application/json' } });
+  }
+}
+
+self.addEventListener("sync", event => {
+  if (event.tag === OUTBOX_TAG) event.waitUntil(replayOutbox());
+});
+
+self.addEventListener("message", event => {
+  if (event.data && event.data.type === 'replay') event.waitUntil(replayOutbox());
+});
+
 // Safe fetch handler using async/await and a single clone
 self.addEventListener("fetch", event => {
+  // only mutations the outbox can queue; anything else (/api/import uploads,
+  // /api/batch, ...) goes to the network untouched
+  if (event.request.method === 'POST' && outboxOp(event.request.url)) {
+    event.respondWith(sendMutation(event.request));
+    return;
+  }
   if (event.request.method !== 'GET') return;
+  // the event stream never ends; let it go straight to the network
+  if (new URL(event.request.url).pathname.endsWith('/api/events')) return;
+  if (HASHED.test(new URL(event.request.url).pathname)) {
+    event.respondWith(caches.match(event.request).then(cached => cached || fetch(event.request)));
+    return;
+  }
   event.respondWith((async () => {
     try {
       const networkResponse = await fetch(event.request);
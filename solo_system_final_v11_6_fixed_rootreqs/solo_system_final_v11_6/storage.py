@@ -0,0 +1,2021 @@
+# storage.py — Solo System persistence backends
+#
+# main.py talks to one Storage object; which one is picked by STORAGE_BACKEND:
+#   supabase  each player document as one jsonb row in player_data (PostgREST)
+#   postgres  the normalized tables from schema.sql, via asyncpg (DATABASE_URL)
+#   sqlite    the same normalized layout in a local WAL-mode file (SQLITE_PATH)
+#
+# Each player is its own document, keyed by a player id and seeded on first
+# load. Every backend loads/saves the same document shape. Writes carry the
+# DocPatch ops of the edit, so row backends can touch only the rows an edit
+# changed, and an expected version, so concurrent writers get WriteConflict
+# instead of silently overwriting each other.
+
+import os
+import re
+import json
+import uuid
+import asyncio
+import sqlite3
+import logging
+import time
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import Optional, Any, AsyncIterator, Callable, Deque, Dict, List, Set, Tuple
+
+import httpx
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-worker dev setups, no cross-process replay lock
+    fcntl = None
+
+import codec
+from metrics import span, STORAGE_BYTES, STORAGE_ERRORS, STORAGE_FALLBACKS, STORAGE_WRITES
+
+log = logging.getLogger("solo.storage")
+
+Doc = Dict[str, Any]
+Ops = Optional[List[Dict[str, Any]]]
+Seed = Callable[[], Doc]
+
+def utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+class WriteConflict(Exception):
+    """The stored version moved since we read it (another worker wrote)."""
+
+class StorageUnavailable(RuntimeError):
+    """The backend can't be reached and there is no local copy to fall back on."""
+
+class CircuitOpen(httpx.TransportError):
+    """Refused without a request: the circuit breaker is open. A transport
+    error, so every caller that copes with a dropped connection copes with it."""
+
+def new_id() -> str:
+    """Stable id for a list item (task, punishment, non-negotiable, diary entry)."""
+    return uuid.uuid4().hex[:12]
+
+# === Document patches (delta writes) ===
+# Handlers record their edits in a DocPatch; backends receive just those ops.
+# An op is {"op": "set"|"append"|"remove", "path": [str, ...], "value": ...}.
+PatchPath = Tuple[Any, ...]
+
+class ItemIndex:
+    """id -> list position for the top-level lists of one document.
+
+    Built lazily per list and kept up to date by DocPatch: appends extend it,
+    anything that can shift positions drops that list's map. Lookups verify
+    the hit, so an edit made behind its back costs a rebuild, not a wrong item.
+    """
+
+    def __init__(self):
+        self.doc: Optional[Doc] = None
+        self.maps: Dict[str, Dict[Any, int]] = {}
+
+    def bind(self, doc: Doc) -> None:
+        if doc is not self.doc:
+            self.doc = doc
+            self.maps = {}
+
+    def _build(self, key: str) -> Dict[Any, int]:
+        items = (self.doc or {}).get(key) or []
+        m = self.maps[key] = {it.get("id"): i for i, it in enumerate(items) if isinstance(it, dict)}
+        return m
+
+    def position(self, key: str, item_id: Any) -> Optional[int]:
+        items = (self.doc or {}).get(key) or []
+        m = self.maps.get(key)
+        for attempt in (0, 1):
+            if m is None or attempt:
+                m = self._build(key)
+            i = m.get(item_id)
+            if i is not None and i < len(items) and isinstance(items[i], dict) and items[i].get("id") == item_id:
+                return i
+        return None
+
+    def appended(self, key: str, item: Any, pos: int) -> None:
+        m = self.maps.get(key)
+        if m is not None and isinstance(item, dict):
+            m[item.get("id")] = pos
+
+    def changed(self, key: str) -> None:
+        self.maps.pop(key, None)
+
+_MISSING = object()
+
+def _restorer(node: Any, key: Any) -> Callable[[], None]:
+    """Undo step putting node[key] back the way it is now (absent included)."""
+    old = node.get(key, _MISSING) if isinstance(node, dict) else node[key]
+
+    def undo() -> None:
+        if old is _MISSING:
+            node.pop(key, None)
+        else:
+            node[key] = old
+    return undo
+
+class DocPatch:
+    """Applies edits to a document in place and records them as patch ops.
+
+    Every edit also pushes an undo step, so rollback() can return the
+    document to an earlier savepoint() (a batch that fails half-way).
+    """
+
+    def __init__(self, doc: Doc, index: Optional[ItemIndex] = None):
+        self.doc = doc
+        self.ops: List[Dict[str, Any]] = []
+        self.full = False  # document replaced wholesale; ops are meaningless
+        self.index = index or ItemIndex()
+        self.index.bind(doc)
+        self._undo: List[Callable[[], None]] = []
+
+    def _record(self, op: str, path: PatchPath, value: Any = None) -> None:
+        entry: Dict[str, Any] = {"op": op, "path": [str(k) for k in path]}
+        if op != "remove":
+            entry["value"] = value
+        self.ops.append(entry)
+
+    def _parent(self, path: PatchPath) -> Any:
+        # Create missing dict containers (and record them): jsonb_set only
+        # creates the last path element, so a missing parent would be a no-op.
+        node: Any = self.doc
+        for i, key in enumerate(path[:-1]):
+            if isinstance(node, dict) and not isinstance(node.get(key), (dict, list)):
+                self._undo.append(_restorer(node, key))
+                node[key] = {}
+                self._record("set", path[: i + 1], {})
+            node = node[key]
+        return node
+
+    def get(self, path: PatchPath, default: Any = None) -> Any:
+        node: Any = self.doc
+        for key in path:
+            try:
+                node = node[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+        return default if node is None else node
+
+    def find(self, key: str, item_id: Any) -> Optional[int]:
+        """Position of the item with `item_id` in list `key`, or None."""
+        return self.index.position(key, item_id)
+
+    def set(self, path: PatchPath, value: Any) -> Any:
+        parent = self._parent(path)
+        self._undo.append(_restorer(parent, path[-1]))
+        parent[path[-1]] = value
+        self._record("set", path, value)
+        if len(path) <= 2:
+            self.index.changed(str(path[0]))
+        return value
+
+    def append(self, path: PatchPath, value: Any) -> Any:
+        parent = self._parent(path)
+        if not isinstance(parent.get(path[-1]), list):
+            self._undo.append(_restorer(parent, path[-1]))
+            parent[path[-1]] = []
+        items = parent[path[-1]]
+        items.append(value)
+        self._undo.append(items.pop)
+        self._record("append", path, value)
+        if len(path) == 1:
+            self.index.appended(str(path[0]), value, len(parent[path[-1]]) - 1)
+        return value
+
+    def remove(self, path: PatchPath) -> Any:
+        parent = self._parent(path)
+        removed = parent.pop(path[-1])
+        if isinstance(parent, list):
+            self._undo.append(lambda: parent.insert(path[-1], removed))
+        else:
+            self._undo.append(lambda: parent.__setitem__(path[-1], removed))
+        self._record("remove", path)
+        if len(path) <= 2:
+            self.index.changed(str(path[0]))
+        return removed
+
+    def replace(self, new_doc: Doc) -> Doc:
+        # in place, so the cached object (and anyone holding it) sees the reset
+        old_doc, old_ops, old_full = dict(self.doc), self.ops, self.full
+
+        def undo() -> None:
+            self.doc.clear()
+            self.doc.update(old_doc)
+            self.ops, self.full = old_ops, old_full
+        self._undo.append(undo)
+        self.doc.clear()
+        self.doc.update(new_doc)
+        self.full = True
+        self.ops = []
+        self.index.maps = {}
+        return self.doc
+
+    def savepoint(self) -> Tuple[int, int, bool]:
+        return len(self.ops), len(self._undo), self.full
+
+    def rollback(self, mark: Tuple[int, int, bool] = (0, 0, False)) -> None:
+        """Undo every edit made since `mark` (by default, all of them)."""
+        n_ops, n_undo, full = mark
+        while len(self._undo) > n_undo:
+            self._undo.pop()()
+        del self.ops[n_ops:]
+        self.full = full
+        self.index.maps = {}
+
+    @property
+    def changes(self) -> Ops:
+        """What Storage.write() should get: the ops, or None for a full write."""
+        return None if self.full else self.ops
+
+def apply_ops(doc: Doc, ops: List[Dict[str, Any]]) -> Doc:
+    """Replay recorded ops on `doc` in place, the way player_data_apply_patch does."""
+    for op in ops:
+        path = op["path"]
+        node: Any = doc
+        for k in path[:-1]:
+            k = int(k) if isinstance(node, list) else k
+            if isinstance(node, dict) and not isinstance(node.get(k), (dict, list)):
+                node[k] = {}
+            node = node[k]
+        last = int(path[-1]) if isinstance(node, list) else path[-1]
+        if op["op"] == "set":
+            if isinstance(node, list) and last >= len(node):
+                node.append(op["value"])
+            else:
+                node[last] = op["value"]
+        elif op["op"] == "append":
+            if not isinstance(node[last] if isinstance(node, list) else node.get(last), list):
+                node[last] = []
+            node[last].append(op["value"])
+        elif op["op"] == "remove":
+            try:
+                node.pop(last)
+            except (KeyError, IndexError):
+                pass
+    return doc
+
+# === Interface ===
+class Storage:
+    """Persistence for player documents. Versions are None when untracked."""
+
+    name = "storage"
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def load(self, player: str) -> Tuple[Doc, Optional[int]]:
+        """Return (document, version), seeding the player if missing."""
+        raise NotImplementedError
+
+    async def probe(self, player: str) -> Optional[int]:
+        """Cheap current-version lookup for cache freshness checks."""
+        return None
+
+    async def player_ids(self) -> List[str]:
+        """Every stored player id (used to seed background jobs at startup)."""
+        return []
+
+    async def write(self, player: str, data: Doc, ops: Ops = None,
+                    expected: Optional[int] = None) -> Tuple[bool, Optional[int]]:
+        """Persist `data` (or just `ops`). Returns (ok, new version).
+
+        Raises WriteConflict when `expected` is given and no longer current.
+        """
+        raise NotImplementedError
+
+    def forget(self, player: str) -> None:
+        """Drop per-player bookkeeping (the player left the resident set)."""
+
+    def available(self) -> bool:
+        """False while the backend is known to be down (circuit open)."""
+        return True
+
+    # --- diary archive (cold tier) ---
+    async def archive_diary(self, player: str, entries: List[Doc]) -> bool:
+        """Copy `entries` into the archive; idempotent per entry id."""
+        return False
+
+    async def search_diary(self, player: str, q: Optional[str] = None, start: Optional[datetime] = None,
+                           end: Optional[datetime] = None, limit: int = 50) -> List[Doc]:
+        """Archived entries containing every word of `q`, start <= ts < end, newest first."""
+        return []
+
+    async def clear_archive(self, player: str) -> None:
+        """Drop the player's archived diary entries and ledger entries."""
+
+    # --- ledger archive ---
+    async def archive_ledger(self, player: str, entries: List[Doc]) -> bool:
+        """Copy ledger `entries` into the archive; idempotent per seq."""
+        return False
+
+    async def ledger_history(self, player: str, before: Optional[int] = None, limit: int = 50) -> List[Doc]:
+        """Archived ledger entries with seq < `before`, newest first."""
+        return []
+
+    # --- export (whole archives, a page at a time, oldest first) ---
+    async def export_diary(self, player: str, offset: int = 0, limit: int = 500) -> List[Doc]:
+        """One page of archived diary entries ordered by ts (unset first), then id.
+
+        Raises StorageUnavailable rather than returning a short page.
+        """
+        return []
+
+    async def export_ledger(self, player: str, after: int = 0, limit: int = 500) -> List[Doc]:
+        """Archived ledger entries with seq > `after`, oldest first (raises like export_diary)."""
+        return []
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+# --- Diary archive rows ---
+# Old diary entries leave the hot document for the diary_archive table: one
+# row per entry keyed by (player id, entry id), so archiving the same entry
+# twice (e.g. after a crash between archive and removal) is a no-op, with a
+# full-text index over the text. Search splits q into words and matches
+# entries containing all of them.
+ARCHIVE_TABLE = "diary_archive"
+
+def _parse_ts(v: Any) -> Optional[datetime]:
+    if not v:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(v))
+    except ValueError:
+        return None
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+def _archive_row(entry: Doc) -> Tuple[str, Any, Optional[str], Dict[str, Any]]:
+    """(id, text, naive ISO ts, extra) for one diary entry."""
+    ts = _parse_ts(entry.get("ts"))
+    extra = {k: v for k, v in entry.items() if k not in ("id", "text", "ts")}
+    if entry.get("ts") is not None and ts is None:
+        extra["ts"] = entry["ts"]  # unparseable: keep the raw string
+    return str(entry.get("id")), entry.get("text"), ts.isoformat() if ts else None, extra
+
+def _archive_entry(entry_id: Any, text: Any, ts: Optional[str], extra: Optional[Dict[str, Any]]) -> Doc:
+    entry: Doc = {"id": entry_id, "text": text, "ts": ts}
+    entry.update(extra or {})
+    return entry
+
+# Coin/XP ledger entries folded into a checkpoint leave the document for
+# ledger_archive: one row per (player id, seq) holding the entry as JSON.
+LEDGER_ARCHIVE_TABLE = "ledger_archive"
+
+# === Supabase: player_data JSON store (one row per player) ===
+# Everything lives inside player_data(id = player id).data (jsonb). version is bumped by
+# every write; writes are conditional on the version we read.
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "8"))
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "3"))
+SUPABASE_POOL_SIZE = int(os.getenv("SUPABASE_POOL_SIZE", "20"))
+SUPABASE_KEEPALIVE = int(os.getenv("SUPABASE_KEEPALIVE", "10"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "1").lower() not in ("0", "false", "no")
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _missing_column(resp: httpx.Response) -> bool:
+    # PostgREST: 42703 = undefined_column, PGRST204 = column not in schema cache
+    return resp.status_code == 400 and ("42703" in resp.text or "PGRST204" in resp.text)
+
+def _json_body(payload: Any, op: str) -> bytes:
+    """Encode a request body ourselves, so the encode shows up as its own span."""
+    with span("json_encode"):
+        body = codec.dumps(payload)
+    STORAGE_BYTES.observe(len(body), op)
+    return body
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _first_row(resp: httpx.Response) -> Optional[Dict[str, Any]]:
+    if resp.status_code == 204 or not resp.content:
+        return None
+    try:
+        arr = codec.loads(resp.content)
+    except ValueError:
+        return None
+    if isinstance(arr, list) and arr and isinstance(arr[0], dict):
+        return arr[0]
+    return None
+
+# --- Circuit breaker & adaptive timeouts ---
+# After BREAKER_FAILURES failures in a row (transport errors, timeouts, 5xx)
+# the breaker opens and Supabase calls fail at once instead of each waiting
+# out its timeout; after the cooldown one trial call goes through, and the
+# cooldown doubles (up to BREAKER_MAX_COOLDOWN) every time the trial fails.
+# Request timeouts follow the observed latency: ADAPTIVE_TIMEOUT_FACTOR x the
+# p99 of the last successful calls of that kind, never below the floor nor
+# above SUPABASE_TIMEOUT. Writes get a higher floor: a write that times out
+# may still have landed, and the journal (JournaledStorage) replays it.
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "5"))
+BREAKER_MAX_COOLDOWN = float(os.getenv("BREAKER_MAX_COOLDOWN", "60"))
+ADAPTIVE_TIMEOUT_FACTOR = float(os.getenv("ADAPTIVE_TIMEOUT_FACTOR", "4"))
+READ_TIMEOUT_FLOOR = float(os.getenv("READ_TIMEOUT_FLOOR", "0.5"))
+WRITE_TIMEOUT_FLOOR = float(os.getenv("WRITE_TIMEOUT_FLOOR", "2"))
+
+class CircuitBreaker:
+    def __init__(self, failures: int, cooldown: float, max_cooldown: float):
+        self.threshold = max(1, failures)
+        self.base_cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False  # a half-open trial call is in flight
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def success(self) -> None:
+        if self.opened_at is not None:
+            log.info("Supabase reachable again; circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.cooldown = self.base_cooldown
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.opened_at is not None:
+            if self.trial:  # the trial failed: stay open, back off further
+                self.trial = False
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.opened_at = time.monotonic()
+        elif self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            log.warning("Supabase failing (%s in a row); circuit open for %gs", self.failures, self.cooldown)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures, "trips": self.trips, "cooldown": self.cooldown}
+
+class LatencyWindow:
+    """Recent successful call latencies, and the timeout they suggest."""
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, floor: float, ceiling: float, size: int = 256):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def timeout(self) -> float:
+        if len(self.samples) < self.MIN_SAMPLES:
+            return self.ceiling
+        ordered = sorted(self.samples)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        return min(self.ceiling, max(self.floor, p99 * ADAPTIVE_TIMEOUT_FACTOR))
+
+class SupabaseJsonStorage(Storage):
+    name = "supabase"
+    PATCH_RPC = "player_data_apply_patch"
+
+    def __init__(self, url: Optional[str], key: Optional[str], seed: Seed, table: str = "player_data"):
+        self.url = url
+        self.key = key
+        self.seed = seed
+        self.table = table
+        self.http: Optional[httpx.AsyncClient] = None
+        # Older deployments lack version/updated_at, the patch RPC or the
+        # diary archive; each is detected on first use and we degrade instead
+        # of failing.
+        self.has_version = True
+        self.has_patch_rpc = True
+        self.has_archive = True
+        self.has_ledger_archive = True
+        # full writes without a version column: "post" (upsert) or "patch",
+        # whichever the server last accepted, so the other isn't tried first
+        self.full_write = "post"
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN, BREAKER_MAX_COOLDOWN)
+        self.latency = {"read": LatencyWindow(READ_TIMEOUT_FLOOR, SUPABASE_TIMEOUT),
+                        "write": LatencyWindow(WRITE_TIMEOUT_FLOOR, SUPABASE_TIMEOUT)}
+
+    def headers(self) -> Dict[str, str]:
+        if not self.key:
+            return {}
+        return {
+            "apikey": self.key,
+            "Authorization": f"Bearer {self.key}",
+            "Content-Type": "application/json",
+        }
+
+    def base_rest(self) -> str:
+        if not self.url:
+            raise RuntimeError("SUPABASE_URL is not set")
+        return self.url.rstrip("/") + "/rest/v1"
+
+    # One AsyncClient per process, opened/closed by the app lifespan, so
+    # handlers reuse keep-alive connections instead of blocking the event loop
+    # on a fresh TCP+TLS handshake per call.
+    def create_http_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            headers=self.headers(),
+            http2=SUPABASE_HTTP2 and http2_available(),
+            limits=httpx.Limits(
+                max_connections=SUPABASE_POOL_SIZE,
+                max_keepalive_connections=SUPABASE_KEEPALIVE,
+                keepalive_expiry=30,
+            ),
+            timeout=httpx.Timeout(SUPABASE_TIMEOUT, connect=SUPABASE_CONNECT_TIMEOUT),
+        )
+
+    def client(self) -> httpx.AsyncClient:
+        """Shared client; created lazily when used outside the app lifespan (scripts)."""
+        if self.http is None or self.http.is_closed:
+            self.http = self.create_http_client()
+        return self.http
+
+    async def send(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        """One Supabase call through the circuit breaker, with an adaptive timeout."""
+        if not self.breaker.allow():
+            raise CircuitOpen("circuit open")
+        window = self.latency["read" if method == "GET" else "write"]
+        limit = window.timeout()
+        start = time.monotonic()
+        try:
+            resp = await self.client().request(
+                method, url, timeout=httpx.Timeout(limit, connect=min(limit, SUPABASE_CONNECT_TIMEOUT)), **kwargs)
+        except httpx.HTTPError:
+            self.breaker.failure()
+            raise
+        if resp.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+            window.add(time.monotonic() - start)
+        return resp
+
+    def available(self) -> bool:
+        return self.breaker.state != "open"
+
+    async def start(self) -> None:
+        if not self.url or not self.key:
+            raise RuntimeError("Supabase env vars missing. Set SUPABASE_URL and SUPABASE_KEY.")
+        self.client()
+        log.info("Supabase client ready (pool=%s, http2=%s)", SUPABASE_POOL_SIZE, SUPABASE_HTTP2 and http2_available())
+
+    async def close(self) -> None:
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    async def load(self, player: str) -> Tuple[Doc, Optional[int]]:
+        """Fetch the player's row and its version. If missing, insert seed data."""
+        cols = "data,version" if self.has_version else "data"
+        url = f"{self.base_rest()}/{self.table}?select={cols}&id=eq.{player}"
+        try:
+            with span("supabase_get"):
+                resp = await self.send("GET", url)
+        except httpx.HTTPError as e:
+            STORAGE_ERRORS.inc("load")
+            raise StorageUnavailable(f"Supabase GET failed: {e!r}") from e
+        if self.has_version and _missing_column(resp):
+            log.warning("player_data.version missing; run schema.sql (TTL-only cache, single worker only)")
+            self.has_version = False
+            return await self.load(player)
+        if resp.status_code == 200:
+            STORAGE_BYTES.observe(len(resp.content), "load")
+            with span("json_decode"):
+                row = _first_row(resp)
+            if row is not None:
+                return row.get("data") or self.seed(), row.get("version")
+            # Empty: create, but never clobber a row another worker just seeded
+            payload: Dict[str, Any] = {"id": player, "data": self.seed()}
+            if self.has_version:
+                payload.update(version=0, updated_at=utc_now_iso())
+            try:
+                r = await self.send(
+                    "POST", f"{self.base_rest()}/{self.table}",
+                    headers={"Prefer": "resolution=ignore-duplicates,return=representation"},
+                    json=payload,
+                )
+            except httpx.HTTPError as e:
+                STORAGE_ERRORS.inc("seed")
+                raise StorageUnavailable(f"Supabase seed failed: {e!r}") from e
+            if r.status_code in (200, 201):
+                created = _first_row(r)
+                if created is not None:
+                    return created.get("data") or payload["data"], created.get("version")
+                # lost the seeding race: read what the winner wrote
+                return await self.load(player)
+            STORAGE_ERRORS.inc("seed")
+            log.error("Supabase UPSERT seed failed %s: %s", r.status_code, r.text)
+            raise RuntimeError("Failed to create player_data row")
+        STORAGE_ERRORS.inc("load")
+        log.error("Supabase GET failed %s: %s", resp.status_code, resp.text)
+        if resp.status_code >= 500:
+            raise StorageUnavailable(f"Supabase GET failed with {resp.status_code}")
+        raise RuntimeError("Supabase unavailable or table missing")
+
+    async def probe(self, player: str) -> Optional[int]:
+        if not self.has_version:
+            return None
+        try:
+            with span("supabase_probe"):
+                resp = await self.send("GET", f"{self.base_rest()}/{self.table}?select=version&id=eq.{player}")
+        except httpx.HTTPError:
+            STORAGE_ERRORS.inc("probe")
+            return None
+        row = _first_row(resp) if resp.status_code == 200 else None
+        return row.get("version") if row else None
+
+    async def player_ids(self) -> List[str]:
+        try:
+            resp = await self.send("GET", f"{self.base_rest()}/{self.table}?select=id")
+        except httpx.HTTPError as e:
+            log.warning("Listing players failed: %s", e)
+            return []
+        if resp.status_code != 200:
+            log.warning("Listing players failed %s: %s", resp.status_code, resp.text)
+            return []
+        return [str(r["id"]) for r in codec.loads(resp.content) if r.get("id")]
+
+    async def write(self, player: str, data: Doc, ops: Ops = None,
+                    expected: Optional[int] = None) -> Tuple[bool, Optional[int]]:
+        # With ops only the diff is sent, through the patch RPC (schema.sql),
+        # which replays them with jsonb_set / || / #- on the server. Falls back
+        # to a full write when the RPC is missing or rejects the patch; not
+        # when Supabase is unreachable, where the full write would only wait
+        # out another timeout.
+        first = None
+        if ops is not None:
+            if not ops:
+                return True, expected
+            if self.has_patch_rpc:
+                try:
+                    with span("supabase_patch"):
+                        ok, version = await self.apply_patch(player, ops, expected)
+                except httpx.HTTPError as e:
+                    STORAGE_ERRORS.inc("patch")
+                    log.warning("Patch RPC failed: %s", e)
+                    return False, None
+                if ok:
+                    STORAGE_WRITES.inc("patch")
+                    return True, version
+                first = "patch"
+        if self.has_version and expected is not None:
+            if first:
+                STORAGE_FALLBACKS.inc(first, "update")
+            with span("supabase_update"):
+                return await self.update_conditional(player, data, expected)
+        if first:
+            STORAGE_FALLBACKS.inc(first, "upsert")
+        with span("supabase_upsert"):
+            return await self.upsert_full(player, data)
+
+    async def apply_patch(self, player: str, ops: List[Dict[str, Any]],
+                          expected: Optional[int]) -> Tuple[bool, Optional[int]]:
+        """(True, version) once applied, (False, None) if a full write should be tried.
+
+        Transport errors and 5xx answers propagate as httpx errors.
+        """
+        resp = await self.send(
+            "POST", f"{self.base_rest()}/rpc/{self.PATCH_RPC}",
+            headers=JSON_HEADERS,
+            content=_json_body({"p_id": player, "p_ops": ops, "p_expected_version": expected}, "patch"),
+        )
+        if resp.status_code == 200:
+            try:
+                result = codec.loads(resp.content)
+            except ValueError:
+                result = None
+            if result is None and expected is not None:
+                raise WriteConflict(f"version {expected} is stale")
+            return True, result.get("version") if isinstance(result, dict) else None
+        if resp.status_code >= 500:
+            raise httpx.HTTPStatusError(f"patch RPC answered {resp.status_code}", request=resp.request, response=resp)
+        if resp.status_code == 404:
+            # remembered, so deployments without the RPC stop paying for it
+            log.warning("%s RPC not installed; using full upserts (see schema.sql)", self.PATCH_RPC)
+            self.has_patch_rpc = False
+        else:
+            STORAGE_ERRORS.inc("patch")
+            log.warning("Patch RPC failed %s: %s; falling back to full upsert", resp.status_code, resp.text)
+        return False, None
+
+    async def update_conditional(self, player: str, data: Doc, expected: int) -> Tuple[bool, Optional[int]]:
+        """PATCH ...&version=eq.N; an empty result means someone else wrote first."""
+        url = f"{self.base_rest()}/{self.table}?select=version&id=eq.{player}&version=eq.{expected}"
+        try:
+            resp = await self.send(
+                "PATCH", url,
+                headers={"Prefer": "return=representation", **JSON_HEADERS},
+                content=_json_body({"data": data, "version": expected + 1, "updated_at": utc_now_iso()}, "full"),
+            )
+        except httpx.HTTPError as e:
+            STORAGE_ERRORS.inc("update")
+            log.error("Supabase save failed: %s", e)
+            return False, None
+        if resp.status_code == 200:
+            row = _first_row(resp)
+            if row is None:
+                raise WriteConflict(f"version {expected} is stale")
+            STORAGE_WRITES.inc("update")
+            return True, row.get("version")
+        STORAGE_ERRORS.inc("update")
+        log.error("Supabase save failed %s: %s", resp.status_code, resp.text)
+        return False, None
+
+    async def full_write_once(self, method: str, player: str, data: Doc) -> Optional[httpx.Response]:
+        """One unversioned full write: "post" upserts the row, "patch" updates it by id."""
+        if method == "post":
+            url = f"{self.base_rest()}/{self.table}"
+            headers = {"Prefer": "resolution=merge-duplicates,return=minimal", **JSON_HEADERS}
+            body = {"id": player, "data": data}
+        else:
+            url = f"{self.base_rest()}/{self.table}?id=eq.{player}"
+            headers = {"Prefer": "return=minimal", **JSON_HEADERS}
+            body = {"data": data}
+        try:
+            return await self.send(method.upper(), url, headers=headers, content=_json_body(body, "full"))
+        except httpx.HTTPError as e:
+            STORAGE_ERRORS.inc(method)
+            log.error("Supabase save (%s) failed: %s", method.upper(), e)
+            return None
+
+    async def upsert_full(self, player: str, data: Doc) -> Tuple[bool, Optional[int]]:
+        """Full write for tables without a version column.
+
+        Some PostgREST setups reject the upsert but take a PATCH by id. The
+        method that last worked goes first; the other one is only tried when
+        the server rejected the first (4xx), never when it was unreachable.
+        """
+        first = self.full_write
+        second = "patch" if first == "post" else "post"
+        resp = await self.full_write_once(first, player, data)
+        if resp is not None and resp.status_code in (200, 201, 204):
+            STORAGE_WRITES.inc(first)
+            return True, None
+        if resp is None or resp.status_code >= 500:
+            if resp is not None:
+                STORAGE_ERRORS.inc(first)
+                log.error("Supabase save failed %s: %s", resp.status_code, resp.text)
+            return False, None
+        STORAGE_ERRORS.inc(first)
+        STORAGE_FALLBACKS.inc(first, second)
+        with span("supabase_upsert_fallback"):
+            resp2 = await self.full_write_once(second, player, data)
+        if resp2 is not None and resp2.status_code in (200, 201, 204):
+            log.info("Supabase rejected %s writes (%s); using %s from now on", first.upper(), resp.status_code,
+                     second.upper())
+            self.full_write = second
+            STORAGE_WRITES.inc(second)
+            return True, None
+        if resp2 is not None:
+            STORAGE_ERRORS.inc(second)
+            log.error("Supabase save failed %s/%s: %s | %s", resp.status_code, resp2.status_code, resp.text, resp2.text)
+        return False, None
+
+    async def archive_diary(self, player: str, entries: List[Doc]) -> bool:
+        if not entries:
+            return True
+        if not self.has_archive:
+            return False
+        rows = []
+        for entry in entries:
+            entry_id, text, ts, extra = _archive_row(entry)
+            rows.append({"player_id": player, "id": entry_id, "entry": text, "ts": ts, "extra": extra or None})
+        try:
+            resp = await self.send(
+                "POST", f"{self.base_rest()}/{ARCHIVE_TABLE}?on_conflict=player_id,id",
+                headers={"Prefer": "resolution=ignore-duplicates,return=minimal"},
+                json=rows,
+            )
+        except httpx.HTTPError as e:
+            log.warning("Diary archive write failed: %s", e)
+            return False
+        if resp.status_code in (200, 201, 204):
+            return True
+        if resp.status_code == 404:
+            log.warning("%s table missing; diary stays in the document (see schema.sql)", ARCHIVE_TABLE)
+            self.has_archive = False
+        else:
+            log.warning("Diary archive write failed %s: %s", resp.status_code, resp.text)
+        return False
+
+    async def search_diary(self, player: str, q: Optional[str] = None, start: Optional[datetime] = None,
+                           end: Optional[datetime] = None, limit: int = 50) -> List[Doc]:
+        if not self.has_archive:
+            return []
+        params = [("select", "id,entry,ts,extra"), ("player_id", f"eq.{player}"),
+                  ("order", "ts.desc.nullslast"), ("limit", str(limit))]
+        if q:
+            params.append(("tsv", f"plfts(simple).{q}"))
+        if start:
+            params.append(("ts", f"gte.{start.isoformat()}"))
+        if end:
+            params.append(("ts", f"lt.{end.isoformat()}"))
+        try:
+            resp = await self.send("GET", f"{self.base_rest()}/{ARCHIVE_TABLE}", params=params)
+        except httpx.HTTPError as e:
+            log.warning("Diary archive search failed: %s", e)
+            return []
+        if resp.status_code != 200:
+            if resp.status_code == 404:
+                self.has_archive = False
+            log.warning("Diary archive search failed %s: %s", resp.status_code, resp.text)
+            return []
+        out = []
+        for r in codec.loads(resp.content):
+            ts = _parse_ts(r.get("ts"))  # timestamptz comes back with an offset
+            out.append(_archive_entry(r.get("id"), r.get("entry"), ts.isoformat() if ts else None, r.get("extra")))
+        return out
+
+    async def clear_archive(self, player: str) -> None:
+        if not self.has_archive:
+            return
+        try:
+            await self.send("DELETE", f"{self.base_rest()}/{ARCHIVE_TABLE}", params={"player_id": f"eq.{player}"})
+            if self.has_ledger_archive:
+                await self.send("DELETE", f"{self.base_rest()}/{LEDGER_ARCHIVE_TABLE}",
+                                params={"player_id": f"eq.{player}"})
+        except httpx.HTTPError as e:
+            log.warning("Archive clear failed: %s", e)
+
+    async def archive_ledger(self, player: str, entries: List[Doc]) -> bool:
+        if not entries:
+            return True
+        if not self.has_ledger_archive:
+            return False
+        rows = [{"player_id": player, "seq": e.get("seq"), "entry": e} for e in entries]
+        try:
+            resp = await self.send(
+                "POST", f"{self.base_rest()}/{LEDGER_ARCHIVE_TABLE}?on_conflict=player_id,seq",
+                headers={"Prefer": "resolution=ignore-duplicates,return=minimal"},
+                json=rows,
+            )
+        except httpx.HTTPError as e:
+            log.warning("Ledger archive write failed: %s", e)
+            return False
+        if resp.status_code in (200, 201, 204):
+            return True
+        if resp.status_code == 404:
+            log.warning("%s table missing; the ledger stays in the document (see schema.sql)", LEDGER_ARCHIVE_TABLE)
+            self.has_ledger_archive = False
+        else:
+            log.warning("Ledger archive write failed %s: %s", resp.status_code, resp.text)
+        return False
+
+    async def ledger_history(self, player: str, before: Optional[int] = None, limit: int = 50) -> List[Doc]:
+        if not self.has_ledger_archive:
+            return []
+        params = [("select", "entry"), ("player_id", f"eq.{player}"), ("order", "seq.desc"), ("limit", str(limit))]
+        if before is not None:
+            params.append(("seq", f"lt.{before}"))
+        try:
+            resp = await self.send("GET", f"{self.base_rest()}/{LEDGER_ARCHIVE_TABLE}", params=params)
+        except httpx.HTTPError as e:
+            log.warning("Ledger history failed: %s", e)
+            return []
+        if resp.status_code != 200:
+            if resp.status_code == 404:
+                self.has_ledger_archive = False
+            log.warning("Ledger history failed %s: %s", resp.status_code, resp.text)
+            return []
+        return [r["entry"] for r in codec.loads(resp.content) if isinstance(r.get("entry"), dict)]
+
+    async def _export_page(self, table: str, params: List[Tuple[str, str]]) -> List[Dict[str, Any]]:
+        try:
+            resp = await self.send("GET", f"{self.base_rest()}/{table}", params=params)
+        except httpx.HTTPError as e:
+            raise StorageUnavailable(f"{table} export failed: {e!r}") from e
+        if resp.status_code == 404:
+            return []  # no archive table: everything is still in the document
+        if resp.status_code != 200:
+            STORAGE_ERRORS.inc("export")
+            raise StorageUnavailable(f"{table} export failed with {resp.status_code}")
+        return codec.loads(resp.content)
+
+    async def export_diary(self, player: str, offset: int = 0, limit: int = 500) -> List[Doc]:
+        if not self.has_archive:
+            return []
+        rows = await self._export_page(ARCHIVE_TABLE, [
+            ("select", "id,entry,ts,extra"), ("player_id", f"eq.{player}"),
+            ("order", "ts.asc.nullsfirst,id.asc"), ("offset", str(offset)), ("limit", str(limit))])
+        out = []
+        for r in rows:
+            ts = _parse_ts(r.get("ts"))
+            out.append(_archive_entry(r.get("id"), r.get("entry"), ts.isoformat() if ts else None, r.get("extra")))
+        return out
+
+    async def export_ledger(self, player: str, after: int = 0, limit: int = 500) -> List[Doc]:
+        if not self.has_ledger_archive:
+            return []
+        rows = await self._export_page(LEDGER_ARCHIVE_TABLE, [
+            ("select", "entry"), ("player_id", f"eq.{player}"), ("seq", f"gt.{after}"),
+            ("order", "seq.asc"), ("limit", str(limit))])
+        return [r["entry"] for r in rows if isinstance(r.get("entry"), dict)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "versioned": self.has_version, "patch_rpc": self.has_patch_rpc,
+                "archive": self.has_archive, "ledger_archive": self.has_ledger_archive,
+                "full_write": self.full_write, "circuit": self.breaker.stats(),
+                "timeouts": {kind: round(w.timeout(), 3) for kind, w in self.latency.items()}}
+
+# === Normalized row storage (postgres / sqlite) ===
+# The document is split the way schema.sql lays it out: one row per task,
+# diary entry, punishment, non-negotiable, shop item and stat; everything
+# else (streak, settings, coins, ...) stays in players.data. Patch ops are
+# routed to the rows they touch: toggling a task updates one tasks row, one
+# stat_progress row and players.data, nothing else. Row ids live next to the
+# document (list position -> row id) rather than inside it.
+
+class ListSpec:
+    """How one document list maps to a table."""
+
+    def __init__(self, key: str, path: Tuple[str, ...], table: str, fields: Dict[str, str],
+                 ts: Tuple[str, ...] = (), ints: Tuple[str, ...] = (), bools: Tuple[str, ...] = ()):
+        self.key = key          # name in the id index
+        self.path = path        # where the list sits in the document
+        self.table = table
+        self.fields = fields    # document field -> column; unmapped fields go to extra
+        self.ts = ts            # timestamptz columns
+        self.ints = ints
+        self.bools = bools
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.fields.values()) + ["extra"]
+
+LIST_SPECS = [
+    ListSpec("tasks", ("tasks",), "tasks",
+             {"task": "task", "deadline": "deadline", "done": "done", "coins": "coins", "xp": "xp",
+              "stat": "stat", "failed": "failed", "created": "created_at"},
+             ts=("deadline", "created_at"), ints=("coins", "xp"), bools=("done", "failed")),
+    ListSpec("diary", ("diary",), "diary", {"text": "entry", "ts": "ts"}, ts=("ts",)),
+    ListSpec("punishments", ("punishments",), "punishments", {"text": "text"}),
+    ListSpec("non_negotiables", ("non_negotiables",), "non_negotiables",
+             {"text": "text", "created": "created_at", "modified": "modified"}, ts=("created_at", "modified")),
+    ListSpec("catalog", ("shop", "catalog"), "shop_items",
+             {"name": "name", "price": "price", "effect": "effect", "value": "value"},
+             ints=("price", "value")),
+    ListSpec("ledger", ("ledger",), "ledger",
+             {"seq": "seq", "ts": "ts", "kind": "kind", "ref": "ref", "coins": "coins", "stat": "stat",
+              "xp": "xp", "tasks": "tasks"},
+             ts=("ts",), ints=("seq", "coins", "xp", "tasks")),
+]
+ABSENT = "~absent"  # extra-column key listing mapped fields the item didn't have
+ROW_KEYS = {"tasks", "diary", "punishments", "non_negotiables", "stat_progress", "ledger"}
+
+def _walk(doc: Any, path: Tuple[str, ...]) -> Any:
+    for key in path:
+        doc = (doc or {}).get(key) if isinstance(doc, dict) else None
+    return doc
+
+def _rest(data: Doc) -> Doc:
+    """The part of the document that stays in players.data."""
+    rest = {k: v for k, v in data.items() if k not in ROW_KEYS}
+    if isinstance(rest.get("shop"), dict):
+        rest["shop"] = {k: v for k, v in rest["shop"].items() if k != "catalog"}
+    return rest
+
+def _to_int(v: Any) -> Optional[int]:
+    try:
+        return int(v) if v is not None else None
+    except (TypeError, ValueError):
+        return None
+
+class _Tx:
+    """Minimal async cursor both dialects implement ($n placeholders)."""
+
+    async def fetch(self, sql: str, *args: Any) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def execute(self, sql: str, *args: Any) -> None:
+        raise NotImplementedError
+
+    async def fetchrow(self, sql: str, *args: Any) -> Optional[Dict[str, Any]]:
+        rows = await self.fetch(sql, *args)
+        return rows[0] if rows else None
+
+class PlayerRows:
+    """Row ids of one player's lists, in document order (list position -> row id)."""
+
+    def __init__(self, pid: Any, ids: Optional[Dict[str, List[Any]]] = None):
+        self.pid = pid  # players.id
+        self.ids: Dict[str, List[Any]] = ids or {}
+
+    def copy(self) -> "PlayerRows":
+        return PlayerRows(self.pid, {k: list(v) for k, v in self.ids.items()})
+
+class RowStorage(Storage):
+    """Shared document <-> rows mapping; subclasses provide transactions and types."""
+
+    def __init__(self, seed: Seed):
+        self.seed = seed
+        self.players: Dict[str, PlayerRows] = {}
+        self.rows_written = 0
+
+    # --- dialect hooks ---
+    def transaction(self) -> Any:
+        raise NotImplementedError
+
+    def to_db_ts(self, v: Any) -> Any:
+        return v
+
+    def from_db_ts(self, v: Any) -> Any:
+        return v
+
+    def to_db_json(self, v: Any) -> Any:
+        return v
+
+    def from_db_json(self, v: Any) -> Any:
+        return v
+
+    def new_player_sql(self) -> str:
+        raise NotImplementedError
+
+    def seed_for(self, player: str) -> Doc:
+        return self.seed()
+
+    def fts_match(self, n: int) -> str:
+        """SQL condition: the archive row's text matches query parameter $n."""
+        raise NotImplementedError
+
+    def fts_query(self, q: str) -> str:
+        return q
+
+    # --- row <-> item ---
+    def to_row(self, spec: ListSpec, item: Any) -> List[Any]:
+        if not isinstance(item, dict):
+            # bare values (e.g. pre-id punishment strings) go in the first column
+            item = {next(iter(spec.fields)): item}
+        vals: List[Any] = []
+        extra = {k: v for k, v in item.items() if k not in spec.fields}
+        absent = [f for f in spec.fields if f not in item]
+        if absent:
+            extra[ABSENT] = absent  # so the item reloads with the same keys
+        for field, col in spec.fields.items():
+            v = item.get(field)
+            if col in spec.ts:
+                conv = self.to_db_ts(v)
+                if v is not None and conv is None:
+                    extra[field] = v  # unparseable: keep the raw string
+                v = conv
+            elif col in spec.ints:
+                v = _to_int(v)
+            elif col in spec.bools:
+                v = bool(v) if v is not None else None
+            vals.append(v)
+        vals.append(self.to_db_json(extra))
+        return vals
+
+    def from_row(self, spec: ListSpec, row: Dict[str, Any]) -> Any:
+        extra = dict(self.from_db_json(row.get("extra")) or {})
+        absent = extra.pop(ABSENT, ())
+        item: Dict[str, Any] = {}
+        for field, col in spec.fields.items():
+            if field in absent:
+                continue
+            v = row.get(col)
+            if col in spec.ts:
+                v = self.from_db_ts(v)
+            elif col in spec.bools and v is not None:
+                v = bool(v)
+            item[field] = v
+        item.update(extra)
+        return item
+
+    async def insert_item(self, tx: _Tx, rows: "PlayerRows", spec: ListSpec, item: Any) -> Any:
+        cols = spec.columns
+        params = ", ".join(f"${i + 2}" for i in range(len(cols)))
+        row = await tx.fetchrow(
+            f"INSERT INTO {spec.table} (player_id, {', '.join(cols)}) VALUES ($1, {params}) RETURNING id",
+            rows.pid, *self.to_row(spec, item))
+        self.rows_written += 1
+        return row["id"]
+
+    async def update_item(self, tx: _Tx, spec: ListSpec, row_id: Any, item: Any) -> None:
+        cols = spec.columns
+        sets = ", ".join(f"{c} = ${i + 2}" for i, c in enumerate(cols))
+        await tx.execute(f"UPDATE {spec.table} SET {sets} WHERE id = $1", row_id, *self.to_row(spec, item))
+        self.rows_written += 1
+
+    async def put_stat(self, tx: _Tx, rows: "PlayerRows", name: str, sp: Any) -> None:
+        sp = sp if isinstance(sp, dict) else {}
+        await tx.execute(
+            "INSERT INTO stat_progress (player_id, stat_name, level, xp) VALUES ($1, $2, $3, $4) "
+            "ON CONFLICT (player_id, stat_name) DO UPDATE SET level = excluded.level, xp = excluded.xp",
+            rows.pid, name, _to_int(sp.get("level")) or 1, _to_int(sp.get("xp")) or 0)
+        self.rows_written += 1
+
+    async def put_rest(self, tx: _Tx, rows: "PlayerRows", data: Doc) -> None:
+        await tx.execute("UPDATE players SET data = $2, name = $3 WHERE id = $1",
+                         rows.pid, self.to_db_json(_rest(data)), data.get("name"))
+        self.rows_written += 1
+
+    # --- Storage ---
+    async def load(self, player: str) -> Tuple[Doc, Optional[int]]:
+        with span(f"{self.name}_load"):
+            return await self._load(player)
+
+    async def _load(self, player: str) -> Tuple[Doc, Optional[int]]:
+        async with self.transaction() as tx:
+            row = await tx.fetchrow("SELECT id, version, data FROM players WHERE external_id = $1", player)
+            if row is None:
+                doc = self.seed_for(player)
+                row = await tx.fetchrow(self.new_player_sql(), player, doc.get("name"))
+                rows = PlayerRows(row["id"])
+                await self.write_all(tx, rows, doc)
+                self.players[player] = rows
+                return doc, row["version"]
+            rows = PlayerRows(row["id"])
+            doc = dict(self.from_db_json(row["data"]) or {})
+            for spec in LIST_SPECS:
+                cols = ", ".join(["id"] + spec.columns)
+                found = await tx.fetch(f"SELECT {cols} FROM {spec.table} WHERE player_id = $1 ORDER BY id", rows.pid)
+                rows.ids[spec.key] = [r["id"] for r in found]
+                parent = doc
+                for key in spec.path[:-1]:
+                    parent = parent.setdefault(key, {})
+                parent[spec.path[-1]] = [self.from_row(spec, r) for r in found]
+            stats = await tx.fetch("SELECT stat_name, level, xp FROM stat_progress WHERE player_id = $1 ORDER BY id", rows.pid)
+            doc["stat_progress"] = {r["stat_name"]: {"level": r["level"], "xp": r["xp"]} for r in stats}
+            self.players[player] = rows
+            return doc, row["version"]
+
+    async def probe(self, player: str) -> Optional[int]:
+        async with self.transaction() as tx:
+            row = await tx.fetchrow("SELECT version FROM players WHERE external_id = $1", player)
+        return row["version"] if row else None
+
+    async def player_ids(self) -> List[str]:
+        async with self.transaction() as tx:
+            rows = await tx.fetch("SELECT external_id FROM players WHERE external_id IS NOT NULL")
+        return [r["external_id"] for r in rows]
+
+    async def write(self, player: str, data: Doc, ops: Ops = None,
+                    expected: Optional[int] = None) -> Tuple[bool, Optional[int]]:
+        if ops is not None and not ops:
+            return True, expected
+        if player not in self.players:
+            await self.load(player)
+        # work on a copy of the row ids; it replaces the live one only on commit
+        rows = self.players[player].copy()
+        try:
+            with span(f"{self.name}_write"):
+                version = await self._write(rows, data, ops, expected)
+        except WriteConflict:
+            raise
+        except Exception as e:
+            STORAGE_ERRORS.inc("write")
+            log.error("%s save failed: %s", self.name, e)
+            return False, None
+        STORAGE_WRITES.inc("rows" if ops is not None else "rows_full")
+        self.players[player] = rows
+        return True, version
+
+    async def _write(self, rows: "PlayerRows", data: Doc, ops: Ops, expected: Optional[int]) -> int:
+        async with self.transaction() as tx:
+            if expected is None:
+                row = await tx.fetchrow("UPDATE players SET version = version + 1 WHERE id = $1 RETURNING version", rows.pid)
+            else:
+                row = await tx.fetchrow(
+                    "UPDATE players SET version = version + 1 WHERE id = $1 AND version = $2 RETURNING version",
+                    rows.pid, expected)
+                if row is None:
+                    raise WriteConflict(f"version {expected} is stale")
+            if ops is None:
+                await self.write_all(tx, rows, data)
+            else:
+                await self.apply_ops(tx, rows, data, ops)
+        return row["version"]
+
+    def forget(self, player: str) -> None:
+        self.players.pop(player, None)
+
+    async def write_all(self, tx: _Tx, rows: "PlayerRows", data: Doc) -> None:
+        for spec in LIST_SPECS:
+            await tx.execute(f"DELETE FROM {spec.table} WHERE player_id = $1", rows.pid)
+            rows.ids[spec.key] = [await self.insert_item(tx, rows, spec, item) for item in (_walk(data, spec.path) or [])]
+        await tx.execute("DELETE FROM stat_progress WHERE player_id = $1", rows.pid)
+        for name, sp in (data.get("stat_progress") or {}).items():
+            await self.put_stat(tx, rows, name, sp)
+        await self.put_rest(tx, rows, data)
+
+    async def apply_ops(self, tx: _Tx, rows: "PlayerRows", data: Doc, ops: List[Dict[str, Any]]) -> None:
+        # Structural ops (append/remove) run in order and keep rows.ids in
+        # step with the list positions. Edits inside an item only mark its row
+        # dirty; dirty rows are written once at the end from the final
+        # document, looked up by row id so later removals can't misalign. A
+        # list set or dropped whole, directly or with a container holding it
+        # (e.g. the whole "shop" with its catalog), is rebuilt once at the end
+        # from the final document; later ops on it are covered by that.
+        dirty: Dict[str, Set[Any]] = {spec.key: set() for spec in LIST_SPECS}
+        rebuilt: Set[str] = set()
+        dirty_stats: Set[str] = set()
+        rest_dirty = False
+        for op in ops:
+            path = tuple(op["path"])
+            spec = next((s for s in LIST_SPECS if path[:len(s.path)] == s.path), None)
+            if spec is not None:
+                if spec.key in rebuilt:
+                    continue
+                ids = rows.ids.setdefault(spec.key, [])
+                depth = len(spec.path)
+                if len(path) == depth:
+                    if op["op"] == "append":
+                        ids.append(await self.insert_item(tx, rows, spec, op["value"]))
+                    else:
+                        rebuilt.add(spec.key)
+                    continue
+                idx = int(path[depth])
+                if len(path) == depth + 1 and op["op"] == "remove":
+                    await tx.execute(f"DELETE FROM {spec.table} WHERE id = $1", ids.pop(idx))
+                    self.rows_written += 1
+                else:
+                    dirty[spec.key].add(ids[idx])
+                continue
+            if path[0] == "stat_progress":
+                if len(path) == 1:
+                    await tx.execute("DELETE FROM stat_progress WHERE player_id = $1", rows.pid)
+                    dirty_stats.update((data.get("stat_progress") or {}).keys())
+                elif len(path) == 2 and op["op"] == "remove":
+                    await tx.execute("DELETE FROM stat_progress WHERE player_id = $1 AND stat_name = $2", rows.pid, path[1])
+                    dirty_stats.discard(path[1])
+                else:
+                    dirty_stats.add(path[1])
+                continue
+            rebuilt.update(s.key for s in LIST_SPECS if len(s.path) > len(path) and s.path[:len(path)] == path)
+            rest_dirty = True
+        for spec in LIST_SPECS:
+            if spec.key not in rebuilt:
+                continue
+            await tx.execute(f"DELETE FROM {spec.table} WHERE player_id = $1", rows.pid)
+            items = _walk(data, spec.path)
+            rows.ids[spec.key] = [await self.insert_item(tx, rows, spec, item)
+                                  for item in (items if isinstance(items, list) else [])]
+            dirty[spec.key].clear()
+        for spec in LIST_SPECS:
+            if not dirty[spec.key]:
+                continue
+            items = _walk(data, spec.path) or []
+            for pos, row_id in enumerate(rows.ids.get(spec.key, [])):
+                if row_id in dirty[spec.key] and pos < len(items):
+                    await self.update_item(tx, spec, row_id, items[pos])
+        for name in dirty_stats:
+            sp = (data.get("stat_progress") or {}).get(name)
+            if sp is not None:
+                await self.put_stat(tx, rows, name, sp)
+        if rest_dirty:
+            await self.put_rest(tx, rows, data)
+
+    async def archive_diary(self, player: str, entries: List[Doc]) -> bool:
+        if not entries:
+            return True
+        try:
+            async with self.transaction() as tx:
+                for entry in entries:
+                    entry_id, text, ts, extra = _archive_row(entry)
+                    await tx.execute(
+                        f"INSERT INTO {ARCHIVE_TABLE} (player_id, id, entry, ts, extra) VALUES ($1, $2, $3, $4, $5) "
+                        "ON CONFLICT DO NOTHING",
+                        player, entry_id, text, self.to_db_ts(ts), self.to_db_json(extra) if extra else None)
+        except Exception as e:
+            log.error("%s diary archive failed: %s", self.name, e)
+            return False
+        return True
+
+    async def search_diary(self, player: str, q: Optional[str] = None, start: Optional[datetime] = None,
+                           end: Optional[datetime] = None, limit: int = 50) -> List[Doc]:
+        conds = ["player_id = $1"]
+        args: List[Any] = [player]
+        if q:
+            args.append(self.fts_query(q))
+            conds.append(self.fts_match(len(args)))
+        if start:
+            args.append(self.to_db_ts(start.isoformat()))
+            conds.append(f"ts >= ${len(args)}")
+        if end:
+            args.append(self.to_db_ts(end.isoformat()))
+            conds.append(f"ts < ${len(args)}")
+        args.append(limit)
+        sql = (f"SELECT id, entry, ts, extra FROM {ARCHIVE_TABLE} WHERE {' AND '.join(conds)} "
+               f"ORDER BY ts IS NULL, ts DESC LIMIT ${len(args)}")
+        async with self.transaction() as tx:
+            rows = await tx.fetch(sql, *args)
+        return [_archive_entry(r["id"], r["entry"], self.from_db_ts(r["ts"]), self.from_db_json(r["extra"]))
+                for r in rows]
+
+    async def clear_archive(self, player: str) -> None:
+        async with self.transaction() as tx:
+            await tx.execute(f"DELETE FROM {ARCHIVE_TABLE} WHERE player_id = $1", player)
+            await tx.execute(f"DELETE FROM {LEDGER_ARCHIVE_TABLE} WHERE player_id = $1", player)
+
+    async def archive_ledger(self, player: str, entries: List[Doc]) -> bool:
+        if not entries:
+            return True
+        try:
+            async with self.transaction() as tx:
+                for entry in entries:
+                    await tx.execute(
+                        f"INSERT INTO {LEDGER_ARCHIVE_TABLE} (player_id, seq, entry) VALUES ($1, $2, $3) "
+                        "ON CONFLICT DO NOTHING",
+                        player, _to_int(entry.get("seq")), self.to_db_json(entry))
+        except Exception as e:
+            log.error("%s ledger archive failed: %s", self.name, e)
+            return False
+        return True
+
+    async def ledger_history(self, player: str, before: Optional[int] = None, limit: int = 50) -> List[Doc]:
+        args: List[Any] = [player]
+        cond = ""
+        if before is not None:
+            args.append(before)
+            cond = " AND seq < $2"
+        args.append(limit)
+        async with self.transaction() as tx:
+            rows = await tx.fetch(f"SELECT entry FROM {LEDGER_ARCHIVE_TABLE} WHERE player_id = $1{cond} "
+                                  f"ORDER BY seq DESC LIMIT ${len(args)}", *args)
+        return [self.from_db_json(r["entry"]) for r in rows]
+
+    async def export_diary(self, player: str, offset: int = 0, limit: int = 500) -> List[Doc]:
+        async with self.transaction() as tx:
+            rows = await tx.fetch(f"SELECT id, entry, ts, extra FROM {ARCHIVE_TABLE} WHERE player_id = $1 "
+                                  "ORDER BY ts IS NOT NULL, ts, id LIMIT $2 OFFSET $3", player, limit, offset)
+        return [_archive_entry(r["id"], r["entry"], self.from_db_ts(r["ts"]), self.from_db_json(r["extra"]))
+                for r in rows]
+
+    async def export_ledger(self, player: str, after: int = 0, limit: int = 500) -> List[Doc]:
+        async with self.transaction() as tx:
+            rows = await tx.fetch(f"SELECT entry FROM {LEDGER_ARCHIVE_TABLE} WHERE player_id = $1 AND seq > $2 "
+                                  "ORDER BY seq LIMIT $3", player, after, limit)
+        return [self.from_db_json(r["entry"]) for r in rows]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": self.name, "rows_written": self.rows_written, "players_tracked": len(self.players)}
+
+# --- Postgres (asyncpg) ---
+class _PgTx(_Tx):
+    def __init__(self, conn: Any):
+        self.conn = conn
+
+    async def fetch(self, sql: str, *args: Any) -> List[Dict[str, Any]]:
+        return [dict(r) for r in await self.conn.fetch(sql, *args)]
+
+    async def execute(self, sql: str, *args: Any) -> None:
+        await self.conn.execute(sql, *args)
+
+class PostgresStorage(RowStorage):
+    """Normalized tables from schema.sql over an asyncpg pool."""
+
+    name = "postgres"
+
+    def __init__(self, dsn: Optional[str], seed: Seed, min_size: int = 1, max_size: int = 10):
+        super().__init__(seed)
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool: Any = None
+
+    async def start(self) -> None:
+        if not self.dsn:
+            raise RuntimeError("DATABASE_URL is not set (STORAGE_BACKEND=postgres)")
+        import asyncpg
+
+        async def init(conn: Any) -> None:
+            await conn.set_type_codec("jsonb", encoder=codec.dumps_str, decoder=codec.loads, schema="pg_catalog")
+
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size, init=init)
+        log.info("Postgres pool ready (max=%s)", self.max_size)
+
+    async def close(self) -> None:
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[_Tx]:
+        if self.pool is None:
+            await self.start()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield _PgTx(conn)
+
+    def new_player_sql(self) -> str:
+        return ("INSERT INTO players (external_id, name, data, version) VALUES ($1, $2, '{}'::jsonb, 0) "
+                "RETURNING id, version")
+
+    def fts_match(self, n: int) -> str:
+        return f"tsv @@ plainto_tsquery('simple', ${n})"
+
+    # The app uses naive local ISO strings; they round-trip through
+    # timestamptz as UTC, so what comes back is the same instant, though not
+    # always the same string ("2024-05-01T00:00" reads back with seconds).
+    def to_db_ts(self, v: Any) -> Any:
+        if not v:
+            return None
+        try:
+            dt = datetime.fromisoformat(str(v))
+        except ValueError:
+            return None
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+    def from_db_ts(self, v: Any) -> Any:
+        if v is None:
+            return None
+        return v.astimezone(timezone.utc).replace(tzinfo=None).isoformat()
+
+# --- SQLite (WAL) ---
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS players (
+  id INTEGER PRIMARY KEY,
+  external_id TEXT UNIQUE NOT NULL,
+  name TEXT,
+  data TEXT NOT NULL DEFAULT '{}',
+  version INTEGER NOT NULL DEFAULT 0,
+  created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS tasks (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  task TEXT NOT NULL, deadline TEXT, done INTEGER DEFAULT 0, coins INTEGER DEFAULT 0,
+  xp INTEGER DEFAULT 0, stat TEXT DEFAULT 'discipline', failed INTEGER DEFAULT 0,
+  created_at TEXT, extra TEXT
+);
+CREATE TABLE IF NOT EXISTS non_negotiables (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  text TEXT NOT NULL, created_at TEXT, modified TEXT, extra TEXT
+);
+CREATE TABLE IF NOT EXISTS punishments (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  text TEXT NOT NULL, extra TEXT
+);
+CREATE TABLE IF NOT EXISTS shop_items (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  name TEXT NOT NULL, price INTEGER NOT NULL, effect TEXT, value INTEGER DEFAULT 0, extra TEXT
+);
+CREATE TABLE IF NOT EXISTS diary (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  entry TEXT, ts TEXT, extra TEXT
+);
+CREATE TABLE IF NOT EXISTS stat_progress (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  stat_name TEXT NOT NULL, level INTEGER DEFAULT 1, xp INTEGER DEFAULT 0,
+  UNIQUE(player_id, stat_name)
+);
+CREATE INDEX IF NOT EXISTS tasks_player ON tasks(player_id);
+CREATE INDEX IF NOT EXISTS diary_player ON diary(player_id);
+CREATE INDEX IF NOT EXISTS punishments_player ON punishments(player_id);
+CREATE INDEX IF NOT EXISTS non_negotiables_player ON non_negotiables(player_id);
+CREATE INDEX IF NOT EXISTS shop_items_player ON shop_items(player_id);
+CREATE TABLE IF NOT EXISTS diary_archive (
+  player_id TEXT NOT NULL,
+  id TEXT NOT NULL,
+  entry TEXT, ts TEXT, extra TEXT,
+  PRIMARY KEY (player_id, id)
+);
+CREATE INDEX IF NOT EXISTS diary_archive_ts ON diary_archive(player_id, ts);
+CREATE VIRTUAL TABLE IF NOT EXISTS diary_archive_fts USING fts5(entry, content='diary_archive', content_rowid='rowid');
+CREATE TRIGGER IF NOT EXISTS diary_archive_ai AFTER INSERT ON diary_archive BEGIN
+  INSERT INTO diary_archive_fts(rowid, entry) VALUES (new.rowid, new.entry);
+END;
+CREATE TRIGGER IF NOT EXISTS diary_archive_ad AFTER DELETE ON diary_archive BEGIN
+  INSERT INTO diary_archive_fts(diary_archive_fts, rowid, entry) VALUES ('delete', old.rowid, old.entry);
+END;
+CREATE TABLE IF NOT EXISTS ledger (
+  id INTEGER PRIMARY KEY,
+  player_id INTEGER REFERENCES players(id) ON DELETE CASCADE,
+  seq INTEGER, ts TEXT, kind TEXT, ref TEXT, coins INTEGER DEFAULT 0, stat TEXT,
+  xp INTEGER DEFAULT 0, tasks INTEGER DEFAULT 0, extra TEXT
+);
+CREATE INDEX IF NOT EXISTS ledger_player ON ledger(player_id);
+CREATE TABLE IF NOT EXISTS ledger_archive (
+  player_id TEXT NOT NULL,
+  seq INTEGER NOT NULL,
+  entry TEXT NOT NULL,
+  PRIMARY KEY (player_id, seq)
+);
+"""
+
+# columns added after a table first shipped (CREATE TABLE IF NOT EXISTS won't add them)
+SQLITE_ADDED_COLUMNS = [("punishments", "extra")]
+
+_PG_PARAM = re.compile(r"\$(\d+)")
+
+class SqliteThread:
+    """The one thread a sqlite3 connection is used from.
+
+    A cancelled await doesn't stop a call already handed to a thread, so
+    with asyncio.to_thread close() could free the connection under a query
+    still running (a crash, not an exception). Calls here run one at a time,
+    in order, and close() queues behind them.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1, thread_name_prefix=self.name)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+    async def close(self, conn: sqlite3.Connection) -> None:
+        if self.executor is None:
+            conn.close()
+            return
+        executor, self.executor = self.executor, None
+        # shielded: if close() is cancelled, the connection still closes after the calls in flight
+        await asyncio.shield(asyncio.get_running_loop().run_in_executor(executor, conn.close))
+        executor.shutdown(wait=False)
+
+class _SqliteTx(_Tx):
+    def __init__(self, conn: sqlite3.Connection, thread: SqliteThread):
+        self.conn = conn
+        self.thread = thread
+
+    async def fetch(self, sql: str, *args: Any) -> List[Dict[str, Any]]:
+        def run() -> List[Dict[str, Any]]:
+            cur = self.conn.execute(_PG_PARAM.sub(r"?\1", sql), args)
+            return [dict(r) for r in cur.fetchall()]
+        return await self.thread.run(run)
+
+    async def execute(self, sql: str, *args: Any) -> None:
+        await self.thread.run(self.conn.execute, _PG_PARAM.sub(r"?\1", sql), args)
+
+class SQLiteStorage(RowStorage):
+    """Local, offline store: same row layout as postgres in a WAL-mode file.
+
+    The legacy player's first load imports data/player_data.json (the old
+    single-user file store) if present; everyone else starts from the seed.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, seed: Seed, legacy_json: Optional[str] = None, legacy_player: str = "singleton"):
+        super().__init__(seed)
+        self.path = path
+        self.legacy_json = legacy_json
+        self.legacy_player = legacy_player
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = asyncio.Lock()  # one transaction at a time on the shared connection
+        self.thread = SqliteThread("sqlite-store")
+
+    def seed_for(self, player: str) -> Doc:
+        doc = self.seed()
+        if player != self.legacy_player or not self.legacy_json or not os.path.exists(self.legacy_json):
+            return doc
+        try:
+            with open(self.legacy_json, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable %s: %s", self.legacy_json, e)
+            return doc
+        log.info("Importing legacy file store %s", self.legacy_json)
+        for key, value in legacy.items():
+            # one level deep, so e.g. shop keeps the seeded catalog
+            if isinstance(value, dict) and isinstance(doc.get(key), dict):
+                doc[key] = {**doc[key], **value}
+            else:
+                doc[key] = value
+        doc.pop("schema_version", None)  # the file predates it; migrate on first load
+        return doc
+
+    async def start(self) -> None:
+        if self.conn is not None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(SQLITE_SCHEMA)
+        for table, column in SQLITE_ADDED_COLUMNS:
+            if column not in {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+        self.conn = conn
+        log.info("SQLite store at %s (WAL)", self.path)
+
+    async def close(self) -> None:
+        if self.conn is not None:
+            async with self.lock:  # not in the middle of someone's transaction
+                conn, self.conn = self.conn, None
+                await self.thread.close(conn)
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator[_Tx]:
+        if self.conn is None:
+            await self.start()
+        async with self.lock:
+            conn = self.conn
+            await self.thread.run(conn.execute, "BEGIN IMMEDIATE")
+            try:
+                yield _SqliteTx(conn, self.thread)
+            except BaseException:
+                await self.thread.run(conn.execute, "ROLLBACK")
+                raise
+            await self.thread.run(conn.execute, "COMMIT")
+
+    def new_player_sql(self) -> str:
+        return "INSERT INTO players (external_id, name, data, version) VALUES ($1, $2, '{}', 0) RETURNING id, version"
+
+    def fts_match(self, n: int) -> str:
+        return f"rowid IN (SELECT rowid FROM diary_archive_fts WHERE diary_archive_fts MATCH ${n})"
+
+    def fts_query(self, q: str) -> str:
+        # each word as a quoted FTS5 string, so user input can't be query syntax
+        return " ".join('"' + w.replace('"', '""') + '"' for w in q.split())
+
+    def to_db_json(self, v: Any) -> Any:
+        return codec.dumps_str(v)
+
+    def from_db_json(self, v: Any) -> Any:
+        return codec.loads(v) if v else None
+
+# === Write journal (remote backends) ===
+# When Supabase (or the postgres server) is down, writes land in a local
+# append-only journal instead of failing: a WAL-mode SQLite file committed
+# with synchronous=FULL, so an acknowledged edit survives a crash. While a
+# player has journaled writes, their later writes queue behind them (order is
+# kept) and reads are served from the last known document: the one in memory,
+# or after a restart the snapshot the journal keeps (the full document is
+# stored with the first journaled write of a player, and with full writes).
+# A background task replays the journal in order once the backend answers
+# again: consecutive patch entries go out as one patch, a full write is
+# conditioned on the version the store has then. Replay holds an flock on
+# JOURNAL_PATH.lock so several workers sharing the file don't send the same
+# entries twice. A write that timed out may still have landed remotely; its
+# replay then applies the ops a second time (sets are idempotent, appends
+# are not).
+JOURNAL_RETRY = float(os.getenv("JOURNAL_RETRY", "2"))
+JOURNAL_BATCH = int(os.getenv("JOURNAL_BATCH", "200"))
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  player TEXT NOT NULL,
+  ops TEXT,
+  data TEXT,
+  ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS journal_player ON journal (player, id);
+"""
+
+class WriteJournal:
+    """Journal rows: ops (NULL for a full write) and, on some, the document after the write."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+        self.lock = asyncio.Lock()
+        self.thread = SqliteThread("write-journal")
+        self.lock_file: Any = None
+        self.pending = 0
+        self.appended = 0
+        self.replayed = 0
+
+    async def open(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.executescript(JOURNAL_SCHEMA)
+        self.conn = conn
+        self.pending = conn.execute("SELECT count(*) FROM journal").fetchone()[0]
+        if self.pending:
+            log.warning("Write journal %s holds %s unsent writes; replaying", self.path, self.pending)
+
+    async def close(self) -> None:
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await self.thread.close(conn)
+
+    async def _run(self, fn: Callable[[], Any]) -> Any:
+        async with self.lock:
+            return await self.thread.run(fn)
+
+    async def count(self) -> int:
+        self.pending = await self._run(lambda: self.conn.execute("SELECT count(*) FROM journal").fetchone()[0])
+        return self.pending
+
+    async def has(self, player: str) -> bool:
+        if not self.pending:
+            return False  # common case: nothing journaled, no thread hop
+        return await self._run(lambda: self.conn.execute(
+            "SELECT 1 FROM journal WHERE player = ? LIMIT 1", (player,)).fetchone() is not None)
+
+    async def append(self, player: str, ops: Ops, data: Doc) -> None:
+        def run() -> None:
+            snapshot = ops is None or self.conn.execute(
+                "SELECT 1 FROM journal WHERE player = ? AND data IS NOT NULL LIMIT 1", (player,)).fetchone() is None
+            self.conn.execute("INSERT INTO journal (player, ops, data, ts) VALUES (?, ?, ?, ?)",
+                              (player, None if ops is None else codec.dumps(ops),
+                               codec.dumps(data) if snapshot else None, time.time()))
+        await self._run(run)
+        self.pending += 1
+        self.appended += 1
+
+    async def players(self) -> List[str]:
+        rows = await self._run(lambda: self.conn.execute(
+            "SELECT player, min(id) AS first FROM journal GROUP BY player ORDER BY first").fetchall())
+        return [r[0] for r in rows]
+
+    async def entries(self, player: str, limit: int) -> List[Tuple[int, Ops, Optional[Doc]]]:
+        """(id, ops, data) in order; data only on full writes (not on patch snapshots)."""
+        rows = await self._run(lambda: self.conn.execute(
+            "SELECT id, ops, CASE WHEN ops IS NULL THEN data END FROM journal WHERE player = ? ORDER BY id LIMIT ?",
+            (player, limit)).fetchall())
+        return [(r[0], codec.loads(r[1]) if r[1] is not None else None, codec.loads(r[2]) if r[2] else None)
+                for r in rows]
+
+    def _restore(self, player: str) -> Optional[Doc]:
+        base = self.conn.execute("SELECT id, data FROM journal WHERE player = ? AND data IS NOT NULL "
+                                 "ORDER BY id DESC LIMIT 1", (player,)).fetchone()
+        if base is None:
+            return None
+        doc = codec.loads(base[1])
+        for (ops,) in self.conn.execute("SELECT ops FROM journal WHERE player = ? AND id > ? ORDER BY id",
+                                        (player, base[0])):
+            apply_ops(doc, codec.loads(ops))
+        return doc
+
+    async def restore(self, player: str) -> Optional[Doc]:
+        """The document as of the player's last journaled write, if the journal can rebuild it."""
+        return await self._run(lambda: self._restore(player))
+
+    async def drop(self, player: str, upto: int) -> None:
+        """Forget entries up to `upto` (sent); keeps a snapshot on what remains."""
+        def run() -> int:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                doc = None
+                left = self.conn.execute("SELECT max(id), count(*) FROM journal WHERE player = ? AND id > ?",
+                                         (player, upto)).fetchone()
+                if left[1] and not self.conn.execute("SELECT 1 FROM journal WHERE player = ? AND id > ? "
+                                                     "AND data IS NOT NULL LIMIT 1", (player, upto)).fetchone():
+                    doc = self._restore(player)
+                n = self.conn.execute("DELETE FROM journal WHERE player = ? AND id <= ?", (player, upto)).rowcount
+                if doc is not None:
+                    self.conn.execute("UPDATE journal SET data = ? WHERE id = ?", (codec.dumps(doc), left[0]))
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return n
+        n = await self._run(run)
+        self.pending = max(0, self.pending - n)
+        self.replayed += n
+
+    def try_lock(self) -> bool:
+        """Take the cross-process replay lock without waiting."""
+        if fcntl is None:
+            return True
+        if self.lock_file is None:
+            self.lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
+
+    def unlock(self) -> None:
+        if fcntl is not None and self.lock_file is not None:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "pending": self.pending, "appended": self.appended, "replayed": self.replayed}
+
+class JournaledStorage(Storage):
+    """A remote backend fronted by the write journal (see above)."""
+
+    def __init__(self, inner: Storage, path: str):
+        self.inner = inner
+        self.name = inner.name
+        self.journal = WriteJournal(path)
+        # last known (document, version) per resident player; the document is
+        # the object main.py caches and edits, so it is always the newest
+        self.docs: Dict[str, Tuple[Doc, Optional[int]]] = {}
+        self.replay_lock = asyncio.Lock()
+        self.wake = asyncio.Event()
+        self.replayer: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self.inner.start()
+        if self.journal.conn is None:
+            await self.journal.open()
+        if self.replayer is None:
+            self.replayer = asyncio.create_task(self._replay_loop())
+            if self.journal.pending:
+                self.wake.set()
+
+    async def close(self) -> None:
+        if self.replayer is not None:
+            self.replayer.cancel()
+            await asyncio.gather(self.replayer, return_exceptions=True)
+            self.replayer = None
+        if self.journal.pending and self.inner.available():
+            await self.replay_all()  # last chance to send; what's left waits for the next start
+        await self.journal.close()
+        await self.inner.close()
+
+    async def _replay_loop(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), JOURNAL_RETRY)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+            if not self.inner.available():
+                continue
+            await self.journal.count()  # other workers may have journaled too
+            if self.journal.pending:
+                try:
+                    await self.replay_all()
+                except Exception:
+                    log.exception("Journal replay failed")
+
+    async def replay_all(self) -> None:
+        for player in await self.journal.players():
+            if not await self.replay(player):
+                break
+
+    async def replay(self, player: str) -> bool:
+        """Send the player's journaled writes in order. True once none are left."""
+        async with self.replay_lock:
+            if not self.journal.try_lock():
+                return False
+            try:
+                while True:
+                    entries = await self.journal.entries(player, JOURNAL_BATCH)
+                    if not entries:
+                        return True
+                    upto, ops, full = entries[0][0], entries[0][1], entries[0][2]
+                    if ops is not None:
+                        ops = list(ops)
+                        for entry_id, more, _ in entries[1:]:
+                            if more is None:
+                                break
+                            ops.extend(more)
+                            upto = entry_id
+                    ok, version = await self._send(player, ops, full)
+                    if not ok:
+                        return False
+                    await self.journal.drop(player, upto)
+                    if player in self.docs:
+                        self.docs[player] = (self.docs[player][0], version)
+                    log.info("Replayed journal for %s up to #%s", player, upto)
+            finally:
+                self.journal.unlock()
+
+    async def _send(self, player: str, ops: Ops, full: Optional[Doc]) -> Tuple[bool, Optional[int]]:
+        try:
+            if ops is not None:
+                data = self.docs[player][0] if player in self.docs else await self.journal.restore(player)
+                return await self.inner.write(player, data if data is not None else {}, ops)
+            # a full write replaces whatever the store has; condition it on
+            # the version it has now so the bump reaches other workers' caches
+            for _ in range(3):
+                try:
+                    return await self.inner.write(player, full, None, await self.inner.probe(player))
+                except WriteConflict:
+                    continue
+            return False, None
+        except Exception as e:
+            log.warning("Journal replay for %s failed: %s", player, e)
+            return False, None
+
+    # --- Storage ---
+    async def load(self, player: str) -> Tuple[Doc, Optional[int]]:
+        if await self.journal.has(player) and (player in self.docs or not await self.replay(player)):
+            # the journal's copy rather than the cached object, which a failed
+            # edit may have left half-changed (that's why main.py reloads)
+            doc = await self.journal.restore(player)
+            if doc is None and player in self.docs:
+                return self.docs[player]
+            if doc is None:
+                raise StorageUnavailable(f"{player} has unsent writes and no local copy")
+            version = self.docs[player][1] if player in self.docs else None
+            self.docs[player] = (doc, version)
+            return doc, version
+        try:
+            data, version = await self.inner.load(player)
+        except (StorageUnavailable, httpx.HTTPError) as e:
+            if player not in self.docs:
+                raise StorageUnavailable(str(e)) from e
+            log.warning("Serving last known document for %s: %s", player, e)
+            return self.docs[player]
+        self.docs[player] = (data, version)
+        return data, version
+
+    async def probe(self, player: str) -> Optional[int]:
+        if player in self.docs and (not self.inner.available() or await self.journal.has(player)):
+            return self.docs[player][1]  # nothing newer can be fetched; keep serving the cache
+        return await self.inner.probe(player)
+
+    async def player_ids(self) -> List[str]:
+        return await self.inner.player_ids()
+
+    async def write(self, player: str, data: Doc, ops: Ops = None,
+                    expected: Optional[int] = None) -> Tuple[bool, Optional[int]]:
+        if ops is not None and not ops:
+            return True, expected
+        if self.inner.available() and not await self.journal.has(player):
+            try:
+                ok, version = await self.inner.write(player, data, ops, expected)
+            except WriteConflict:
+                raise
+            except Exception as e:
+                log.warning("%s write failed for %s: %s", self.name, player, e)
+                ok, version = False, None
+            if ok:
+                self.docs[player] = (data, version)
+                return True, version
+        try:
+            with span("journal_append"):
+                await self.journal.append(player, ops, data)
+        except Exception as e:
+            log.error("Journal append failed for %s: %s", player, e)
+            return False, None
+        self.docs[player] = (data, expected)
+        self.wake.set()
+        return True, expected
+
+    def forget(self, player: str) -> None:
+        self.docs.pop(player, None)
+        self.inner.forget(player)
+
+    def available(self) -> bool:
+        return self.inner.available()
+
+    async def archive_diary(self, player: str, entries: List[Doc]) -> bool:
+        return await self.inner.archive_diary(player, entries)
+
+    async def search_diary(self, player: str, q: Optional[str] = None, start: Optional[datetime] = None,
+                           end: Optional[datetime] = None, limit: int = 50) -> List[Doc]:
+        return await self.inner.search_diary(player, q, start, end, limit)
+
+    async def clear_archive(self, player: str) -> None:
+        await self.inner.clear_archive(player)
+
+    async def archive_ledger(self, player: str, entries: List[Doc]) -> bool:
+        return await self.inner.archive_ledger(player, entries)
+
+    async def ledger_history(self, player: str, before: Optional[int] = None, limit: int = 50) -> List[Doc]:
+        return await self.inner.ledger_history(player, before, limit)
+
+    async def export_diary(self, player: str, offset: int = 0, limit: int = 500) -> List[Doc]:
+        return await self.inner.export_diary(player, offset, limit)
+
+    async def export_ledger(self, player: str, after: int = 0, limit: int = 500) -> List[Doc]:
+        return await self.inner.export_ledger(player, after, limit)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.inner.stats(), "journal": self.journal.stats()}
+
+# === Factory ===
+def create_storage(seed: Seed, base_dir: str, default_player: str = "singleton") -> Storage:
+    """Pick the backend from STORAGE_BACKEND (default: supabase if configured, else sqlite).
+
+    The remote backends get the write journal unless JOURNAL=0.
+    """
+    supabase_url = os.getenv("SUPABASE_URL")
+    backend = (os.getenv("STORAGE_BACKEND") or ("supabase" if supabase_url else "sqlite")).lower()
+    journal = os.getenv("JOURNAL", "1") != "0"
+    journal_path = os.getenv("JOURNAL_PATH") or os.path.join(base_dir, "data", "journal.db")
+    if backend == "supabase":
+        remote: Storage = SupabaseJsonStorage(supabase_url, os.getenv("SUPABASE_KEY"), seed)
+        return JournaledStorage(remote, journal_path) if journal else remote
+    if backend == "postgres":
+        remote = PostgresStorage(os.getenv("DATABASE_URL"), seed,
+                                 max_size=int(os.getenv("PG_POOL_SIZE", "10")))
+        return JournaledStorage(remote, journal_path) if journal else remote
+    if backend == "sqlite":
+        return SQLiteStorage(os.getenv("SQLITE_PATH") or os.path.join(base_dir, "data", "solo.db"), seed,
+                             legacy_json=os.path.join(base_dir, "data", "player_data.json"), legacy_player=default_player)
+    raise RuntimeError(f"Unknown STORAGE_BACKEND {backend!r} (use supabase, postgres or sqlite)")
@@ -0,0 +1,75 @@
+# conftest.py — test harness for the Solo System API
+#
+#   pip install -r requirements-dev.txt && python -m pytest tests
+#
+# main.py reads its configuration at import time, so the environment is set
+# here, once, before it is imported. Each test then gets a fresh store and
+# fresh in-process state (players, scheduler) swapped into main, runs the
+# app's lifespan, and talks to it through an in-memory ASGI transport:
+#   sqlite_app   SQLiteStorage on a file in the test's tmp dir
+#   remote_app   the supabase backend behind the write journal, talking to
+#                bench/fake_postgrest.py (also in memory)
+# Async tests run on anyio's pytest plugin (installed with httpx).
+
+import os
+import sys
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Tuple
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [BASE_DIR, os.path.join(BASE_DIR, "bench")]
+
+os.environ.update(
+    STORAGE_BACKEND="sqlite",
+    SQLITE_PATH=os.devnull,  # replaced per test; never opened
+    SCHEDULER="0",
+    STATIC_BUILD="0",
+    # quick outage tests: trip after two failures, probe and replay often
+    BREAKER_FAILURES="2",
+    BREAKER_COOLDOWN="0.05",
+    BREAKER_MAX_COOLDOWN="0.2",
+    JOURNAL_RETRY="0.05",
+)
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+import storage  # noqa: E402
+from fake_postgrest import FakePostgrest  # noqa: E402
+
+@pytest.fixture
+def anyio_backend() -> str:
+    return "asyncio"
+
+@asynccontextmanager
+async def running(store: storage.Storage, monkeypatch: pytest.MonkeyPatch) -> AsyncIterator[httpx.AsyncClient]:
+    monkeypatch.setattr(main, "store", store)
+    monkeypatch.setattr(main, "players", main.PlayerRegistry(main.MAX_RESIDENT_PLAYERS))
+    monkeypatch.setattr(main, "deadlines", main.DeadlineScheduler())
+    async with main.app.router.lifespan_context(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            yield client
+
+@pytest.fixture
+async def sqlite_app(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> AsyncIterator[httpx.AsyncClient]:
+    store = storage.SQLiteStorage(str(tmp_path / "solo.db"), main.seed_data)
+    async with running(store, monkeypatch) as client:
+        yield client
+
+@pytest.fixture
+async def remote_app(tmp_path: Any, monkeypatch: pytest.MonkeyPatch
+                     ) -> AsyncIterator[Tuple[httpx.AsyncClient, FakePostgrest, storage.JournaledStorage]]:
+    fake = FakePostgrest()
+    remote = storage.SupabaseJsonStorage("http://fake-postgrest", "test", main.seed_data)
+    remote.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake), headers=remote.headers())
+    store = storage.JournaledStorage(remote, str(tmp_path / "journal.db"))
+    async with running(store, monkeypatch) as client:
+        yield client, fake, store
+
+async def data(client: httpx.AsyncClient, player: str = "singleton") -> Dict[str, Any]:
+    r = await client.get(f"/p/{player}/api/data")
+    assert r.status_code == 200, r.text
+    return r.json()["data"]
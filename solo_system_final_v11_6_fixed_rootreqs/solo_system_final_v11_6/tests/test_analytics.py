@@ -0,0 +1,23 @@
+import pytest
+
+from conftest import data
+
+pytestmark = pytest.mark.anyio
+
+async def test_analytics_counts_completed_tasks(sqlite_app):
+    task = (await sqlite_app.post("/api/tasks/add", json={"task": "t", "coins": 4, "xp": 20,
+                                                          "stat": "strength"})).json()["task"]
+    await sqlite_app.post(f"/api/tasks/{task['id']}/toggle")
+    await data(sqlite_app)
+    for granularity in ("day", "week", "month"):
+        r = await sqlite_app.get(f"/api/analytics?granularity={granularity}")
+        assert r.status_code == 200
+        totals = r.json()["totals"]
+        assert totals["earned"] == 4 and totals["done"] == {"strength": 1}, totals
+        assert totals["xp"] == {"strength": 20}
+
+async def test_analytics_rejects_bad_ranges(sqlite_app):
+    assert (await sqlite_app.get("/api/analytics?granularity=year")).status_code == 400
+    assert (await sqlite_app.get("/api/analytics?from=2024-02-01&to=2024-01-01")).status_code == 400
+    r = await sqlite_app.get("/api/analytics?granularity=day&from=1900-01-01&to=2024-01-01")
+    assert r.status_code == 400
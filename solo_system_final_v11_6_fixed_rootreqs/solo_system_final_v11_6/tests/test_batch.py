@@ -0,0 +1,66 @@
+import pytest
+
+import main
+from conftest import data
+
+pytestmark = pytest.mark.anyio
+
+async def reloaded(client):
+    """The document as stored, not the cached copy."""
+    main.players.get("singleton").cache.invalidate()
+    return await data(client)
+
+async def test_batch_applies_ops_in_order(sqlite_app):
+    task = (await sqlite_app.post("/api/tasks/add", json={"task": "t", "coins": 25})).json()["task"]
+    r = await sqlite_app.post("/api/batch", json={"ops": [
+        {"op": "task.toggle", "id": task["id"]},
+        {"op": "diary.add", "entry": "batched"},
+        {"op": "shop.buy", "id": 2},
+    ]})
+    assert r.status_code == 200
+    assert [x["op"] for x in r.json()["results"]] == ["task.toggle", "diary.add", "shop.buy"]
+    doc = await reloaded(sqlite_app)
+    assert doc["tasks"][0]["done"] is True
+    assert doc["diary"][-1]["text"] == "batched"
+    assert doc["shop"]["coins"] == 5
+
+async def test_failing_op_rolls_back_the_whole_batch(sqlite_app):
+    task = (await sqlite_app.post("/api/tasks/add", json={"task": "t"})).json()["task"]
+    before = await reloaded(sqlite_app)
+    r = await sqlite_app.post("/api/batch", json={"ops": [
+        {"op": "task.toggle", "id": task["id"]},
+        {"op": "diary.add", "entry": "never kept"},
+        {"op": "task.delete", "id": "missing"},
+    ]})
+    assert r.status_code == 404
+    assert r.json()["failed"] == 2 and r.json()["op"] == "task.delete"
+    assert await data(sqlite_app) == before  # the cached copy was rolled back
+    assert await reloaded(sqlite_app) == before  # and nothing was written
+
+async def test_bad_op_is_rejected_before_anything_runs(sqlite_app):
+    await sqlite_app.post("/api/tasks/add", json={"task": "t"})
+    before = await reloaded(sqlite_app)
+    r = await sqlite_app.post("/api/batch", json={"ops": [{"op": "diary.add", "entry": "x"}, {"op": "nope"}]})
+    assert r.status_code == 400 and r.json()["failed"] == 1
+    assert await reloaded(sqlite_app) == before
+
+@pytest.mark.parametrize("op", [
+    {"op": "settings", "sounds": False},
+    {"op": "settings", "settings": {"sounds": False}},
+])
+async def test_settings_op_stores_only_the_settings(sqlite_app, op):
+    r = await sqlite_app.post("/api/batch", json={"ops": [op]})
+    assert r.status_code == 200
+    settings = (await reloaded(sqlite_app))["settings"]
+    assert settings == {"sounds": False, "mobile_fullscreen": True}
+
+async def test_settings_left_by_old_batches_are_cleaned(sqlite_app):
+    def old_batch(p):
+        # what a v2 document looks like after the settings op leaked its keys
+        p.set(("settings", "op"), "settings")
+        p.set(("schema_version",), 2)
+        return {}
+    await main.mutate(old_batch, player=main.players.get("singleton"))
+    doc = await reloaded(sqlite_app)
+    assert doc["schema_version"] == 3
+    assert doc["settings"] == {"sounds": True, "mobile_fullscreen": True}
@@ -0,0 +1,61 @@
+import gzip
+import re
+import shutil
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+import assets
+import main
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def built(tmp_path):
+    """A fresh build of a copy of static/, mounted at /static."""
+    static = tmp_path / "static"
+    shutil.copytree(main.STATIC_DIR, static, ignore=shutil.ignore_patterns(assets.DIST, "__pycache__"))
+    files = assets.AssetFiles(str(static))
+    app = Starlette(routes=[Mount("/static", files)])
+    return files, httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+async def test_data_revalidates_with_its_etag(sqlite_app):
+    r = await sqlite_app.get("/api/data")
+    etag = r.headers["ETag"]
+    assert r.headers["Cache-Control"] == "private, no-cache"
+    r = await sqlite_app.get("/api/data", headers={"If-None-Match": etag})
+    assert r.status_code == 304 and r.content == b"" and r.headers["ETag"] == etag
+    await sqlite_app.post("/api/tasks/add", json={"task": "t"})
+    r = await sqlite_app.get("/api/data", headers={"If-None-Match": etag})
+    assert r.status_code == 200 and r.headers["ETag"] != etag
+
+async def test_pages_link_fingerprinted_immutable_assets(built):
+    files, client = built
+    index = files.files["index.html"].bodies["identity"].decode()
+    links = re.findall(r'/static/(app\.[0-9a-f]{10}\.js)', index)
+    assert links and "/static/app.js" not in index
+    async with client:
+        r = await client.get(f"/static/{links[0]}")
+        assert r.status_code == 200 and r.headers["Cache-Control"] == assets.IMMUTABLE
+        assert assets.hashed_name("app.js", r.content) == links[0]
+        assert (await client.get(f"/static/{links[0]}", headers={"If-None-Match": r.headers["ETag"]})).status_code == 304
+    sw = files.files["sw.js"]
+    assert sw.cache == assets.REVALIDATE and f"solo-cache-{files.version}".encode() in sw.bodies["identity"]
+
+async def test_bodies_are_negotiated_by_accept_encoding(built):
+    files, client = built
+    name = next(n for n in files.files if n.startswith("app."))
+    plain = files.files[name].bodies["identity"]
+    async with client:
+        r = await client.get(f"/static/{name}", headers={"Accept-Encoding": "gzip"})
+        assert r.headers["Content-Encoding"] == "gzip" and r.headers["Vary"] == "Accept-Encoding"
+        assert r.content == plain  # httpx decodes it
+        assert r.headers["ETag"].endswith('-gzip"')
+        r = await client.get(f"/static/{name}", headers={"Accept-Encoding": "gzip;q=0"})
+        assert "Content-Encoding" not in r.headers and r.content == plain
+        if assets.brotli is not None:
+            r = await client.get(f"/static/{name}", headers={"Accept-Encoding": "gzip, br"})
+            assert r.headers["Content-Encoding"] == "br"
+    assert gzip.decompress(files.files[name].bodies["gzip"]) == plain
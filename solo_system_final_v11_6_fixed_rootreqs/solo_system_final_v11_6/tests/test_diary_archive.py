@@ -0,0 +1,43 @@
+import pytest
+
+import main
+from conftest import data
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def small_diary(monkeypatch):
+    monkeypatch.setattr(main, "DIARY_HOT_MAX", 4)
+    monkeypatch.setattr(main, "DIARY_HOT_DAYS", 0)
+
+async def settle(player_id):
+    player = main.players.get(player_id)
+    while player.compaction is not None and not player.compaction.done():
+        await player.compaction
+
+async def write_days(client, monkeypatch, n):
+    """One entry a day from 2020-01-01; the odd days mention the gym."""
+    for day in range(1, n + 1):
+        monkeypatch.setattr(main, "now_iso", lambda day=day: f"2020-01-{day:02d}T09:00:00")
+        text = f"day {day} gym" if day % 2 else f"day {day} rest"
+        assert (await client.post("/api/diary/add", json={"entry": text})).status_code == 200
+    await settle("singleton")
+
+async def search(client, query):
+    r = await client.get(f"/api/diary/search?{query}")
+    assert r.status_code == 200, r.text
+    return [e["text"] for e in r.json()["diary"]]
+
+async def test_overflow_moves_to_the_archive_and_stays_searchable(sqlite_app, small_diary, monkeypatch):
+    await write_days(sqlite_app, monkeypatch, 10)
+    hot = [e["text"] for e in (await data(sqlite_app))["diary"]]
+    assert len(hot) <= 4 and hot[-1] == "day 10 rest"
+    assert await search(sqlite_app, "q=gym") == [f"day {d} gym" for d in (9, 7, 5, 3, 1)]
+    assert await search(sqlite_app, "from=2020-01-02&to=2020-01-03") == ["day 3 gym", "day 2 rest"]
+    assert await search(sqlite_app, "q=rest&to=2020-01-04") == ["day 4 rest", "day 2 rest"]
+    assert await search(sqlite_app, "q=gym&limit=2") == ["day 9 gym", "day 7 gym"]
+
+async def test_search_rejects_bad_dates_and_empty_queries(sqlite_app):
+    r = await sqlite_app.get("/api/diary/search?from=yesterday")
+    assert r.status_code == 400 and r.json()["error"] == "from/to must be ISO dates"
+    assert (await sqlite_app.get("/api/diary/search")).status_code == 400
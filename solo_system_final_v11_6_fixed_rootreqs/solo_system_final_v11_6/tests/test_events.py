@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+def parse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if fields:
+            events.append(fields)
+    return events
+
+async def stream(client, act, headers=None):
+    """Events seen by a subscriber while `act` runs; the hub is closed to end the stream."""
+    hub = main.players.get("singleton").events
+    before = len(hub.subscribers)
+    get = asyncio.ensure_future(client.get("/api/events", headers=headers or {}))
+    while len(hub.subscribers) == before:  # ASGITransport only returns once the stream ends
+        await asyncio.sleep(0.01)
+    await act()
+    hub.close()
+    r = await get
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/event-stream")
+    return parse(r.text)
+
+async def test_mutations_reach_a_subscriber(sqlite_app):
+    await sqlite_app.get("/api/data")
+
+    async def add():
+        await sqlite_app.post("/api/tasks/add", json={"task": "seen"})
+    events = await stream(sqlite_app, add)
+    assert [e["event"] for e in events] == ["hello", "task.added"]
+    assert '"seen"' in events[1]["data"]
+
+async def test_last_event_id_replays_missed_events(sqlite_app):
+    async def nothing():
+        pass
+    await sqlite_app.get("/api/data")
+    last = (await stream(sqlite_app, nothing))[0]["id"]
+    for i in range(2):
+        await sqlite_app.post("/api/tasks/add", json={"task": f"missed {i}"})
+
+    async def add():
+        await sqlite_app.post("/api/tasks/add", json={"task": "live"})
+    events = await stream(sqlite_app, add, {"Last-Event-ID": last})
+    assert [e["event"] for e in events] == ["task.added"] * 3
+    for event, task in zip(events, ["missed 0", "missed 1", "live"]):
+        assert f'"{task}"' in event["data"]
+    ids = [int(e["id"].rpartition("-")[2]) for e in events]
+    assert ids == sorted(ids) and ids[0] == int(last.rpartition("-")[2]) + 1
+
+    events = await stream(sqlite_app, nothing, {"Last-Event-ID": "old-epoch-1"})
+    assert [e["event"] for e in events] == ["resync"]
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+import main
+from conftest import data
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def small_tiers(monkeypatch):
+    # small enough that the source player has archived diary and ledger entries
+    monkeypatch.setattr(main, "DIARY_HOT_MAX", 6)
+    monkeypatch.setattr(main, "DIARY_HOT_DAYS", 0)
+    monkeypatch.setattr(main, "LEDGER_HOT_MAX", 8)
+    monkeypatch.setattr(main, "IMPORT_BATCH", 5)
+
+async def settle(player_id):
+    player = main.players.get(player_id)
+    while player.compaction is not None and not player.compaction.done():
+        await player.compaction
+
+async def build_source(client):
+    for i in range(4):
+        task = (await client.post("/p/src/api/tasks/add", json={"task": f"t{i}", "coins": i + 1, "xp": 30,
+                                                                 "stat": "strength"})).json()["task"]
+        for _ in range(i + 3):
+            await client.post(f"/p/src/api/tasks/{task['id']}/toggle")
+    for i in range(20):
+        await client.post("/p/src/api/diary/add", json={"entry": f"entry {i}"})
+    await client.post("/p/src/api/settings", json={"sounds": False})
+    await settle("src")
+
+async def export(client, player):
+    r = await client.get(f"/p/{player}/api/export")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("application/x-ndjson")
+    return r.content
+
+def records(body):
+    return [json.loads(line) for line in body.splitlines()]
+
+def without_header(body):
+    return [r for r in records(body) if r["type"] != "header"]
+
+async def test_export_includes_archived_history(sqlite_app, small_tiers):
+    await build_source(sqlite_app)
+    doc = await data(sqlite_app, "src")
+    assert len(doc["diary"]) < 20 and doc["ledger_checkpoint"]["seq"] > 0  # tiers really were used
+    recs = records(await export(sqlite_app, "src"))
+    kinds = [r["type"] for r in recs]
+    assert kinds[:3] == ["header", "settings", "state"] and kinds[-1] == "end"
+    assert recs[-1]["counts"] == {"task": 4, "diary": 20, "ledger": sum(i + 3 for i in range(4))}
+    assert [r["data"]["seq"] for r in recs if r["type"] == "ledger"] == list(range(1, 19))
+    assert [r["data"]["text"] for r in recs if r["type"] == "diary"] == [f"entry {i}" for i in range(20)]
+
+async def test_import_round_trips_an_export(sqlite_app, small_tiers):
+    await build_source(sqlite_app)
+    body = await export(sqlite_app, "src")
+    r = await sqlite_app.post("/p/dst/api/import", content=body)
+    assert r.status_code == 200, r.text
+    assert r.json()["import"]["done"] is True
+    await settle("dst")
+    assert without_header(await export(sqlite_app, "dst")) == without_header(body)
+    src, dst = await data(sqlite_app, "src"), await data(sqlite_app, "dst")
+    for key in ("tasks", "shop", "stat_progress", "stats", "settings"):
+        assert dst[key] == src[key], key
+
+async def test_truncated_import_resumes_from_its_checkpoint(sqlite_app, small_tiers, caplog):
+    await build_source(sqlite_app)
+    body = await export(sqlite_app, "src")
+    lines = body.splitlines(keepends=True)
+    cut = b"".join(lines[:27]) + lines[27][:10]  # the upload dies mid-line
+    r = await sqlite_app.post("/p/dst/api/import", content=cut)
+    assert r.status_code == 400
+    assert r.json()["line"] == 28
+    status = (await sqlite_app.get("/p/dst/api/import")).json()
+    assert status["running"] is False
+    assert status["import"]["done"] is False and status["import"]["line"] == 27
+    applied = status["import"]["counts"]
+    assert sum(applied.values()) == 27 - 3  # header, settings, state
+
+    r = await sqlite_app.post("/p/dst/api/import", content=body)
+    assert r.status_code == 200, r.text
+    assert "Resuming import" in caplog.text
+    result = r.json()["import"]
+    assert result["done"] is True and result["skipped"] == 0
+    assert result["counts"] == records(body)[-1]["counts"]
+    await settle("dst")
+    assert without_header(await export(sqlite_app, "dst")) == without_header(body)
+
+async def test_restart_discards_a_partial_import(sqlite_app, small_tiers, caplog):
+    await build_source(sqlite_app)
+    body = await export(sqlite_app, "src")
+    lines = body.splitlines(keepends=True)
+    await sqlite_app.post("/p/dst/api/import", content=b"".join(lines[:20]))
+    r = await sqlite_app.post("/p/dst/api/import?restart=1", content=body)
+    assert r.status_code == 200
+    assert "Resuming import" not in caplog.text
+    await settle("dst")
+    assert without_header(await export(sqlite_app, "dst")) == without_header(body)
+
+async def test_bad_input_is_rejected_with_its_line(sqlite_app):
+    r = await sqlite_app.post("/api/import", content=b'{"type":"task"}\n')
+    assert r.status_code == 400
+    header = json.dumps({"type": "header", "format": main.EXPORT_FORMAT, "version": main.EXPORT_VERSION,
+                         "export_id": "x", "schema_version": main.model.SCHEMA_VERSION})
+    r = await sqlite_app.post("/api/import", content=f'{header}\n{{"type":"state","data":{{}}}}\nnot json\n'.encode())
+    assert r.status_code == 400 and r.json()["line"] == 3
+    newer = header.replace(f'"schema_version": {main.model.SCHEMA_VERSION}', '"schema_version": 99')
+    assert (await sqlite_app.post("/api/import", content=newer.encode() + b"\n")).status_code == 400
+
+async def test_state_applied_in_a_later_batch_reaches_the_rows(sqlite_app, monkeypatch):
+    monkeypatch.setattr(main, "IMPORT_BATCH", 1)  # settings and state land in separate writes
+    await sqlite_app.post("/p/src/api/tasks/add", json={"task": "t"})
+    recs = records(await export(sqlite_app, "src"))
+    state = next(r for r in recs if r["type"] == "state")
+    catalog = state["data"]["shop"]["catalog"][:2]
+    catalog[0]["price"] = 999
+    state["data"]["shop"]["catalog"] = catalog
+    body = b"".join(json.dumps(r).encode() + b"\n" for r in recs)
+    r = await sqlite_app.post("/p/dst/api/import", content=body)
+    assert r.status_code == 200, r.text
+    stored, _ = await main.store.load("dst")
+    assert stored["shop"]["catalog"] == catalog
+    assert [t["task"] for t in stored["tasks"]] == ["t"]
@@ -0,0 +1,64 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+import storage
+from conftest import data, running
+from fake_postgrest import FakePostgrest, Faults
+
+pytestmark = pytest.mark.anyio
+
+async def drained(store, seconds=5.0):
+    for _ in range(int(seconds / 0.05)):
+        if not store.journal.pending:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+def remote_tasks(fake):
+    return [t["task"] for t in fake.rows["singleton"]["data"]["tasks"]]
+
+async def test_writes_during_an_outage_are_journaled_and_replayed(remote_app):
+    client, fake, store = remote_app
+    assert (await client.post("/api/tasks/add", json={"task": "before"})).status_code == 200
+    fake.faults["*"] = Faults(error_rate=1.0)
+    for i in range(4):
+        r = await client.post("/api/tasks/add", json={"task": f"down {i}"})
+        assert r.status_code == 200
+    task_id = (await data(client))["tasks"][0]["id"]
+    assert (await client.post(f"/api/tasks/{task_id}/toggle")).status_code == 200
+    assert store.journal.pending > 0
+    assert store.inner.breaker.state == "open"
+    assert remote_tasks(fake) == ["before"]
+    local = await data(client)  # served from the journaled copy while down
+    assert [t["task"] for t in local["tasks"]] == ["before", "down 0", "down 1", "down 2", "down 3"]
+
+    fake.faults.clear()
+    assert await drained(store)
+    remote = fake.rows["singleton"]["data"]
+    assert remote == await data(client)
+    assert remote["tasks"][0]["done"] is True and remote["shop"]["coins"] == 5
+
+async def test_journal_survives_a_restart_during_an_outage(tmp_path, monkeypatch):
+    fake = FakePostgrest()
+
+    def make_store():
+        remote = storage.SupabaseJsonStorage("http://fake-postgrest", "test", main.seed_data)
+        remote.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake), headers=remote.headers())
+        return storage.JournaledStorage(remote, str(tmp_path / "journal.db"))
+
+    async with running(make_store(), monkeypatch) as client:
+        await client.post("/api/tasks/add", json={"task": "before"})
+        fake.faults["*"] = Faults(error_rate=1.0)
+        for i in range(2):
+            assert (await client.post("/api/tasks/add", json={"task": f"down {i}"})).status_code == 200
+    # shut down while still down: the edits wait in the journal file
+    assert remote_tasks(fake) == ["before"]
+    fake.faults.clear()
+    store = make_store()
+    async with running(store, monkeypatch) as client:
+        assert await drained(store)
+        assert remote_tasks(fake) == ["before", "down 0", "down 1"]
+        assert [t["task"] for t in (await data(client))["tasks"]] == ["before", "down 0", "down 1"]
@@ -0,0 +1,71 @@
+import pytest
+
+import main
+from conftest import data
+
+pytestmark = pytest.mark.anyio
+
+async def toggle(client, task_id):
+    r = await client.post(f"/api/tasks/{task_id}/toggle")
+    assert r.status_code == 200
+    return r.json()
+
+def balance(doc):
+    return (doc["shop"]["coins"], doc["stat_progress"]["strength"], doc["stats"]["tasks_completed"])
+
+async def stored(client):
+    main.players.get("singleton").cache.invalidate()
+    return await data(client)
+
+async def test_toggle_and_untoggle_reverse_coins_and_xp(sqlite_app):
+    task = (await sqlite_app.post("/api/tasks/add", json={
+        "task": "lift", "coins": 7, "xp": 150, "stat": "strength"})).json()["task"]
+    start = balance(await data(sqlite_app))
+    done = await toggle(sqlite_app, task["id"])
+    assert done["coins"] == 7 and done["tasks_completed"] == 1
+    assert done["stat_progress"]["strength"] == {"level": 2, "xp": 50}
+    undone = await toggle(sqlite_app, task["id"])
+    assert undone["task"]["done"] is False
+    doc = await stored(sqlite_app)
+    assert balance(doc) == start
+    assert [(e["kind"], e["coins"], e["xp"], e["tasks"]) for e in doc["ledger"]] == [
+        ("task.reward", 7, 150, 1), ("task.revert", -7, -150, -1)]
+    # the materialized balance is the ledger folded onto its checkpoint
+    folded = main.fold_ledger(doc["ledger_checkpoint"], doc["ledger"])
+    assert folded["coins"] == doc["shop"]["coins"]
+    assert folded["tasks_completed"] == doc["stats"]["tasks_completed"]
+    assert main.xp_progress(folded["xp"].get("strength", 0)) == doc["stat_progress"]["strength"]
+
+async def test_revert_never_takes_coins_below_zero(sqlite_app):
+    task = (await sqlite_app.post("/api/tasks/add", json={"task": "t", "coins": 25})).json()["task"]
+    await toggle(sqlite_app, task["id"])
+    assert (await sqlite_app.post("/api/shop/buy/2")).status_code == 200  # spends 20 of the 25
+    await toggle(sqlite_app, task["id"])
+    doc = await stored(sqlite_app)
+    assert doc["shop"]["coins"] == 0
+    assert doc["ledger"][-1]["kind"] == "task.revert" and doc["ledger"][-1]["coins"] == -5
+
+async def test_toggle_again_after_revert_rewards_again(sqlite_app):
+    task = (await sqlite_app.post("/api/tasks/add", json={"task": "t", "coins": 3, "xp": 10,
+                                                          "stat": "strength"})).json()["task"]
+    for _ in range(3):
+        await toggle(sqlite_app, task["id"])
+    doc = await stored(sqlite_app)
+    assert balance(doc) == (3, {"level": 1, "xp": 10}, 1)
+    assert [e["seq"] for e in doc["ledger"]] == [1, 2, 3]
+
+async def test_archived_entries_fold_into_the_checkpoint(sqlite_app, monkeypatch):
+    monkeypatch.setattr(main, "LEDGER_HOT_MAX", 8)
+    task = (await sqlite_app.post("/api/tasks/add", json={"task": "t", "coins": 2, "xp": 40,
+                                                          "stat": "strength"})).json()["task"]
+    for _ in range(21):  # ends done: 11 rewards, 10 reverts
+        await toggle(sqlite_app, task["id"])
+    player = main.players.get("singleton")
+    if player.compaction is not None:
+        await player.compaction
+    doc = await stored(sqlite_app)
+    assert len(doc["ledger"]) <= 8 and doc["ledger_checkpoint"]["seq"] == 21 - len(doc["ledger"])
+    assert balance(doc) == (2, {"level": 1, "xp": 40}, 1)
+    # the history reads through the archive, newest first, with no gaps
+    r = await sqlite_app.get("/api/ledger?limit=50")
+    assert [e["seq"] for e in r.json()["ledger"]] == list(range(21, 0, -1))
@@ -0,0 +1,44 @@
+import re
+
+import pytest
+
+import main
+
+pytestmark = pytest.mark.anyio
+
+SAMPLE = re.compile(r'^[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? [-+0-9.eE]+(Inf)?$')
+
+async def test_metrics_is_prometheus_text(sqlite_app):
+    await sqlite_app.post("/api/tasks/add", json={"task": "t"})
+    r = await sqlite_app.get("/metrics")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = r.text.splitlines()
+    for line in lines:
+        assert line.startswith(("# HELP ", "# TYPE ")) or SAMPLE.match(line), line
+    assert "# TYPE solo_request_duration_seconds histogram" in lines
+    count = next(line for line in lines if line.startswith("solo_request_duration_seconds_count")
+                 and 'route="api_add_task"' in line)
+    assert float(count.rsplit(" ", 1)[1]) >= 1
+    assert any(line.startswith('solo_stage_duration_seconds_bucket{stage="store_write",le="+Inf"}') for line in lines)
+
+async def test_metrics_token_is_checked(sqlite_app, monkeypatch):
+    monkeypatch.setattr(main, "METRICS_TOKEN", "s3cret")
+    assert (await sqlite_app.get("/metrics")).status_code == 401
+    assert (await sqlite_app.get("/metrics", headers={"Authorization": "Bearer s3cret"})).status_code == 200
+
+async def test_responses_carry_server_timing(sqlite_app, monkeypatch):
+    r = await sqlite_app.get("/api/data")
+    timing = r.headers["Server-Timing"]
+    assert re.match(r"total;dur=[0-9.]+", timing)
+    assert "store_load;dur=" in timing and "json_encode;dur=" in timing
+    monkeypatch.setattr(main, "SERVER_TIMING", False)
+    assert "Server-Timing" not in (await sqlite_app.get("/api/data")).headers
+
+async def test_profiler_is_off_unless_enabled(sqlite_app, monkeypatch):
+    r = await sqlite_app.post("/api/profile/start")
+    assert r.status_code == 404 and "PROFILER=1" in r.json()["error"]
+    monkeypatch.setattr(main, "PROFILER", True)
+    assert (await sqlite_app.post("/api/profile/start?interval_ms=1&seconds=5")).status_code == 200
+    assert (await sqlite_app.post("/api/profile/start")).status_code == 409
+    r = await sqlite_app.post("/api/profile/stop")
+    assert r.status_code == 200 and int(r.headers["X-Profile-Samples"]) >= 0
@@ -0,0 +1,79 @@
+import copy
+import json
+
+import pytest
+
+import main
+import model
+import storage
+from conftest import data, running
+from storage import DocPatch
+
+pytestmark = pytest.mark.anyio
+
+def v1_doc():
+    """A schema v1 document: ids everywhere, but shapes as old clients left them."""
+    doc = main.seed_data()
+    doc["schema_version"] = 1
+    doc["shop"]["coins"] = "12"
+    doc["stats"] = {}
+    doc["streak"] = None
+    doc["stat_progress"]["strength"] = {"level": "3", "xp": -5}
+    doc["stat_progress"]["discipline"] = "broken"
+    doc["tasks"] = [{"id": "t1", "task": "old", "coins": "3", "stat": " Strength ", "done": 0}]
+    del doc["attributes"]
+    return doc
+
+def test_v1_to_v2_fills_shapes_and_coerces_types():
+    doc = v1_doc()
+    ran = model.migrate(DocPatch(doc), main.seed_data)
+    assert ran == ["fill_shape", "clean_settings"]
+    assert doc["schema_version"] == model.SCHEMA_VERSION
+    assert doc["shop"]["coins"] == 12 and doc["stats"] == {"tasks_completed": 0}
+    assert doc["streak"] == 0 and doc["attributes"] == main.seed_data()["attributes"]
+    assert doc["stat_progress"]["strength"] == {"level": 3, "xp": 0}
+    assert doc["stat_progress"]["discipline"] == {"level": 1, "xp": 0}
+    assert doc["tasks"] == [{"id": "t1", "task": "old", "coins": 3, "xp": 0, "stat": "strength", "done": False}]
+
+def test_migration_ops_replay_to_the_same_document():
+    doc = v1_doc()
+    replica = copy.deepcopy(doc)
+    p = DocPatch(doc)
+    model.migrate(p, main.seed_data)
+    assert storage.apply_ops(replica, p.ops) == doc
+
+def test_current_document_is_left_alone():
+    doc = main.seed_data()
+    p = DocPatch(doc)
+    assert model.migrate(p, main.seed_data) == [] and p.ops == []
+
+async def test_legacy_file_is_migrated_once_and_saved(tmp_path, monkeypatch):
+    legacy = tmp_path / "player_data.json"
+    legacy.write_text(json.dumps({
+        "punishments": ["pushups", {"text": "no sugar"}],
+        "tasks": [{"task": "legacy", "coins": "4", "done": False}],
+        "diary": [{"text": "old entry", "ts": "2019-01-01T00:00:00"}],
+        "shop": {"coins": "9"},
+    }))
+    store = storage.SQLiteStorage(str(tmp_path / "solo.db"), main.seed_data,
+                                  legacy_json=str(legacy), legacy_player="singleton")
+    async with running(store, monkeypatch) as client:
+        doc = await data(client)
+        assert doc["schema_version"] == model.SCHEMA_VERSION
+        assert [p["text"] for p in doc["punishments"]] == ["pushups", "no sugar"]
+        assert all(item.get("id") for key in model.ID_LISTS for item in doc[key])
+        assert doc["shop"]["coins"] == 9 and doc["tasks"][0]["coins"] == 4
+        ids = [t["id"] for t in doc["tasks"]] + [p["id"] for p in doc["punishments"]]
+        main.players.get("singleton").cache.invalidate()
+        again = await data(client)
+        assert [t["id"] for t in again["tasks"]] + [p["id"] for p in again["punishments"]] == ids
+
+async def test_remote_row_is_migrated_in_place(remote_app):
+    client, fake, store = remote_app
+    fake.put("singleton", v1_doc(), version=4)
+    doc = await data(client)
+    row = fake.rows["singleton"]
+    assert row["version"] == 5
+    assert row["data"]["schema_version"] == model.SCHEMA_VERSION
+    assert row["data"]["shop"]["coins"] == 12
+    assert row["data"] == doc
@@ -0,0 +1,29 @@
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+async def add_tasks(client, n):
+    for i in range(n):
+        assert (await client.post("/api/tasks/add", json={"task": f"t{i}"})).status_code == 200
+
+async def test_tasks_are_paged_newest_first(sqlite_app):
+    await add_tasks(sqlite_app, 5)
+    first = (await sqlite_app.get("/api/tasks?limit=2")).json()
+    assert [t["task"] for t in first["tasks"]] == ["t4", "t3"] and first["total"] == 5
+    second = (await sqlite_app.get(f"/api/tasks?limit=2&after={first['next']}")).json()
+    assert [t["task"] for t in second["tasks"]] == ["t2", "t1"]
+    last = (await sqlite_app.get(f"/api/tasks?limit=2&after={second['next']}")).json()
+    assert [t["task"] for t in last["tasks"]] == ["t0"] and last["next"] is None
+
+async def test_unknown_cursor_is_rejected(sqlite_app):
+    await add_tasks(sqlite_app, 1)
+    r = await sqlite_app.get("/api/tasks?after=nope")
+    assert r.status_code == 400 and r.json()["error"] == "Unknown cursor"
+    assert (await sqlite_app.get("/api/diary?after=nope")).status_code == 400
+
+async def test_fields_selects_dotted_keys(sqlite_app):
+    await add_tasks(sqlite_app, 1)
+    doc = (await sqlite_app.get("/api/data?fields=shop.coins,stats,missing")).json()["data"]
+    assert doc == {"shop": {"coins": 0}, "stats": {"tasks_completed": 0}}
+    doc = (await sqlite_app.get("/api/data?fields=shop,shop.coins")).json()["data"]
+    assert set(doc) == {"shop"} and "catalog" in doc["shop"]
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+import main
+import storage
+
+pytestmark = pytest.mark.anyio
+
+async def add_task(client, **body):
+    r = await client.post("/api/tasks/add", json={"task": "overdue", "coins": 5, **body})
+    assert r.status_code == 200
+    return r.json()["task"]
+
+async def test_overdue_task_is_failed_and_punished(sqlite_app):
+    task = await add_task(sqlite_app, deadline="2020-01-01T00:00")
+    assert main.deadlines.stats()["tracked"] == 1
+    await main.deadlines.fire(time.time())
+    doc = await main.load_data(main.players.get("singleton"))
+    assert doc["tasks"][0]["failed"] is True
+    assert [p["task"] for p in doc["ongoing_punishments"]] == [task["id"]]
+    assert main.deadlines.stats()["tracked"] == 0
+
+async def test_reformatted_deadline_still_fails(sqlite_app):
+    # a timestamptz round trip gives "2020-01-01T00:00:00" back for "2020-01-01T00:00"
+    await add_task(sqlite_app, deadline="2020-01-01T00:00")
+    doc = await main.load_data(main.players.get("singleton"))
+    doc["tasks"][0]["deadline"] = "2020-01-01T00:00:00"
+    await main.deadlines.fire(time.time())
+    assert doc["tasks"][0]["failed"] is True
+    assert len(doc["ongoing_punishments"]) == 1
+
+async def test_moved_deadline_is_not_failed(sqlite_app):
+    await add_task(sqlite_app, deadline="2020-01-01T00:00")
+    doc = await main.load_data(main.players.get("singleton"))
+    doc["tasks"][0]["deadline"] = "2099-01-01T00:00"  # extended elsewhere
+    await main.deadlines.fire(time.time())
+    assert doc["tasks"][0]["failed"] is False
+    assert doc["ongoing_punishments"] == []
+
+def test_postgres_timestamp_round_trip_keeps_the_instant():
+    pg = storage.PostgresStorage.__new__(storage.PostgresStorage)
+    for deadline in ("2024-05-01T00:00", "2024-05-01T23:59:30", "2024-05-01T08:15:00.250000"):
+        back = pg.from_db_ts(pg.to_db_ts(deadline))
+        assert main.deadline_ts(back) == main.deadline_ts(deadline)
+
+async def test_reload_rescans_deadlines_changed_elsewhere(remote_app):
+    client, fake, store = remote_app
+    await add_task(client, deadline="2099-01-01T00:00")
+    await add_task(client, deadline="2099-01-01T00:00")
+    # another worker moves the first deadline into the past and deletes the second
+    row = fake.rows["singleton"]
+    row["data"]["tasks"][0]["deadline"] = "2020-01-01T00:00"
+    del row["data"]["tasks"][1]
+    row["version"] += 1
+    main.players.get("singleton").cache.invalidate()
+    doc = await main.load_data(main.players.get("singleton"))
+    assert main.deadlines.stats()["tracked"] == 1
+    await main.deadlines.fire(time.time())
+    assert doc["tasks"][0]["failed"] is True
+    assert fake.rows["singleton"]["data"]["tasks"][0]["failed"] is True
+    # a reload that changed nothing adds no heap entries
+    main.deadlines.register("singleton", {"tasks": [{"id": "t", "deadline": "2099-01-01T00:00"}]})
+    heap = len(main.deadlines.heap)
+    main.deadlines.register("singleton", {"tasks": [{"id": "t", "deadline": "2099-01-01T00:00"}]})
+    assert len(main.deadlines.heap) == heap and main.deadlines.stats()["tracked"] == 1
@@ -0,0 +1,72 @@
+import copy
+
+import pytest
+
+import main
+from conftest import data
+from storage import DocPatch, apply_ops
+
+pytestmark = pytest.mark.anyio
+
+def test_docpatch_rollback_restores_document():
+    doc = main.seed_data()
+    doc["tasks"].append({"id": "t1", "task": "a", "done": False})
+    before = copy.deepcopy(doc)
+    p = DocPatch(doc)
+    p.set(("tasks", 0, "done"), True)
+    p.append(("diary",), {"id": "d1", "text": "x"})
+    p.remove(("punishments", 0))
+    p.set(("rollups", "day", "2024-05-01"), {"done": 1})  # creates missing parents
+    mark = p.savepoint()
+    p.set(("shop", "coins"), 99)
+    p.rollback(mark)
+    assert doc["shop"]["coins"] == 0 and len(p.ops) == mark[0]
+    p.rollback()
+    assert doc == before and p.ops == []
+    assert p.find("tasks", "t1") == 0
+
+def test_docpatch_ops_replay_to_same_document():
+    doc = main.seed_data()
+    replica = copy.deepcopy(doc)
+    p = DocPatch(doc)
+    p.append(("tasks",), {"id": "t1", "task": "a"})
+    p.set(("tasks", 0, "done"), True)
+    p.set(("stats", "tasks_completed"), 1)
+    p.remove(("non_negotiables", 1))
+    assert apply_ops(replica, p.ops) == doc
+
+async def test_write_conflict_is_retried_on_fresh_document(remote_app, caplog):
+    client, fake, store = remote_app
+    await data(client)
+    # another worker writes behind this one's cached copy
+    row = fake.rows["singleton"]
+    row["data"]["tasks"].append({"id": "other", "task": "from another worker", "done": False,
+                                 "coins": 5, "xp": 0, "stat": "discipline"})
+    row["version"] += 1
+    r = await client.post("/api/tasks/add", json={"task": "from this worker"})
+    assert r.status_code == 200
+    assert "version conflict" in caplog.text
+    stored = [t["task"] for t in fake.rows["singleton"]["data"]["tasks"]]
+    assert stored == ["from another worker", "from this worker"]
+    assert [t["task"] for t in (await data(client))["tasks"]] == stored
+
+async def test_setting_a_container_rewrites_the_lists_inside_it(sqlite_app):
+    player = main.players.get("singleton")
+    catalog = [{"id": 1, "name": "Skip Punishment", "price": 999, "effect": "skip_punishment", "value": 1},
+               {"id": 2, "name": "Cheat Meal", "price": 20, "effect": "cheat_meal", "value": 1}]
+    extra = {"id": 9, "name": "Nap", "price": 5, "effect": "nap", "value": 1}
+
+    def apply(p):
+        p.set(("shop",), {"coins": 3, "items": [], "catalog": copy.deepcopy(catalog)})
+        p.append(("shop", "catalog"), dict(extra))  # later ops still land on the new rows
+        p.set(("shop", "catalog", 1, "price"), 25)
+        return {}
+    await main.mutate(apply, player=player)
+    expected = [catalog[0], {**catalog[1], "price": 25}, extra]
+    stored, _ = await main.store.load("singleton")
+    assert stored["shop"]["catalog"] == expected and stored["shop"]["coins"] == 3
+    assert (await data(sqlite_app))["shop"]["catalog"] == expected
+
+    await main.mutate(lambda p: p.remove(("shop",)) and {}, player=player)
+    stored, _ = await main.store.load("singleton")
+    assert not (stored.get("shop") or {}).get("catalog")
@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+import main
+from conftest import data
+
+pytestmark = pytest.mark.anyio
+
+@pytest.fixture
+def write_behind(monkeypatch):
+    monkeypatch.setattr(main, "WRITE_BEHIND_MS", 20)  # players created from here on queue writes
+
+async def flushed(player, seconds=5.0):
+    for _ in range(int(seconds / 0.02)):
+        if not player.writer.dirty:
+            return True
+        await asyncio.sleep(0.02)
+    return False
+
+def remote_tasks(fake):
+    return [t["task"] for t in fake.rows["singleton"]["data"]["tasks"]]
+
+async def test_edits_are_coalesced_into_one_write(remote_app, write_behind):
+    client, fake, store = remote_app
+    await data(client)
+    player = main.players.get("singleton")
+    assert player.writer.enabled
+    fake.reset_counters()
+    for i in range(5):
+        assert (await client.post("/api/tasks/add", json={"task": f"t{i}"})).status_code == 200
+    assert await flushed(player)
+    assert remote_tasks(fake) == [f"t{i}" for i in range(5)]
+    assert player.writer.flushes <= 2 and sum(fake.requests.values()) <= 2
+
+async def test_queued_edits_are_rebased_onto_another_workers_write(remote_app, write_behind):
+    client, fake, store = remote_app
+    await client.post("/api/tasks/add", json={"task": "mine 1"})
+    player = main.players.get("singleton")
+    assert await flushed(player)
+    row = fake.rows["singleton"]
+    row["data"]["tasks"].append({"id": "other", "task": "theirs", "done": False,
+                                 "coins": 5, "xp": 0, "stat": "discipline"})
+    row["version"] += 1
+    await client.post("/api/tasks/add", json={"task": "mine 2"})
+    assert await flushed(player)
+    assert player.writer.conflicts == 1
+    assert remote_tasks(fake) == ["mine 1", "theirs", "mine 2"]
+    assert [t["task"] for t in (await data(client))["tasks"]] == remote_tasks(fake)